@@ -0,0 +1 @@
+"""Transfer benchmarks and the local SSH stand-in server they run against."""
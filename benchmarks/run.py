@@ -0,0 +1,294 @@
+"""Transfer benchmarks for clustertools against a local SSH stand-in server.
+
+Runs uploads and downloads of the standard workloads (see workloads.py)
+through a BenchmarkServer on 127.0.0.1, optionally with added latency and a
+bandwidth cap, and reports files/s, MB/s, phase timings and peak memory.
+
+Each case runs in a fresh child process so its peak RSS is its own. Since
+clustertools overlaps archiving, transfer and extraction, phases are read
+off the wire: "archive" is the time until bulk data starts moving,
+"transfer" until the last data byte arrives, and "extract" whatever the
+client still needs after that.
+
+Usage:
+    python benchmarks/run.py [--workloads tiny,mixed,huge,compressed] [--directions upload,download]
+                             [--scale 1.0] [--rtt MS] [--bandwidth MBIT] [--repeat N]
+                             [--workers N] [--backend NAME] [--stripes N] [--shards N]
+                             [--compression auto|none|lz4|zstd|gzip]
+                             [--json results.json] [--baseline old.json [--tolerance 0.15]]
+"""
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import BenchmarkServer
+from workloads import SINGLE_FILE, WORKLOADS, generate
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+DIRECTIONS = ['upload', 'download']
+
+# Bytes that must cross the wire before a transfer counts as started;
+# smaller exchanges are commands like mkdir, du or find
+BULK_THRESHOLD = 64 * 1024
+
+def max_rss_mb():
+    """Peak resident set size of this process in MB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def run_case(case):
+    """Run one transfer in this (child) process and return its timings."""
+    import importlib
+    import paramiko
+    from scp import SCPClient
+    from clustertools.login import progress
+
+    local2cluster = importlib.import_module('clustertools.local2cluster')
+    cluster2local = importlib.import_module('clustertools.cluster2local')
+
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect('127.0.0.1', port=case['port'], username='bench', password='bench',
+                look_for_keys=False, allow_agent=False)
+    scp = SCPClient(ssh.get_transport(), progress=progress)
+    options = case['options']
+    filename = SINGLE_FILE.get(case['workload'])
+    rss_before = max_rss_mb()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.time()
+        if case['direction'] == 'upload':
+            if filename:
+                local2cluster.upload_file(ssh, scp, case['source'], case['dest'], filename,
+                                          backend=options['backend'], stripes=options['stripes'])
+            else:
+                local2cluster.upload_folder(ssh, scp, case['source'], case['dest'],
+                                            workers=options['workers'], backend=options['backend'],
+                                            compression=options['compression'])
+        else:
+            if filename:
+                cluster2local.download_file(scp, case['dest'], case['source'], filename, ssh=ssh,
+                                            backend=options['backend'], stripes=options['stripes'])
+            else:
+                cluster2local.download_folder(ssh, scp, case['dest'], case['source'], backend=options['backend'],
+                                              shards=options['shards'], compression=options['compression'])
+        end = time.time()
+
+    ssh.close()
+    return {'start': start, 'end': end, 'rss_before_mb': rss_before, 'peak_rss_mb': max_rss_mb()}
+
+def split_phases(recorder, direction, start, end):
+    """Split [start, end] into archive/transfer/extract from when bulk data moved."""
+    events = recorder.window('up' if direction == 'upload' else 'down', start, end)
+    total = sum(n for _, n in events)
+    if not events:
+        return None, 0
+    threshold = min(BULK_THRESHOLD, total / 2)
+    moved = 0
+    first = events[0][0]
+    for t, n in events:
+        moved += n
+        if moved >= threshold:
+            first = t
+            break
+    last = events[-1][0]
+    wire_bytes = total + sum(n for _, n in recorder.window('down' if direction == 'upload' else 'up', start, end))
+    return {'archive': first - start, 'transfer': last - first, 'extract': end - last}, wire_bytes
+
+def tree_stats(path):
+    """Return (file_count, total_bytes) of a local directory or file."""
+    if os.path.isfile(path):
+        return 1, os.path.getsize(path)
+    count = size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            count += 1
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return count, size
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmarks(args):
+    rate = args.bandwidth * 125000 if args.bandwidth else None
+    server = BenchmarkServer(args.rtt / 1000, rate).start()
+    workdir = tempfile.mkdtemp(prefix='clustertools-bench-', dir=args.workdir)
+    options = {'workers': args.workers, 'backend': args.backend, 'stripes': args.stripes, 'shards': args.shards,
+               'compression': args.compression}
+    results = []
+
+    try:
+        for workload in args.workloads:
+            print(f"{YELLOW}Generating {workload} workload...{RESET}")
+            source, file_count, total_bytes = generate(workload, os.path.join(workdir, 'data'), args.scale)
+            filename = SINGLE_FILE.get(workload)
+
+            for direction in args.directions:
+                if direction == 'upload':
+                    case_source = source
+                    dest_root = os.path.join(workdir, 'remote')
+                    dest = os.path.join(dest_root, filename or workload)
+                else:
+                    # Serve the workload from a separate "remote" copy
+                    case_source = os.path.join(workdir, 'remote-source', workload)
+                    if not os.path.exists(case_source):
+                        shutil.copytree(source, case_source)
+                    dest_root = os.path.join(workdir, 'local')
+                    dest = os.path.join(dest_root, filename or workload)
+
+                runs = []
+                for repeat in range(args.repeat):
+                    shutil.rmtree(dest_root, ignore_errors=True)
+                    os.makedirs(dest_root)
+                    server.recorder.reset()
+                    case = {'port': server.port, 'workload': workload, 'direction': direction,
+                            'source': case_source, 'dest': dest_root, 'options': options}
+                    child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(case)],
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+                    if child.returncode != 0:
+                        print(f"{RED}{workload} {direction} failed:\n{child.stderr}{RESET}")
+                        break
+                    timing = json.loads(child.stdout.strip().splitlines()[-1])
+                    phases, wire_bytes = split_phases(server.recorder, direction, timing['start'], timing['end'])
+                    seconds = timing['end'] - timing['start']
+                    verified = tree_stats(dest) == (file_count, total_bytes)
+                    runs.append({
+                        'seconds': seconds,
+                        'files_per_s': file_count / seconds if seconds > 0 else 0,
+                        'mb_per_s': total_bytes / seconds / (1024 * 1024) if seconds > 0 else 0,
+                        'phases': phases,
+                        'wire_bytes': wire_bytes,
+                        'rss_before_mb': timing['rss_before_mb'],
+                        'peak_rss_mb': timing['peak_rss_mb'],
+                        'verified': verified,
+                    })
+
+                if not runs:
+                    continue
+                # Report the median run; every run stays in the JSON output
+                median = sorted(runs, key=lambda run: run['seconds'])[len(runs) // 2]
+                result = {'workload': workload, 'direction': direction, 'files': file_count, 'bytes': total_bytes}
+                result.update(median)
+                result['runs'] = [run['seconds'] for run in runs]
+                results.append(result)
+                print_result(result)
+    finally:
+        server.close()
+        if args.keep:
+            print(f"Benchmark data kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+def print_result(result):
+    phases = result['phases']
+    phase_str = (f"archive {phases['archive']:.2f}s / transfer {phases['transfer']:.2f}s / extract {phases['extract']:.2f}s"
+                 if phases else "no bulk data seen")
+    status = f"{GREEN}ok{RESET}" if result['verified'] else f"{RED}MISMATCH{RESET}"
+    print(f"{result['workload']:>10} {result['direction']:>8}: {result['seconds']:7.2f}s "
+          f"{result['files_per_s']:9.1f} files/s {result['mb_per_s']:8.2f} MB/s  "
+          f"peak {result['peak_rss_mb']:.0f} MB  ({phase_str}) {status}")
+
+def compare_with_baseline(results, settings, baseline_path, tolerance):
+    """Print cases that got slower or hungrier than the baseline; return how many did."""
+    with open(baseline_path) as f:
+        data = json.load(f)
+    if data.get('settings') != settings:
+        print(f"{YELLOW}Warning: {baseline_path} was recorded with different settings: {data.get('settings')}{RESET}")
+    baseline = {(r['workload'], r['direction']): r for r in data['results']}
+
+    regressions = 0
+    for result in results:
+        old = baseline.get((result['workload'], result['direction']))
+        if old is None:
+            continue
+        name = f"{result['workload']} {result['direction']}"
+        if result['mb_per_s'] < old['mb_per_s'] * (1 - tolerance):
+            regressions += 1
+            print(f"{RED}Regression: {name} throughput {old['mb_per_s']:.2f} -> {result['mb_per_s']:.2f} MB/s{RESET}")
+        if result['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+            regressions += 1
+            print(f"{RED}Regression: {name} peak memory {old['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB{RESET}")
+    if not regressions:
+        print(f"{GREEN}No regressions against {baseline_path} (tolerance {tolerance:.0%}){RESET}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark clustertools transfers against a local SSH server')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help=f"Comma-separated workloads (default: {','.join(WORKLOADS)})")
+    parser.add_argument('--directions', default=','.join(DIRECTIONS), help='Comma-separated directions (default: upload,download)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply workload file counts and sizes (default: 1.0)')
+    parser.add_argument('--rtt', type=float, default=0, help='Added round-trip time in milliseconds (default: 0)')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Bandwidth cap per direction in Mbit/s (default: none)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case; the median is reported (default: 1)')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Parallel channels for folder uploads (default: 1)')
+    parser.add_argument('--backend', default='auto', help='Transfer backend (default: auto)')
+    parser.add_argument('--stripes', type=int, default=1, help='Stripes for the huge single-file workload (default: 1)')
+    parser.add_argument('--shards', type=int, default=1, help='Compressed shards for folder downloads (default: 1)')
+    parser.add_argument('--compression', default='auto', help='Codec for folder tar streams (default: auto)')
+    parser.add_argument('--json', help='Write machine-readable results to this file')
+    parser.add_argument('--baseline', help='Earlier --json output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='Relative slowdown or memory growth counted as a regression (default: 0.15)')
+    parser.add_argument('--workdir', default=None, help='Directory for generated data (default: system temp)')
+    parser.add_argument('--keep', action='store_true', help='Keep generated data and transfer results')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(json.loads(args.child))))
+        return
+
+    args.workloads = [w for w in args.workloads.split(',') if w]
+    args.directions = [d for d in args.directions.split(',') if d]
+    for workload in args.workloads:
+        if workload not in WORKLOADS:
+            parser.error(f"unknown workload {workload!r}")
+    for direction in args.directions:
+        if direction not in DIRECTIONS:
+            parser.error(f"unknown direction {direction!r}")
+
+    results = run_benchmarks(args)
+    settings = {'scale': args.scale, 'rtt_ms': args.rtt, 'bandwidth_mbit': args.bandwidth,
+                'repeat': args.repeat, 'workers': args.workers, 'backend': args.backend,
+                'stripes': args.stripes, 'shards': args.shards, 'compression': args.compression}
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'python': sys.version.split()[0],
+                'settings': settings,
+                'results': results,
+            }, f, indent=2)
+        print(f"Results written to {args.json}")
+
+    failed = any(not result['verified'] for result in results)
+    if args.baseline and compare_with_baseline(results, settings, args.baseline, args.tolerance):
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""Local SSH stand-in server for the benchmarks.
+
+Serves exec requests through bash and the SFTP subsystem on the local
+filesystem, accepting any username and password. Every connection passes
+through a shaping layer that can add latency and cap bandwidth in each
+direction, and that records when bytes moved so benchmark runs can be
+split into phases.
+"""
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK
+
+RELAY_CHUNK = 64 * 1024
+
+class Handle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+class LocalSFTP(paramiko.SFTPServerInterface):
+    """SFTP on the local filesystem with absolute paths, like a login node would see them."""
+
+    def _realpath(self, path):
+        return path
+
+    def list_folder(self, path):
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            mode = getattr(attr, 'st_mode', None)
+            fd = os.open(path, flags, mode if mode is not None else 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if (flags & os.O_CREAT) and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, fstr)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(oldpath, newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.replace(oldpath, newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(path)
+            if attr is not None:
+                SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+class AcceptAll(paramiko.ServerInterface):
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_exec, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+def run_exec(channel, command):
+    """Run command through bash, wiring the channel to its stdin, stdout and stderr."""
+    proc = subprocess.Popen(['bash', '-c', command], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def feed_stdin():
+        try:
+            while True:
+                data = channel.recv(RELAY_CHUNK)
+                if not data:
+                    break
+                proc.stdin.write(data)
+                proc.stdin.flush()
+        except Exception:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except Exception:
+                pass
+
+    def drain_stderr():
+        for chunk in iter(lambda: proc.stderr.read1(RELAY_CHUNK), b''):
+            channel.sendall_stderr(chunk)
+
+    threading.Thread(target=feed_stdin, daemon=True).start()
+    stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+    stderr_thread.start()
+    try:
+        for chunk in iter(lambda: proc.stdout.read1(RELAY_CHUNK), b''):
+            channel.sendall(chunk)
+        stderr_thread.join()
+        channel.send_exit_status(proc.wait())
+        channel.shutdown_write()
+        channel.close()
+    except Exception:
+        # Client went away mid-command
+        proc.kill()
+
+class WireRecorder:
+    """Timestamps of data moving through the shaping layer, per direction."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = {'up': [], 'down': []}
+
+    def record(self, direction, n):
+        with self._lock:
+            self.events[direction].append((time.time(), n))
+
+    def reset(self):
+        with self._lock:
+            self.events = {'up': [], 'down': []}
+
+    def window(self, direction, start, end):
+        """Return the (time, bytes) events of one direction between start and end."""
+        with self._lock:
+            return [(t, n) for t, n in self.events[direction] if start <= t <= end]
+
+class ShapedPipe:
+    """Copy bytes from src to dst, delayed by delay seconds and capped at rate bytes/s."""
+
+    def __init__(self, src, dst, delay, rate, recorder, direction):
+        self.src = src
+        self.dst = dst
+        self.delay = delay
+        self.rate = rate
+        self.recorder = recorder
+        self.direction = direction
+        # Bounded so a bandwidth cap pushes back on the sender like a real link
+        self.queue = queue.Queue(maxsize=256)
+        self.next_free = 0.0
+
+    def start(self):
+        threading.Thread(target=self._read, daemon=True).start()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def _read(self):
+        try:
+            while True:
+                data = self.src.recv(RELAY_CHUNK)
+                if not data:
+                    break
+                self.queue.put((time.time(), data))
+        except OSError:
+            pass
+        self.queue.put(None)
+
+    def _write(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                received, data = item
+                send_at = received + self.delay
+                if self.rate:
+                    send_at = max(send_at, self.next_free)
+                    self.next_free = max(send_at, time.time()) + len(data) / self.rate
+                wait = send_at - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self.dst.sendall(data)
+                self.recorder.record(self.direction, len(data))
+        except OSError:
+            pass
+        finally:
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+class BenchmarkServer:
+    """Threaded SSH server on 127.0.0.1 with optional latency and bandwidth shaping.
+
+    rtt is the added round-trip time in seconds, split evenly between the
+    two directions; bandwidth caps each direction in bytes per second.
+    """
+
+    def __init__(self, rtt=0.0, bandwidth=None, port=0):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.recorder = WireRecorder()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        self.sock.listen(64)
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        outer, inner = socket.socketpair()
+        ShapedPipe(conn, outer, self.rtt / 2, self.bandwidth, self.recorder, 'up').start()
+        ShapedPipe(outer, conn, self.rtt / 2, self.bandwidth, self.recorder, 'down').start()
+
+        transport = paramiko.Transport(inner)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTP)
+        transport.start_server(server=AcceptAll())
+        while transport.is_active():
+            transport.join(1)
+
+    def close(self):
+        self.sock.close()
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the benchmark SSH server on its own')
+    parser.add_argument('--port', type=int, default=2222, help='Port to listen on (default: 2222)')
+    parser.add_argument('--rtt', type=float, default=0, help='Added round-trip time in milliseconds')
+    parser.add_argument('--bandwidth', type=float, default=None, help='Bandwidth cap per direction in Mbit/s')
+    args = parser.parse_args()
+
+    server = BenchmarkServer(args.rtt / 1000, args.bandwidth * 125000 if args.bandwidth else None, args.port).start()
+    print(f"Listening on 127.0.0.1:{server.port}")
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,90 @@
+"""Standard benchmark workloads, generated deterministically from a fixed seed.
+
+Each workload is a directory of files; `huge` is transferred as a single
+file, the others as folders. scale multiplies file counts and sizes so the
+same shapes can be run quickly or at full size.
+"""
+import os
+import random
+
+KIB = 1024
+MIB = 1024 * 1024
+
+WORKLOADS = ['tiny', 'mixed', 'huge', 'compressed']
+
+# Workloads moved with upload_file/download_file rather than the folder paths
+SINGLE_FILE = {'huge': 'huge.bin'}
+
+WORDS = (b"the of and to in is for on that by with as from at voxel subject session run "
+         b"mean std fmri bold mask model fit error trial cluster node job queue data").split()
+
+def text_block(rng, size):
+    """Return size bytes of word-like text, which compresses about as well as logs or CSVs."""
+    out = bytearray()
+    while len(out) < size:
+        out += rng.choice(WORDS) + (b'\n' if rng.random() < 0.1 else b' ')
+    return bytes(out[:size])
+
+class ContentSource:
+    """Slices of a pregenerated pool, so large workloads are quick to write."""
+
+    def __init__(self, rng, compressible):
+        self.rng = rng
+        if compressible:
+            self.pool = text_block(rng, 4 * MIB)
+        else:
+            self.pool = rng.getrandbits(4 * MIB * 8).to_bytes(4 * MIB, 'little')
+
+    def write(self, path, size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                start = self.rng.randrange(0, len(self.pool) // 2)
+                chunk = self.pool[start:start + min(remaining, len(self.pool) - start)]
+                f.write(chunk)
+                remaining -= len(chunk)
+
+def generate(name, root, scale=1.0, seed=0):
+    """Create workload name under root and return (path, file_count, total_bytes)."""
+    rng = random.Random(f"{name}-{seed}")
+    path = os.path.join(root, name)
+    files = []
+
+    if name == 'tiny':
+        # Many small source-code-sized files spread over a few directories
+        source = ContentSource(rng, compressible=True)
+        for i in range(max(1, int(2000 * scale))):
+            files.append((os.path.join(path, f"dir{i % 20:02d}", f"file{i:05d}.txt"), rng.randint(200, 4 * KIB), source))
+    elif name == 'mixed':
+        # Mostly small files, some medium ones and a few large ones, like an analysis tree
+        text = ContentSource(rng, compressible=True)
+        binary = ContentSource(rng, compressible=False)
+        for i in range(max(1, int(400 * scale))):
+            roll = rng.random()
+            if roll < 0.70:
+                size, source = rng.randint(KIB, 64 * KIB), text
+            elif roll < 0.95:
+                size, source = rng.randint(64 * KIB, 2 * MIB), text if rng.random() < 0.5 else binary
+            else:
+                size, source = rng.randint(4 * MIB, 16 * MIB), binary
+            depth = rng.randint(0, 3)
+            subdir = os.path.join(*[f"level{d}_{rng.randint(0, 4)}" for d in range(depth)]) if depth else ''
+            files.append((os.path.join(path, subdir, f"item{i:04d}.dat"), size, source))
+    elif name == 'huge':
+        source = ContentSource(rng, compressible=False)
+        files.append((os.path.join(path, SINGLE_FILE['huge']), max(MIB, int(256 * MIB * scale)), source))
+    elif name == 'compressed':
+        # Already-compressed data, where gzip on the wire only costs CPU
+        source = ContentSource(rng, compressible=False)
+        for i in range(max(1, int(40 * scale))):
+            files.append((os.path.join(path, f"archive{i:03d}.gz"), rng.randint(1 * MIB, 4 * MIB), source))
+    else:
+        raise ValueError(f"Unknown workload {name!r}, expected one of {', '.join(WORKLOADS)}")
+
+    for file_path, size, source in files:
+        source.write(file_path, size)
+    # Fixed mtimes keep runs comparable for sync-style options
+    for file_path, size, source in files:
+        os.utime(file_path, (1700000000, 1700000000))
+    return path, len(files), sum(size for _, size, _ in files)
@@ -1,8 +1,14 @@
 from .local2cluster import local2cluster
 from .cluster2local import cluster2local
+from .cluster2cluster import cluster2cluster
+from .aio import alocal2cluster, acluster2local, transfer_many
 __version__ = '0.1.0'
 
 __all__ = [
     'local2cluster',
-    'cluster2local'
+    'cluster2local',
+    'cluster2cluster',
+    'alocal2cluster',
+    'acluster2local',
+    'transfer_many'
 ] 
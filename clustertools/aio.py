@@ -0,0 +1,168 @@
+"""asyncio front end for local2cluster and cluster2local.
+
+Every transfer runs the blocking implementation on a thread of its own, so
+transfers to one or several hosts run side by side while the event loop
+does other work. A TransferLimiter caps how many run at once, in total and
+per host; connections are shared per host (see clustertools.connection).
+
+    await alocal2cluster('results', '/scratch/me', hostname='cluster-a')
+    await transfer_many([
+        {'direction': 'upload', 'localDIR': 'run1', 'clusterDIR': '/scratch/me', 'hostname': 'cluster-a'},
+        {'direction': 'download', 'localDIR': '.', 'clusterDIR': '/scratch/me/out', 'hostname': 'cluster-b'},
+    ], concurrency=4)
+
+Cancelling the awaiting task stops the transfer at its next progress
+update. The task only finishes once the transfer has cleaned up: remote
+temporary archives are deleted and a file cut off mid-way is removed,
+except the partial files kept on purpose by resume=True.
+"""
+import asyncio
+import threading
+import weakref
+
+from clustertools.local2cluster import local2cluster
+from clustertools.cluster2local import cluster2local
+from clustertools.metrics import TransferCancelled, cancel_scope
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+DEFAULT_CONCURRENCY = 4
+
+DIRECTIONS = {'upload': local2cluster, 'download': cluster2local}
+
+class TransferLimiter:
+    """Caps the transfers running at once: limit in total, per_host for each host.
+
+    Either may be None for no cap. One limiter can be shared by transfers
+    on any number of event loops.
+    """
+
+    def __init__(self, limit=DEFAULT_CONCURRENCY, per_host=None):
+        self.limit = limit
+        self.per_host = per_host
+        # Semaphores belong to one event loop
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphores_for(self, hostname):
+        loop = asyncio.get_event_loop()
+        if loop not in self._semaphores:
+            total = asyncio.Semaphore(self.limit) if self.limit else None
+            self._semaphores[loop] = (total, {})
+        total, hosts = self._semaphores[loop]
+        semaphores = [total] if total is not None else []
+        if self.per_host:
+            if hostname not in hosts:
+                hosts[hostname] = asyncio.Semaphore(self.per_host)
+            # Host first, so a transfer waiting for its host holds no global slot
+            semaphores.insert(0, hosts[hostname])
+        return semaphores
+
+    async def acquire(self, hostname):
+        acquired = []
+        try:
+            for semaphore in self._semaphores_for(hostname):
+                await semaphore.acquire()
+                acquired.append(semaphore)
+        except BaseException:
+            for semaphore in acquired:
+                semaphore.release()
+            raise
+        return acquired
+
+    @staticmethod
+    def release(acquired):
+        for semaphore in reversed(acquired):
+            semaphore.release()
+
+default_limiter = TransferLimiter()
+
+def set_concurrency(limit=DEFAULT_CONCURRENCY, per_host=None):
+    """Set the limits of transfers that aren't given a limiter of their own."""
+    global default_limiter
+    default_limiter = TransferLimiter(limit, per_host)
+
+def run_in_thread(function):
+    """Run function() on a new daemon thread and return an asyncio future of its result."""
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def settle(method, value):
+        if not future.done():
+            method(value)
+
+    def run():
+        try:
+            result = function()
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(settle, future.set_result, result)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+async def run_transfer(function, args, kwargs, hostname=None, limiter=None):
+    """Run a blocking transfer function on its own thread within the limits of limiter."""
+    limiter = limiter or default_limiter
+    acquired = await limiter.acquire(hostname)
+    try:
+        cancel = threading.Event()
+
+        def call():
+            with cancel_scope(cancel):
+                return function(*args, **kwargs)
+
+        future = run_in_thread(call)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancel.set()
+            # Wait for the transfer to unwind so its cleanup is done when the task ends
+            try:
+                await future
+            except (Exception, TransferCancelled):
+                pass
+            raise
+    finally:
+        limiter.release(acquired)
+
+async def alocal2cluster(localDIR, clusterDIR, filename=None, limiter=None, **options):
+    """Awaitable local2cluster; options are its keyword arguments (hostname, workers, sync, ...)."""
+    return await run_transfer(local2cluster, (localDIR, clusterDIR, filename), options,
+                              options.get('hostname', 'sftp.fmrib.ox.ac.uk'), limiter)
+
+async def acluster2local(localDIR, clusterDIR, filename=None, limiter=None, **options):
+    """Awaitable cluster2local; options are its keyword arguments (hostname, shards, sync, ...)."""
+    return await run_transfer(cluster2local, (localDIR, clusterDIR, filename), options,
+                              options.get('hostname'), limiter)
+
+async def transfer_many(transfers, concurrency=None, per_host=None, return_exceptions=False):
+    """Run many transfers concurrently and return their results in order.
+
+    Each transfer is a dict with 'direction' ('upload' or 'download') and
+    the keyword arguments of local2cluster or cluster2local. concurrency and
+    per_host cap this batch on its own; without them the default limiter
+    applies. With return_exceptions=True a failed transfer gives its
+    exception in place of a result instead of cancelling the others.
+    """
+    limiter = TransferLimiter(concurrency, per_host) if concurrency or per_host else None
+    tasks = []
+    for transfer in transfers:
+        options = dict(transfer)
+        direction = options.pop('direction')
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Unknown direction {direction!r}, expected one of {', '.join(DIRECTIONS)}")
+        start = alocal2cluster if direction == 'upload' else acluster2local
+        tasks.append(asyncio.ensure_future(start(limiter=limiter, **options)))
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    except BaseException:
+        # One failure (or cancelling the batch) stops the transfers still running
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,354 @@
+"""Run a manifest of upload and download jobs over one set of connections.
+
+A manifest is YAML (needs PyYAML) or JSON lines. In YAML, jobs are a list,
+optionally under `jobs:` next to `defaults:` applied to every job:
+
+    defaults:
+      host: clint.fmrib.ox.ac.uk
+    jobs:
+      - {direction: upload, local: /data/run1, remote: /scratch/me, priority: 10, workers: 4}
+      - {direction: download, local: ./results, remote: /scratch/me/out, filename: summary.csv}
+
+In JSON lines every line is one job. local, remote and filename mean the
+same as -l, -c and -f of local2cluster and cluster2local; host, priority
+(higher runs first, default 0) and retries are read by the scheduler, and
+any other key is passed on as a keyword argument (workers, sync, verify,
+shards...).
+
+Jobs run concurrently, highest priority first and largest first within a
+priority, so big transfers start early and small ones fill in around
+them. Small single files going between the same two directories are
+grouped into one tar stream. A failed job is retried on its own.
+"""
+import asyncio
+import inspect
+import itertools
+import json
+import os
+import shlex
+import tarfile
+import threading
+import time
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from clustertools.aio import DEFAULT_CONCURRENCY, TransferLimiter, run_transfer
+from clustertools.connection import get_ssh_connection
+from clustertools.local2cluster import SMALL_FILE_THRESHOLD, ensure_remote_dirs, local2cluster, upload_file_list
+from clustertools.cluster2local import cluster2local, extract_member, send_file_list
+from clustertools.metrics import TransferMetrics, measure_rtt
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+DIRECTIONS = {'upload': local2cluster, 'download': cluster2local}
+DEFAULT_HOSTS = {'upload': 'sftp.fmrib.ox.ac.uk', 'download': 'clint.fmrib.ox.ac.uk'}
+
+# Attempts after the first one, and the pause before each
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 5
+
+# Manifest keys read by the scheduler rather than passed to the transfer
+JOB_KEYS = {'direction', 'local', 'remote', 'filename', 'host', 'priority', 'retries'}
+
+class Job:
+    """One manifest entry and its outcome."""
+
+    def __init__(self, index, direction, local, remote, filename=None, host=None, priority=0,
+                 retries=DEFAULT_RETRIES, options=None):
+        self.index = index
+        self.direction = direction
+        self.local = local
+        self.remote = remote
+        self.filename = filename
+        self.host = host or DEFAULT_HOSTS[direction]
+        self.priority = priority
+        self.retries = retries
+        self.options = options or {}
+        self.size = 0
+        self.attempts = 0
+        self.seconds = 0.0
+        # Bytes per second of the unit the job last ran in
+        self.rate = 0.0
+        self.error = None
+        self.ok = None
+        self.grouped = 0
+
+    @property
+    def local_path(self):
+        return os.path.join(self.local, self.filename) if self.filename else self.local
+
+    @property
+    def remote_path(self):
+        return os.path.join(self.remote, self.filename) if self.filename else self.remote
+
+    def describe(self):
+        if self.direction == 'upload':
+            return f"upload {self.local_path} -> {self.remote}"
+        return f"download {self.remote_path} -> {self.local}"
+
+def parse_job(index, entry, defaults):
+    """Build a Job from a manifest entry, checking its keys against the transfer function."""
+    entry = dict(defaults, **entry)
+    direction = entry.get('direction')
+    if direction not in DIRECTIONS:
+        raise ValueError(f"Job {index}: direction must be one of {', '.join(DIRECTIONS)}, got {direction!r}")
+    for key in ('local', 'remote'):
+        if not entry.get(key):
+            raise ValueError(f"Job {index}: missing {key!r}")
+    options = {key: value for key, value in entry.items() if key not in JOB_KEYS}
+    accepted = set(inspect.signature(DIRECTIONS[direction]).parameters)
+    accepted -= {'localDIR', 'clusterDIR', 'filename', 'username', 'password', 'hostname'}
+    unknown = sorted(set(options) - accepted)
+    if unknown:
+        raise ValueError(f"Job {index}: unknown option(s) {', '.join(unknown)} for {direction}")
+    return Job(index, direction, entry['local'], entry['remote'], entry.get('filename'), entry.get('host'),
+               int(entry.get('priority', 0)), int(entry.get('retries', DEFAULT_RETRIES)), options)
+
+def load_manifest(path):
+    """Read a .yaml/.yml or .jsonl manifest and return its jobs."""
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError("YAML manifests need the PyYAML package (pip install pyyaml); JSON lines work without it")
+            data = yaml.safe_load(f) or []
+        else:
+            data = [json.loads(line) for line in f if line.strip()]
+    defaults = {}
+    if isinstance(data, dict):
+        defaults = data.get('defaults') or {}
+        data = data.get('jobs') or []
+    return [parse_job(index, entry, defaults) for index, entry in enumerate(data, 1)]
+
+def local_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, dirnames, filenames in os.walk(path) for name in filenames)
+
+def remote_sizes(ssh, paths):
+    """Return {path: bytes} of remote files or folders with one batched `du`; unreadable paths are left out."""
+    channel = ssh.get_transport().open_session()
+    channel.exec_command("xargs -0 -r du -0 -sb --")
+    threading.Thread(target=send_file_list, args=(channel, paths), daemon=True).start()
+    try:
+        output = channel.makefile('rb').read()
+        channel.recv_exit_status()
+    finally:
+        channel.close()
+    sizes = {}
+    for line in output.split(b'\0'):
+        size, _, path = line.partition(b'\t')
+        if size.isdigit():
+            sizes[path.decode('utf-8', 'surrogateescape')] = int(size)
+    return sizes
+
+def measure_jobs(jobs, connect):
+    """Fill in the size of every job: local ones from disk, remote ones with one `du` per host."""
+    for job in jobs:
+        if job.direction == 'upload':
+            try:
+                job.size = local_size(job.local_path)
+            except OSError:
+                job.size = 0
+    downloads = [job for job in jobs if job.direction == 'download']
+    for host in sorted(set(job.host for job in downloads)):
+        ssh, scp = connect(host)
+        host_jobs = [job for job in downloads if job.host == host]
+        sizes = remote_sizes(ssh, sorted(set(job.remote_path for job in host_jobs)))
+        for job in host_jobs:
+            job.size = sizes.get(job.remote_path, 0)
+
+def plan_units(jobs, small_file_threshold=SMALL_FILE_THRESHOLD):
+    """Group small single-file jobs and return the units of work, in manifest order.
+
+    Single files below small_file_threshold with no options of their own,
+    going between the same two directories at the same priority, become one
+    unit; every other job is a unit by itself. run_jobs queues them by
+    priority, then by size, largest first.
+    """
+    units = []
+    groups = {}
+    for job in jobs:
+        if job.filename and job.size < small_file_threshold and not job.options:
+            key = (job.direction, job.host, job.local, job.remote, job.priority)
+            if key not in groups:
+                groups[key] = []
+                units.append(groups[key])
+            groups[key].append(job)
+        else:
+            units.append([job])
+    return units
+
+def upload_group(ssh, jobs, small_file_threshold=SMALL_FILE_THRESHOLD):
+    """Send small single-file uploads to one remote directory as a single tar stream.
+
+    small_file_threshold is the one the jobs were grouped with, so every
+    file is packed.
+    """
+    remote = jobs[0].remote
+    file_list = [(job.local_path, os.path.dirname(job.remote_path), job.remote_path, job.size) for job in jobs]
+    ensure_remote_dirs(ssh, set(item[1] for item in file_list))
+    progress = TransferMetrics('Uploading', sum(job.size for job in jobs), len(jobs),
+                               name=os.path.basename(remote.rstrip('/')), direction='upload')
+    progress.record_rtt(measure_rtt(ssh))
+    progress.phase('transfer')
+    failed = upload_file_list(ssh, file_list, remote, progress, small_file_threshold=small_file_threshold)
+    progress.finish()
+    if failed:
+        raise Exception(f"{failed} of {len(jobs)} grouped files failed to upload")
+
+def download_group(ssh, jobs):
+    """Receive small single-file downloads from one remote directory as a single tar stream."""
+    local, remote = jobs[0].local, jobs[0].remote
+    metrics = TransferMetrics('Downloading', sum(job.size for job in jobs), len(jobs),
+                              name=os.path.basename(remote.rstrip('/')), direction='download')
+    metrics.record_rtt(measure_rtt(ssh))
+    metrics.phase('transfer')
+    os.makedirs(local, exist_ok=True)
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(f"tar -cf - -C {shlex.quote(remote)} --null -T -")
+    threading.Thread(target=send_file_list, daemon=True,
+                     args=(channel, [job.filename for job in jobs])).start()
+    try:
+        with tarfile.open(fileobj=channel.makefile('rb'), mode='r|') as tar:
+            for member in tar:
+                extract_member(tar, member, local)
+                tar.members = []
+                if member.isfile():
+                    metrics.add_bytes(member.size)
+                    metrics.file_done(member.name, member.size)
+        exit_status = channel.recv_exit_status()
+        if exit_status != 0:
+            error = channel.makefile_stderr('rb').read().decode()
+            raise Exception(f"Remote tar failed: {error.strip()}")
+    finally:
+        channel.close()
+        metrics.finish()
+
+def run_unit(unit, username=None, password=None, small_file_threshold=SMALL_FILE_THRESHOLD):
+    """Run one unit of work on the calling thread; returns False if a job reported failure."""
+    job = unit[0]
+    if len(unit) > 1:
+        ssh, _ = get_ssh_connection(username, password, job.host)
+        if job.direction == 'upload':
+            upload_group(ssh, unit, small_file_threshold)
+        else:
+            download_group(ssh, unit)
+        return True
+    result = DIRECTIONS[job.direction](job.local, job.remote, job.filename, username=username, password=password,
+                                       hostname=job.host, **job.options)
+    return result is not False
+
+async def run_jobs(jobs, concurrency=DEFAULT_CONCURRENCY, per_host=None, username=None, password=None,
+                   small_file_threshold=SMALL_FILE_THRESHOLD):
+    """Run jobs concurrently with retries, filling in their outcome; returns the jobs."""
+    queue = asyncio.PriorityQueue()
+    order = itertools.count()
+    loop = asyncio.get_event_loop()
+    limiter = TransferLimiter(None, per_host)
+
+    def enqueue(unit):
+        queue.put_nowait(((-unit[0].priority, -sum(job.size for job in unit), next(order)), unit))
+
+    for unit in plan_units(jobs, small_file_threshold):
+        enqueue(unit)
+
+    def requeue(unit):
+        enqueue(unit)
+        queue.task_done()
+
+    async def worker():
+        while True:
+            _, unit = await queue.get()
+            for job in unit:
+                job.attempts += 1
+                job.grouped = len(unit) if len(unit) > 1 else 0
+            label = unit[0].describe() if len(unit) == 1 else f"{len(unit)} grouped files ({unit[0].describe()})"
+            print(f"{YELLOW}Starting {label}{RESET}")
+            start = time.time()
+            try:
+                ok = await run_transfer(run_unit, (unit, username, password, small_file_threshold), {}, unit[0].host, limiter)
+                error = None if ok else "transfer reported a failure"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                ok, error = False, str(e) or type(e).__name__
+            elapsed = time.time() - start
+            rate = sum(job.size for job in unit) / elapsed if elapsed > 0 else 0
+            for job in unit:
+                job.seconds, job.rate, job.ok, job.error = elapsed, rate, ok, error
+
+            if ok:
+                queue.task_done()
+            elif len(unit) > 1:
+                # Retry grouped files one by one, so one bad file doesn't sink the rest
+                print(f"{YELLOW}Group failed ({error}), retrying its {len(unit)} files separately{RESET}")
+                for job in unit:
+                    enqueue([job])
+                queue.task_done()
+            elif unit[0].attempts <= unit[0].retries:
+                print(f"{YELLOW}{label} failed ({error}), retrying in {RETRY_DELAY}s "
+                      f"({unit[0].attempts}/{unit[0].retries}){RESET}")
+                loop.call_later(RETRY_DELAY, requeue, unit)
+            else:
+                print(f"{RED}{label} failed: {error}{RESET}")
+                queue.task_done()
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency))]
+    try:
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return jobs
+
+def print_summary(jobs, elapsed):
+    print("\nBatch summary:")
+    for job in sorted(jobs, key=lambda job: job.index):
+        status = f"{GREEN}ok    {RESET}" if job.ok else f"{RED}failed{RESET}"
+        speed = job.rate / (1024*1024)
+        attempts = f"{job.attempts} attempt{'s' if job.attempts != 1 else ''}"
+        # Grouped jobs share the time and throughput of their group
+        grouped = f", grouped with {job.grouped - 1} others" if job.grouped else ""
+        print(f"  {status} {job.describe()}: {round(job.size/(1024*1024), 2)} MB in {job.seconds:.1f}s "
+              f"({speed:.2f} MB/s, {attempts}{grouped})")
+        if not job.ok and job.error:
+            print(f"         {RED}{job.error}{RESET}")
+    total = sum(job.size for job in jobs if job.ok)
+    failed = sum(1 for job in jobs if not job.ok)
+    speed = total / elapsed / (1024*1024) if elapsed > 0 else 0
+    color = RED if failed else GREEN
+    print(f"{color}{len(jobs) - failed} of {len(jobs)} jobs succeeded: {round(total/(1024*1024), 2)} MB "
+          f"in {elapsed:.1f}s ({speed:.2f} MB/s){RESET}")
+
+def run_batch(manifest, concurrency=DEFAULT_CONCURRENCY, per_host=None, username=None, password=None,
+              small_file_threshold=SMALL_FILE_THRESHOLD):
+    """Run every job of a manifest file and print the summary; returns True if all succeeded."""
+    jobs = load_manifest(manifest)
+    if not jobs:
+        print(f"{YELLOW}Manifest {manifest} has no jobs.{RESET}")
+        return True
+
+    # Log in to every host up front, so prompts don't interleave with running jobs
+    for host in sorted(set(job.host for job in jobs)):
+        get_ssh_connection(username, password, host)
+    measure_jobs(jobs, lambda host: get_ssh_connection(username, password, host))
+    print(f"{YELLOW}Running {len(jobs)} jobs ({round(sum(job.size for job in jobs)/(1024*1024), 2)} MB) "
+          f"on {len(set(job.host for job in jobs))} host(s), {concurrency} at a time{RESET}")
+
+    start = time.time()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run_jobs(jobs, concurrency, per_host, username, password, small_file_threshold))
+    finally:
+        loop.close()
+    print_summary(jobs, time.time() - start)
+    return all(job.ok for job in jobs)
@@ -0,0 +1,557 @@
+"""Local connection broker that keeps an authenticated SSH session alive.
+
+`clustertools-broker start --host HOST` authenticates once (password + 2FA),
+then keeps running in the background and serves channels on that session to
+later `local2cluster`/`cluster2local` invocations over a Unix socket, much
+like OpenSSH's ControlMaster. Every channel request is multiplexed onto the
+broker's paramiko transport, so no further handshakes or 2FA prompts are
+needed until the broker exits.
+
+Wire protocol on the Unix socket: frames of a one-byte type, a four-byte
+big-endian length and a payload. A client opens a socket per channel and
+sends an 'R' frame with a JSON request; the broker answers with an 'R' frame
+and then relays 'D' (stdin/stdout data), 'E' (stderr data), 'W' (end of
+stdin), 'Q'/'q' (end of stdout/stderr) and 'X' (exit status) frames.
+A client stops reading the socket while it holds PIPE_LIMIT unread bytes
+of a stream, so a slow consumer backs up through the socket into the
+broker and the SSH channel window instead of filling memory.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+import paramiko
+from paramiko.buffered_pipe import BufferedPipe, PipeTimeout
+from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
+from paramiko.util import asbytes
+
+from clustertools.login import login2ssh
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+BROKER_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'clustertools', 'brokers')
+
+# Seconds without any client before a broker shuts itself down
+DEFAULT_PERSIST = 4 * 60 * 60
+
+KEEPALIVE_INTERVAL = 30
+RELAY_CHUNK = 32768
+# Unread bytes a client buffers per stream, as much as paramiko's channel window
+PIPE_LIMIT = 2 * 1024 * 1024
+
+def broker_socket_path(hostname):
+    return os.path.join(BROKER_DIR, f"{hostname}.sock")
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(kind + struct.pack('>I', len(payload)) + payload)
+
+def recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError('Broker socket closed')
+        data += chunk
+    return data
+
+def recv_frame(sock):
+    header = recv_exact(sock, 5)
+    length, = struct.unpack('>I', header[1:])
+    return header[:1], recv_exact(sock, length) if length else b''
+
+class BoundedPipe(BufferedPipe):
+    """A BufferedPipe whose feed() waits while limit bytes or more are unread."""
+
+    def __init__(self, limit=PIPE_LIMIT):
+        super().__init__()
+        self.limit = limit
+        self._space = threading.Condition()
+        self._shut = False
+
+    def feed(self, data):
+        with self._space:
+            while len(self) >= self.limit and not self._shut:
+                self._space.wait()
+        super().feed(data)
+
+    def read(self, nbytes, timeout=None):
+        data = super().read(nbytes, timeout)
+        with self._space:
+            self._space.notify_all()
+        return data
+
+    def close(self):
+        super().close()
+        with self._space:
+            self._shut = True
+            self._space.notify_all()
+
+class BrokerChannel:
+    """The subset of paramiko.Channel used by clustertools, scp and SFTPClient."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(transport.socket_path)
+        self.timeout = None
+        self.closed = False
+        self._send_lock = threading.Lock()
+        self._stdout = BoundedPipe()
+        self._stderr = BoundedPipe()
+        self._exit_status = -1
+        self._status_event = threading.Event()
+
+    def _request(self, request):
+        send_frame(self.sock, b'R', json.dumps(request).encode())
+        kind, payload = recv_frame(self.sock)
+        reply = json.loads(payload.decode())
+        if kind != b'R' or not reply.get('ok'):
+            raise paramiko.SSHException(reply.get('error', 'Broker request failed'))
+        threading.Thread(target=self._read_frames, daemon=True).start()
+
+    def _read_frames(self):
+        try:
+            while True:
+                kind, payload = recv_frame(self.sock)
+                if kind == b'D':
+                    self._stdout.feed(payload)
+                elif kind == b'E':
+                    self._stderr.feed(payload)
+                elif kind == b'Q':
+                    self._stdout.close()
+                elif kind == b'q':
+                    self._stderr.close()
+                elif kind == b'X':
+                    self._exit_status, = struct.unpack('>i', payload)
+                    self._status_event.set()
+        except (EOFError, OSError):
+            pass
+        finally:
+            self._stdout.close()
+            self._stderr.close()
+            self._status_event.set()
+
+    def exec_command(self, command):
+        if isinstance(command, bytes):
+            # scp builds its commands as bytes
+            command = command.decode('utf-8', 'surrogateescape')
+        self._request({'kind': 'exec', 'command': command})
+
+    def invoke_subsystem(self, subsystem):
+        self._request({'kind': 'subsystem', 'name': subsystem})
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def send(self, data):
+        with self._send_lock:
+            send_frame(self.sock, b'D', asbytes(data))
+        return len(data)
+
+    def sendall(self, data):
+        # Keep frames small so the broker can interleave channels fairly
+        for i in range(0, len(data), RELAY_CHUNK):
+            self.send(data[i:i + RELAY_CHUNK])
+
+    def _read_pipe(self, pipe, nbytes):
+        try:
+            return pipe.read(nbytes, self.timeout)
+        except PipeTimeout:
+            raise socket.timeout()
+
+    def recv(self, nbytes):
+        return self._read_pipe(self._stdout, nbytes)
+
+    def recv_stderr(self, nbytes):
+        return self._read_pipe(self._stderr, nbytes)
+
+    def recv_ready(self):
+        return self._stdout.read_ready()
+
+    def recv_stderr_ready(self):
+        return self._stderr.read_ready()
+
+    def shutdown_write(self):
+        with self._send_lock:
+            send_frame(self.sock, b'W')
+
+    def exit_status_ready(self):
+        return self._status_event.is_set()
+
+    def recv_exit_status(self):
+        self._status_event.wait()
+        return self._exit_status
+
+    def makefile(self, *params):
+        return ChannelFile(self, *params)
+
+    def makefile_stderr(self, *params):
+        return ChannelStderrFile(self, *params)
+
+    def makefile_stdin(self, *params):
+        return ChannelStdinFile(self, *params)
+
+    def get_transport(self):
+        return self.transport
+
+    def get_name(self):
+        return 'broker'
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            # Wake the frame reader if it waits for room in a pipe
+            self._stdout.close()
+            self._stderr.close()
+
+class BrokerTransport:
+    """Stands in for paramiko.Transport; every session is a channel on the broker."""
+
+    def __init__(self, socket_path, info):
+        self.socket_path = socket_path
+        self.info = info
+
+    def open_session(self, window_size=None, max_packet_size=None, timeout=None):
+        return BrokerChannel(self)
+
+    def is_active(self):
+        return ping_broker(self.socket_path) is not None
+
+    def getpeername(self):
+        return tuple(self.info.get('peername', ('', 0)))
+
+    def set_keepalive(self, interval):
+        # The broker keeps its own session alive
+        pass
+
+    def close(self):
+        pass
+
+class BrokerClient:
+    """Stands in for paramiko.SSHClient on top of a running broker."""
+
+    def __init__(self, socket_path, info):
+        self._transport = BrokerTransport(socket_path, info)
+
+    def get_transport(self):
+        return self._transport
+
+    def exec_command(self, command, bufsize=-1, timeout=None, get_pty=False, environment=None):
+        chan = self._transport.open_session()
+        chan.settimeout(timeout)
+        chan.exec_command(command)
+        stdin = chan.makefile_stdin('wb', bufsize)
+        stdout = chan.makefile('r', bufsize)
+        stderr = chan.makefile_stderr('r', bufsize)
+        return stdin, stdout, stderr
+
+    def open_sftp(self):
+        chan = self._transport.open_session()
+        chan.invoke_subsystem('sftp')
+        return paramiko.SFTPClient(chan)
+
+    def close(self):
+        # Leave the broker's session open for other invocations
+        pass
+
+def ping_broker(socket_path):
+    """Return the broker's info dict if a live broker answers on socket_path."""
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        sock.connect(socket_path)
+        try:
+            send_frame(sock, b'R', json.dumps({'kind': 'ping'}).encode())
+            kind, payload = recv_frame(sock)
+        finally:
+            sock.close()
+        reply = json.loads(payload.decode())
+        return reply if reply.get('ok') else None
+    except (OSError, EOFError, ValueError):
+        return None
+
+def connect_broker(hostname):
+    """Return a BrokerClient for hostname if a broker is running, otherwise None."""
+    socket_path = broker_socket_path(hostname)
+    info = ping_broker(socket_path)
+    if info is None:
+        return None
+    return BrokerClient(socket_path, info)
+
+class Broker:
+    """Serves channels on one authenticated SSH session over a Unix socket."""
+
+    def __init__(self, ssh, hostname, username, socket_path, persist=DEFAULT_PERSIST):
+        self.ssh = ssh
+        self.transport = ssh.get_transport()
+        self.hostname = hostname
+        self.username = username
+        self.socket_path = socket_path
+        self.persist = persist
+        self.active_clients = 0
+        self.last_activity = time.time()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # Set once the socket accepts clients
+        self.listening = threading.Event()
+
+    def serve(self):
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o700, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        server.listen(64)
+        server.settimeout(1)
+        self.listening.set()
+
+        try:
+            while not self.stopping.is_set():
+                if not self.transport.is_active():
+                    break
+                with self.lock:
+                    idle = self.active_clients == 0 and time.time() - self.last_activity > self.persist
+                if idle:
+                    break
+                try:
+                    client, _ = server.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self.handle_client, args=(client,), daemon=True).start()
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.ssh.close()
+
+    def handle_client(self, client):
+        with self.lock:
+            self.active_clients += 1
+            self.last_activity = time.time()
+        try:
+            kind, payload = recv_frame(client)
+            request = json.loads(payload.decode())
+            if request.get('kind') == 'ping':
+                send_frame(client, b'R', json.dumps({
+                    'ok': True,
+                    'hostname': self.hostname,
+                    'username': self.username,
+                    'peername': list(self.transport.getpeername()),
+                    'pid': os.getpid(),
+                }).encode())
+            elif request.get('kind') == 'stop':
+                send_frame(client, b'R', json.dumps({'ok': True}).encode())
+                self.stopping.set()
+            else:
+                self.relay(client, request)
+        except Exception:
+            pass
+        finally:
+            client.close()
+            with self.lock:
+                self.active_clients -= 1
+                self.last_activity = time.time()
+
+    def relay(self, client, request):
+        """Open a real channel for a client request and pump frames both ways."""
+        try:
+            channel = self.transport.open_session()
+            if request.get('kind') == 'exec':
+                channel.exec_command(request['command'])
+            elif request.get('kind') == 'subsystem':
+                channel.invoke_subsystem(request['name'])
+            else:
+                raise ValueError(f"Unknown request {request.get('kind')!r}")
+        except Exception as e:
+            send_frame(client, b'R', json.dumps({'ok': False, 'error': str(e)}).encode())
+            return
+        send_frame(client, b'R', json.dumps({'ok': True}).encode())
+
+        send_lock = threading.Lock()
+
+        def pump(read, kind, eof_kind):
+            try:
+                while True:
+                    data = read(RELAY_CHUNK)
+                    if not data:
+                        break
+                    with send_lock:
+                        send_frame(client, kind, data)
+                with send_lock:
+                    send_frame(client, eof_kind)
+            except OSError:
+                # Client went away; the input pump closes the channel
+                pass
+
+        def pump_input():
+            try:
+                while True:
+                    kind, payload = recv_frame(client)
+                    if kind == b'D':
+                        channel.sendall(payload)
+                    elif kind == b'W':
+                        channel.shutdown_write()
+            except (EOFError, OSError):
+                # Client went away; drop its channel
+                channel.close()
+
+        threading.Thread(target=pump_input, daemon=True).start()
+        stderr_thread = threading.Thread(target=pump, args=(channel.recv_stderr, b'E', b'q'), daemon=True)
+        stderr_thread.start()
+        try:
+            pump(channel.recv, b'D', b'Q')
+            stderr_thread.join()
+            status = channel.recv_exit_status()
+            with send_lock:
+                send_frame(client, b'X', struct.pack('>i', status))
+        except OSError:
+            pass
+        finally:
+            channel.close()
+
+def start_broker(hostname, username=None, password=None, persist=DEFAULT_PERSIST, foreground=False):
+    """Authenticate to hostname and run a broker for it, in the background unless foreground."""
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'fork'):
+        print(f"{RED}The connection broker needs Unix sockets and fork(){RESET}")
+        return False
+
+    socket_path = broker_socket_path(hostname)
+    if ping_broker(socket_path) is not None:
+        print(f"{GREEN}A broker for {hostname} is already running{RESET}")
+        return True
+
+    if foreground:
+        ssh, scp = login2ssh(username, password, hostname)
+        ssh.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+        print(f"{GREEN}Broker for {hostname} listening on {socket_path}{RESET}")
+        Broker(ssh, hostname, username, socket_path, persist).serve()
+        return True
+
+    # paramiko's transport thread wouldn't survive a fork, so the child
+    # authenticates (still attached to the terminal) and reports back.
+    ready_read, ready_write = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(ready_write)
+        status = os.read(ready_read, 1)
+        os.close(ready_read)
+        if status == b'1':
+            print(f"{GREEN}Broker for {hostname} running in the background (pid {pid}), socket {socket_path}{RESET}")
+            return True
+        print(f"{RED}Broker for {hostname} failed to start{RESET}")
+        return False
+
+    os.close(ready_read)
+    try:
+        ssh, scp = login2ssh(username, password, hostname)
+        ssh.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+    except BaseException:
+        os.write(ready_write, b'0')
+        os._exit(1)
+
+    broker = Broker(ssh, hostname, username, socket_path, persist)
+    os.setsid()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+    # Report success once this broker listens; a socket left by a crashed
+    # one would already exist. If serve() fails first, the parent reads EOF
+    def report_ready():
+        broker.listening.wait()
+        os.write(ready_write, b'1')
+        os.close(ready_write)
+
+    threading.Thread(target=report_ready, daemon=True).start()
+    try:
+        broker.serve()
+    finally:
+        os._exit(0)
+
+def stop_broker(hostname):
+    socket_path = broker_socket_path(hostname)
+    if ping_broker(socket_path) is None:
+        print(f"{YELLOW}No broker running for {hostname}{RESET}")
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        send_frame(sock, b'R', json.dumps({'kind': 'stop'}).encode())
+        recv_frame(sock)
+    finally:
+        sock.close()
+    print(f"{GREEN}Broker for {hostname} stopped{RESET}")
+    return True
+
+def broker_status():
+    """Print every broker socket and whether it is alive."""
+    if not os.path.isdir(BROKER_DIR):
+        print("No brokers running")
+        return
+    found = False
+    for name in sorted(os.listdir(BROKER_DIR)):
+        if not name.endswith('.sock'):
+            continue
+        found = True
+        info = ping_broker(os.path.join(BROKER_DIR, name))
+        if info is None:
+            print(f"{RED}{name[:-5]}: not responding{RESET}")
+        else:
+            print(f"{GREEN}{info['hostname']}: {info.get('username')} (pid {info['pid']}){RESET}")
+    if not found:
+        print("No brokers running")
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep an authenticated cluster connection open for later transfers')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    start = subparsers.add_parser('start', help='Authenticate and start a broker')
+    start.add_argument('--host', help='Hostname', default='sftp.fmrib.ox.ac.uk')
+    start.add_argument('--username', help='Username for cluster', default=None)
+    start.add_argument('--password', help='Password for cluster', default=None)
+    start.add_argument('--persist', type=int, default=DEFAULT_PERSIST,
+                       help='Exit after this many seconds without clients (default: 4 hours)')
+    start.add_argument('--foreground', action='store_true', help='Run in the foreground instead of detaching')
+
+    stop = subparsers.add_parser('stop', help='Stop a running broker')
+    stop.add_argument('--host', help='Hostname', default='sftp.fmrib.ox.ac.uk')
+
+    subparsers.add_parser('status', help='List running brokers')
+
+    args = parser.parse_args()
+    if args.command == 'start':
+        ok = start_broker(args.host, args.username, args.password, args.persist, args.foreground)
+    elif args.command == 'stop':
+        ok = stop_broker(args.host)
+    else:
+        broker_status()
+        ok = True
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
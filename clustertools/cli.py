@@ -0,0 +1,84 @@
+import argparse
+import sys
+
+from clustertools.aio import DEFAULT_CONCURRENCY
+from clustertools.batch import run_batch
+from clustertools.connection import close_ssh_connection
+from clustertools.index import RemoteIndex
+from clustertools.local2cluster import SMALL_FILE_THRESHOLD
+from clustertools.metrics import PROGRESS_MODES, set_progress_output
+from clustertools.store import STORE_DIR, ContentStore, format_size
+
+def run_cache(action, host=None, root=None):
+    index = RemoteIndex()
+    if action == 'list':
+        summary = index.summary()
+        for host, root, entries, age in summary:
+            print(f"{host}:{root}  {entries} entries, listed {age:.0f}s ago")
+        if not summary:
+            print("No remote directories are cached")
+    elif root is not None and host is None:
+        raise SystemExit('clear ROOT needs --host')
+    else:
+        index.invalidate(host, root)
+        target = f"{host}:{root}" if root else host or 'every host'
+        print(f"Cleared cached listings of {target}")
+
+def run_store(action, path=STORE_DIR):
+    store = ContentStore(path)
+    if action == 'stats':
+        stats = store.stats()
+        requests = stats['hits'] + stats['misses']
+        rate = f", {stats['hits'] / requests:.0%} hit rate" if requests else ''
+        print(f"{path}: {stats['objects']} contents ({format_size(stats['size'])}) for {stats['keys']} remote files")
+        print(f"  Hits: {stats['hits']} files ({format_size(stats['hit_bytes'])}){rate}")
+        print(f"  Misses: {stats['misses']} files ({format_size(stats['miss_bytes'])})")
+        print(f"  Evictions: {stats['evictions']}")
+    else:
+        store.clear()
+        print(f"Cleared the content cache in {path}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Cluster transfer tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch = subparsers.add_parser('batch', help='Run a manifest of upload and download jobs')
+    batch.add_argument('manifest', help='Jobs as YAML (.yaml/.yml, needs PyYAML) or JSON lines (.jsonl)')
+    batch.add_argument('-j', '--jobs', type=int, default=DEFAULT_CONCURRENCY,
+                       help=f'Jobs running at once (default: {DEFAULT_CONCURRENCY})')
+    batch.add_argument('--per-host', type=int, default=None, help='Jobs running at once on one host (default: no limit)')
+    batch.add_argument('--username', help='Username for cluster', default=None)
+    batch.add_argument('--password', help='Password for cluster', default=None)
+    batch.add_argument('--small-file-threshold', type=int, default=SMALL_FILE_THRESHOLD,
+                       help='Single files below this many bytes between the same directories share a tar stream, '
+                            '0 disables grouping (default: 1 MiB)')
+    batch.add_argument('--progress', choices=PROGRESS_MODES, default='none',
+                       help='Progress output of the jobs; bars of concurrent jobs overwrite each other (default: none)')
+
+    cache = subparsers.add_parser('cache', help='Show or clear the local cache of remote directory listings')
+    cache.add_argument('action', choices=['list', 'clear'])
+    cache.add_argument('root', nargs='?', default=None, help='With clear, only forget this remote directory')
+    cache.add_argument('--host', default=None, help='With clear, only forget listings of this host')
+
+    store = subparsers.add_parser('store', help='Show statistics of the local content cache of downloads, or empty it')
+    store.add_argument('action', choices=['stats', 'clear'])
+    store.add_argument('--path', default=STORE_DIR, help=f'Store directory (default: {STORE_DIR})')
+
+    args = parser.parse_args()
+    if args.command == 'cache':
+        run_cache(args.action, args.host, args.root)
+        return
+    if args.command == 'store':
+        run_store(args.action, args.path)
+        return
+
+    set_progress_output(args.progress)
+    try:
+        ok = run_batch(args.manifest, args.jobs, args.per_host, args.username, args.password,
+                       args.small_file_threshold)
+    finally:
+        close_ssh_connection()
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""Copy files and folders between two clusters without storing them locally.
+
+The data leaves the source cluster as a `tar -c` stream and is unpacked by
+`tar -x` on the destination. When one cluster can log in to the other
+non-interactively (SSH keys or agent, no 2FA prompt), the stream runs
+directly between them: the source pushes it with `ssh`, or else the
+destination pulls it, and no data passes through this machine. Otherwise
+it is relayed through the two connections held here: received from one and
+sent on to the other as it arrives, with at most RELAY_BUFFERS chunks in
+memory and nothing written to local disk. Two folders on the same host are
+copied by a tar pipe on that host.
+"""
+import argparse
+import os
+import queue
+import shlex
+import threading
+import time
+
+from clustertools.cluster2local import get_remote_file_size, list_remote_files, list_remote_folder, send_file_list
+from clustertools.compression import (COMPRESSION_MODES, REMOTE_GZIP_SPEED, choose_codec, is_precompressed,
+                                      measure_link_rate, probe_remote, sample_remote, tar_compress_option)
+from clustertools.connection import close_ssh_connection, get_ssh_connection
+from clustertools.filters import add_filter_arguments, as_filter, filter_from_args
+from clustertools.metrics import PROGRESS_MODES, TransferMetrics, measure_rtt, set_progress_output
+from clustertools.tuning import rate_limiter
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+MODES = ['auto', 'direct', 'relay']
+CHUNK_SIZE = 1024 * 1024
+# Chunks held in memory between receiving from the source and sending to the destination
+RELAY_BUFFERS = 16
+# Options for the ssh one cluster runs to reach the other: fail instead of prompting
+REMOTE_SSH = 'ssh -o BatchMode=yes -o ConnectTimeout=10'
+
+def login_of(ssh, hostname, username=None):
+    """user@host as another machine would reach the host of a connection."""
+    transport = ssh.get_transport()
+    if username is None and hasattr(transport, 'get_username'):
+        username = transport.get_username()
+    return f"{username}@{hostname}" if username else hostname
+
+def can_reach(ssh, login):
+    """True if the host of ssh can run a command as login without a password prompt."""
+    stdin, stdout, stderr = ssh.exec_command(f"{REMOTE_SSH} {shlex.quote(login)} true")
+    stdin.close()
+    return stdout.channel.recv_exit_status() == 0
+
+def choose_route(source, destination, mode, source_login, destination_login):
+    """How the stream gets from source to destination: 'local', 'push', 'pull' or 'relay'.
+
+    mode 'auto' tries a direct route first, 'direct' fails without one and
+    'relay' always relays.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {', '.join(MODES)}")
+    if source is destination:
+        return 'local'
+    if mode != 'relay':
+        print(f"{YELLOW}Checking whether the clusters can reach each other...{RESET}")
+        if can_reach(source, destination_login):
+            return 'push'
+        if can_reach(destination, source_login):
+            return 'pull'
+        if mode == 'direct':
+            raise Exception(f"Neither {source_login} nor {destination_login} can log in to the other "
+                            f"without a prompt; set up SSH keys between them or use relay mode")
+        print(f"{YELLOW}No direct route between the clusters, relaying through this machine{RESET}")
+    return 'relay'
+
+def choose_stream_codec(source, destination, root, sizes, route, compression='auto', link_rate=None):
+    """Return (codec, source tar option, destination tar option) for the stream.
+
+    A codec has to be available on both clusters. In auto mode data that
+    is already compressed travels as it is; otherwise the codec is picked
+    from a sample compressed on the source and the link the stream crosses:
+    for a relay the slower of the two connections from here, for a direct
+    route link_rate (bytes/s), without which nothing is compressed since
+    the link between the clusters can't be measured from here.
+    """
+    cpus, source_codecs = probe_remote(source)
+    destination_codecs = source_codecs if destination is source else probe_remote(destination)[1]
+    available = {'none', 'gzip'} | (source_codecs & destination_codecs)
+    if compression != 'auto':
+        codec = compression
+        if codec not in available:
+            print(f"{YELLOW}{codec} is not available on both clusters, using gzip{RESET}")
+            codec = 'gzip'
+    else:
+        codec = 'none'
+        compressible = sorted(path for path in sizes if not is_precompressed(path) and sizes[path] > 0)
+        if route != 'local' and compressible and (route == 'relay' or link_rate):
+            if route == 'relay' and not link_rate:
+                link_rate = min(measure_link_rate(source, 'download'), measure_link_rate(destination, 'upload'))
+            ratio = sample_remote(source, root, compressible)
+            codec = choose_codec(ratio, REMOTE_GZIP_SPEED, link_rate, available, cpus)
+            print(f"Compression: {codec} (sample compresses to {ratio * 100:.1f}% with gzip -1, "
+                  f"link {round(link_rate * 8 / 1e6, 1)} Mbit/s)")
+    return (codec, tar_compress_option(codec, cpus, source_codecs),
+            tar_compress_option(codec, 1, destination_codecs))
+
+def run_pipeline(ssh, command, paths=None):
+    """Run a shell command on ssh, feeding it a NUL-separated file list if given; raise if it fails.
+
+    The command runs under bash with pipefail, so an archiver failing on one
+    side of a pipe isn't hidden by the extractor succeeding on the other.
+    """
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(f"bash -o pipefail -c {shlex.quote(command)}")
+    if paths is not None:
+        threading.Thread(target=send_file_list, daemon=True, args=(channel, paths)).start()
+    else:
+        channel.shutdown_write()
+    error = channel.makefile_stderr('rb').read().decode()
+    exit_status = channel.recv_exit_status()
+    # GNU tar uses 1 for "some files changed while being archived"
+    if exit_status not in (0, 1):
+        raise Exception(f"Remote copy failed: {error.strip()}")
+    if error.strip():
+        print(f"{YELLOW}Warning from the clusters: {error.strip()}{RESET}")
+
+def relay_stream(source, destination, metrics, limiters=()):
+    """Send everything received on the source channel to the destination channel.
+
+    A thread receives while the caller sends, so both links stay busy; a
+    bounded queue keeps at most RELAY_BUFFERS chunks in memory. Returns the
+    number of bytes relayed.
+    """
+    chunks = queue.Queue(RELAY_BUFFERS)
+
+    def receive():
+        try:
+            while True:
+                data = source.recv(CHUNK_SIZE)
+                chunks.put(data)
+                if not data:
+                    break
+        except Exception as e:
+            chunks.put(e)
+
+    threading.Thread(target=receive, daemon=True).start()
+    relayed = 0
+    while True:
+        data = chunks.get()
+        if isinstance(data, Exception):
+            raise data
+        if not data:
+            break
+        for limiter in limiters:
+            limiter.throttle(len(data))
+        destination.sendall(data)
+        relayed += len(data)
+        metrics.add_bytes(len(data))
+    destination.shutdown_write()
+    return relayed
+
+def cluster2cluster(sourceDIR, destDIR, filename=None, source_host=None, dest_host=None, username=None,
+                    password=None, dest_username=None, dest_password=None, mode='auto', compression='auto',
+                    link_speed=None, filters=None):
+    """Copy a folder (or one file of it, with filename) from source_host to destDIR on dest_host.
+
+    Like local2cluster, the folder arrives as destDIR/<folder name>; a file
+    keeps its path relative to sourceDIR. The two hosts are logged in to
+    with username/password, or dest_username/dest_password for the
+    destination when given. mode is 'auto', 'direct' or 'relay' (see the
+    module docstring); compression and link_speed (Mbit/s) choose the codec
+    of the stream as for cluster2local. With a TransferFilter only matching
+    files are copied.
+    """
+    filters = as_filter(filters)
+    source, _ = get_ssh_connection(username, password, source_host)
+    destination, _ = get_ssh_connection(dest_username or username, dest_password or password, dest_host)
+
+    paths = None
+    if filename:
+        parent_dir, name = sourceDIR, filename
+        sizes = {filename: get_remote_file_size(source, os.path.join(sourceDIR, filename))}
+    else:
+        parent_dir = os.path.dirname(sourceDIR.rstrip('/')) or '/'
+        name = os.path.basename(sourceDIR.rstrip('/'))
+        if filters:
+            sizes, extra_entries = list_remote_folder(source, sourceDIR, filters=filters)
+            if not sizes and not extra_entries:
+                print(f'{YELLOW}No files in {name} match the filters.{RESET}')
+                return
+            paths = [os.path.join(name, path) for path in sorted(sizes) + extra_entries]
+        else:
+            sizes = {path: size for path, (size, mtime) in list_remote_files(source, sourceDIR).items()}
+    total_size = sum(sizes.values())
+    print(f"{len(sizes)} files to copy ({round(total_size / (1024*1024), 2)} MB)")
+
+    route = choose_route(source, destination, mode, login_of(source, source_host, username),
+                         login_of(destination, dest_host, dest_username or username))
+    codec, source_option, destination_option = choose_stream_codec(
+        source, destination, sourceDIR, sizes, route, compression, link_speed * 125000 if link_speed else None)
+
+    if paths is None:
+        create = f"tar -cf - -C {shlex.quote(parent_dir)} {shlex.quote(name)}{source_option}"
+    else:
+        create = f"tar -cf - -C {shlex.quote(parent_dir)} --null -T -{source_option}"
+    prepare = f"mkdir -p {shlex.quote(destDIR)}"
+    extract = f"tar -xf - -C {shlex.quote(destDIR)}{destination_option}"
+
+    start_time = time.time()
+    if route == 'local':
+        print(f"{YELLOW}Copying {name} to {destDIR} on {source_host}...{RESET}")
+        run_pipeline(source, f"{prepare} && {create} | {extract}", paths)
+    elif route == 'push':
+        print(f"{YELLOW}Streaming {name} from {source_host} straight to {dest_host}...{RESET}")
+        destination_login = login_of(destination, dest_host, dest_username or username)
+        run_pipeline(source, f"{create} | {REMOTE_SSH} {shlex.quote(destination_login)} "
+                             f"{shlex.quote(f'{prepare} && {extract}')}", paths)
+    elif route == 'pull':
+        print(f"{YELLOW}Streaming {name} from {source_host} straight to {dest_host} (pulled by {dest_host})...{RESET}")
+        source_login = login_of(source, source_host, username)
+        run_pipeline(destination, f"{prepare} && {REMOTE_SSH} {shlex.quote(source_login)} "
+                                  f"{shlex.quote(create)} | {extract}", paths)
+    else:
+        print(f"{YELLOW}Relaying {name} from {source_host} to {dest_host} through memory...{RESET}")
+        metrics = TransferMetrics('Relaying', total_size, 1, name=name, direction='relay')
+        metrics.record_rtt(measure_rtt(source))
+        metrics.phase('transfer')
+        sender = destination.get_transport().open_session()
+        sender.exec_command(f"{prepare} && {extract}")
+        receiver = source.get_transport().open_session()
+        receiver.exec_command(create)
+        if paths is not None:
+            threading.Thread(target=send_file_list, daemon=True, args=(receiver, paths)).start()
+        try:
+            limiters = [limiter for limiter in (rate_limiter(source), rate_limiter(destination)) if limiter]
+            relayed = relay_stream(receiver, sender, metrics, limiters)
+
+            source_status = receiver.recv_exit_status()
+            source_error = receiver.makefile_stderr('rb').read().decode()
+            destination_status = sender.recv_exit_status()
+            destination_error = sender.makefile_stderr('rb').read().decode()
+        finally:
+            receiver.close()
+            sender.close()
+        if codec != 'none':
+            # Progress counted compressed bytes; the files themselves have all arrived
+            metrics.set_bytes(total_size)
+        metrics.finish()
+        if source_status == 1:
+            # GNU tar uses 1 for "some files changed while being archived"
+            print(f"{YELLOW}Warning from tar on {source_host}: {source_error}{RESET}")
+        elif source_status != 0:
+            raise Exception(f"Archiving on {source_host} failed: {source_error.strip()}")
+        if destination_status != 0:
+            raise Exception(f"Extracting on {dest_host} failed: {destination_error.strip()}")
+        print(f"Relayed {round(relayed / (1024*1024), 2)} MB for {round(total_size / (1024*1024), 2)} MB of files")
+
+    elapsed = time.time() - start_time
+    speed = total_size / elapsed / (1024*1024) if elapsed > 0 else 0
+    print(f'{GREEN}Copied {name} to {dest_host}:{destDIR} in {elapsed:.1f}s ({speed:.2f} MB/s).{RESET}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy files/folders from one cluster to another without storing them locally')
+    parser.add_argument('-s', '--source_dir', required=True, help='Source directory path on the source cluster')
+    parser.add_argument('-d', '--dest_dir', required=True, help='Destination directory path on the destination cluster')
+    parser.add_argument('-f', '--filename', help='Specific file to copy (optional)', default=None)
+    parser.add_argument('--source-host', required=True, help='Source hostname')
+    parser.add_argument('--dest-host', required=True, help='Destination hostname')
+    parser.add_argument('--username', help='Username for the source cluster (and the destination by default)', default=None)
+    parser.add_argument('--password', help='Password for the source cluster (and the destination by default)', default=None)
+    parser.add_argument('--dest-username', help='Username for the destination cluster', default=None)
+    parser.add_argument('--dest-password', help='Password for the destination cluster', default=None)
+    parser.add_argument('--mode', choices=MODES, default='auto',
+                        help='Stream directly between the clusters, relay it through this machine, '
+                             'or go direct when they can reach each other (default: auto)')
+    parser.add_argument('--compression', choices=COMPRESSION_MODES, default='auto',
+                        help='Codec for the stream; auto picks one from a data sample and the link speed (default: auto)')
+    parser.add_argument('--link-speed', type=float, default=None,
+                        help='Link throughput in Mbit/s used by --compression auto instead of measuring it')
+    parser.add_argument('--progress', choices=PROGRESS_MODES, default='bar',
+                        help='Progress output: terminal bar, JSON lines on stderr, or none (default: bar)')
+    add_filter_arguments(parser)
+
+    args = parser.parse_args()
+    set_progress_output(args.progress)
+
+    try:
+        cluster2cluster(args.source_dir, args.dest_dir, args.filename, args.source_host, args.dest_host,
+                        args.username, args.password, args.dest_username, args.dest_password, args.mode,
+                        args.compression, args.link_speed, filter_from_args(args))
+    finally:
+        close_ssh_connection()
+
+if __name__ == "__main__":
+    main()
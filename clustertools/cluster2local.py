@@ -3,7 +3,26 @@ from tqdm import tqdm
 import argparse
 import tempfile
 import shutil
-from clustertools.login import login2ssh
+import shlex
+import tarfile
+from clustertools.login import progress
+from clustertools.connection import get_ssh_connection, close_ssh_connection
+from clustertools.sync import remote_manifest, local_manifest, compare_manifests, check_delete, delete_local_files
+from clustertools.delta import DEFAULT_BLOCK_SIZE, download_delta
+from clustertools.resume import TransferJournal, is_connection_lost, resumable_download, with_reconnect
+from clustertools.backends import (BACKEND_NAMES, DEFAULT_MAX_REQUESTS, DEFAULT_REQUEST_SIZE,
+                                   choose_backend, make_backend)
+from clustertools.stripe import STRIPE_THRESHOLD, striped_download
+from clustertools.metrics import PROGRESS_MODES, TransferMetrics, measure_rtt, set_progress_output
+from clustertools.verify import ALGORITHMS, DEFAULT_ALGORITHM, DigestLog, verify_and_record
+from clustertools.shard import plan_shards, remote_extra_entries, shard_command
+from clustertools.index import DEFAULT_TTL, open_index, split_entries
+from clustertools.filters import add_filter_arguments, as_filter, filter_from_args, parse_size
+from clustertools.compression import COMPRESSION_MODES, CompressionPolicy, DecompressingReader, is_precompressed
+from clustertools.store import DEFAULT_MAX_SIZE, KEY_MODES, LINK_MODES, STORE_ALGORITHM, STORE_DIR, open_store, unshare
+from clustertools.tuning import MAX_CHANNELS, AdaptiveConcurrency, bandwidth_limiter, limit_rate, rate_limiter, tune_connection
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
 # Color constants
@@ -12,36 +31,30 @@ GREEN = '\033[92m'
 YELLOW = '\033[93m'
 RESET = '\033[0m'
 
-# Add these global variables at the top of your file
-global_ssh = None
-global_scp = None
+CHUNK_SIZE = 1024 * 1024
 
-def get_ssh_connection(username=None, password=None, hostname=None):
-    """Get an SSH connection, reusing an existing one if available."""
-    global global_ssh, global_scp
+def download_file(scp, localDIR, clusterDIR, filename, ssh=None, delta=False, block_size=DEFAULT_BLOCK_SIZE,
+                  resume=False, reconnect=None, backend='auto', request_size=DEFAULT_REQUEST_SIZE,
+                  max_requests=DEFAULT_MAX_REQUESTS, stripes=1, verify=False, algorithm=DEFAULT_ALGORITHM,
+                  manifest=None, store=None):
+    """Download a single file from the cluster.
     
-    # Check if we already have an active connection
-    if global_ssh is not None:
-        try:
-            # Test if the connection is still active
-            global_ssh.exec_command('echo test', timeout=5)
-            print(f"{GREEN}Using existing SSH connection{RESET}")
-            return global_ssh, global_scp
-        except Exception:
-            # Connection is no longer active, close it and create a new one
-            try:
-                global_scp.close()
-                global_ssh.close()
-            except:
-                pass
-            global_ssh = None
-            global_scp = None
-    
-    # Create a new connection
-    global_ssh, global_scp = login2ssh(username, password, hostname)
-    return global_ssh, global_scp
-
-def download_file(scp, localDIR, clusterDIR, filename):
+    With ssh, the transfer backend is picked from the file size by
+    choose_backend unless backend names one ('scp', 'sftp' or 'tar'), and
+    with stripes > 1 files of at least STRIPE_THRESHOLD bytes are fetched as
+    that many byte ranges over separate SFTP channels at once.
+    
+    With delta=True (requires ssh) only the blocks that differ from the existing
+    local copy are received, falling back to a full download on failure.
+    With resume=True (requires ssh) the file is received over SFTP into a
+    partial file that a later run, or an automatic reconnect, continues.
+    With verify=True (requires ssh) the file is hashed as it arrives and
+    compared with a hash computed on the cluster; on a mismatch it is fetched
+    again, and the result is written to a manifest (see clustertools.verify).
+    With store (a HostStore, requires ssh) an unchanged file whose content
+    is cached locally is placed from the store, and a downloaded one is
+    added to it.
+    """
     file_path_local = os.path.join(localDIR, filename)
     file_path_cluster = os.path.join(clusterDIR, filename)
 
@@ -51,12 +64,667 @@ def download_file(scp, localDIR, clusterDIR, filename):
     print(f"Remote file path: {file_path_cluster}")
     print(f"Local file path: {file_path_local}")
     
+    if store is not None and ssh is not None:
+        entry = {filename: get_remote_file_stat(ssh, file_path_cluster)}
+        if store.fetch(ssh, clusterDIR, entry, localDIR):
+            print(f'{GREEN}File {filename} download complete.{RESET}')
+            return
+    
     print(f"{YELLOW}Downloading {filename}...{RESET}")
-    scp.get(file_path_cluster, file_path_local)
+    if delta and ssh is not None:
+        try:
+            download_delta(ssh, file_path_cluster, file_path_local, block_size)
+            print(f'{GREEN}File {filename} download complete.{RESET}')
+            if store is not None:
+                store.add(clusterDIR, entry, localDIR)
+            return
+        except Exception as e:
+            print(f"{YELLOW}Delta transfer failed ({str(e).strip()}), downloading the whole file{RESET}")
+    
+    if ssh is None:
+        unshare(file_path_local)
+        scp.get(file_path_cluster, file_path_local, preserve_times=True)
+        print(f'{GREEN}File {filename} download complete.{RESET}')
+        return
+    
+    digests = DigestLog(algorithm) if verify else None
     
+    def fetch():
+        if resume:
+            def transfer(ssh):
+                # A fresh hash per attempt; resumable_download rehashes the part received before
+                digest = digests.new() if digests is not None else None
+                sftp = ssh.open_sftp()
+                try:
+                    resumable_download(sftp, file_path_cluster, file_path_local,
+                                       callback=lambda sent, size: progress(filename, size, sent), digest=digest)
+                finally:
+                    sftp.close()
+                return digest
+            
+            digest = with_reconnect(transfer, ssh, reconnect)
+        else:
+            size = get_remote_file_size(ssh, file_path_cluster)
+            if stripes > 1 and size >= STRIPE_THRESHOLD:
+                # Every stripe is already checked against a remote hash of its range
+                digest = None
+                striped_download(ssh, file_path_cluster, file_path_local, stripes,
+                                 lambda sent, size: progress(filename, size, sent), request_size, max_requests)
+            else:
+                digest = digests.new() if digests is not None else None
+                name = choose_backend(size, backend, verify)
+                print(f"Using {name} backend")
+                transfer = make_backend(name, ssh, request_size, max_requests)
+                try:
+                    if name == 'scp':
+                        # Progress bar handled by SCPClient
+                        transfer.download(file_path_cluster, file_path_local, digest=digest)
+                    else:
+                        transfer.download(file_path_cluster, file_path_local,
+                                          lambda sent, size: progress(filename, size, sent), digest)
+                finally:
+                    transfer.close()
+        if digests is not None:
+            digests.add(filename, os.path.getsize(file_path_local), digest)
+    
+    fetch()
     print(f'{GREEN}File {filename} download complete.{RESET}')
+    result = None
+    if verify:
+        result = verify_and_record(ssh, clusterDIR, digests, lambda paths: fetch(), 'download', localDIR, manifest)
+    if store is not None:
+        store.add(clusterDIR, entry, localDIR, digests)
+    return result
+
+def get_remote_file_size(ssh, path):
+    """Return the size in bytes of a remote file with a single `stat` call."""
+    stdin, stdout, stderr = ssh.exec_command(f"stat -c %s {shlex.quote(path)}")
+    output = stdout.read().decode().strip()
+    if stdout.channel.recv_exit_status() != 0:
+        raise Exception(f"Cannot access remote file {path}: {stderr.read().decode().strip()}")
+    return int(output)
+
+def get_remote_file_stat(ssh, path):
+    """Return the (size, mtime) of a remote file with a single `stat` call."""
+    stdin, stdout, stderr = ssh.exec_command(f"stat -c '%s %Y' {shlex.quote(path)}")
+    output = stdout.read().decode().split()
+    if stdout.channel.recv_exit_status() != 0:
+        raise Exception(f"Cannot access remote file {path}: {stderr.read().decode().strip()}")
+    return int(output[0]), float(output[1])
+
+def download_file_list(ssh, localDIR, clusterDIR, paths, sizes, backend,
+                       request_size=DEFAULT_REQUEST_SIZE, max_requests=DEFAULT_MAX_REQUESTS, on_file=None,
+                       digests=None, adaptive=False):
+    """Download files (relative to clusterDIR) one by one through a transfer backend.
+    
+    Used for folders when the scp or sftp backend is requested instead of a
+    tar stream. on_file(path) is called for every finished file. With a
+    DigestLog, every file is hashed as it arrives. With adaptive=True files
+    are fetched over several channels at once, their number adjusted to
+    the throughput by an AdaptiveConcurrency.
+    """
+    folder_name = os.path.basename(clusterDIR.rstrip('/'))
+    total_size = sum(sizes[path] for path in paths)
+    print(f"{YELLOW}Downloading {len(paths)} files ({round(total_size/(1024*1024), 2)} MB) with the {backend} backend...{RESET}")
+    
+    local = threading.local()
+    open_backends = []
+    limiter = rate_limiter(ssh)
+    controller = AdaptiveConcurrency(1, MAX_CHANNELS, rate_cap=limiter.rate if limiter else None) if adaptive else None
+    metrics = TransferMetrics('Downloading', total_size, len(paths), name=folder_name, direction='download')
+    metrics.record_rtt(measure_rtt(ssh))
+    metrics.phase('transfer')
+    
+    def get_backend():
+        if not hasattr(local, 'transfer'):
+            local.transfer = make_backend(backend, ssh, request_size, max_requests)
+            open_backends.append(local.transfer)
+        return local.transfer
+    
+    def fetch(path):
+        local_path = os.path.join(localDIR, folder_name, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        received = [0]
+        digest = digests.new() if digests is not None else None
+        
+        def callback(sent, size):
+            metrics.add_bytes(sent - received[0])
+            received[0] = sent
+        
+        started = time.time()
+        try:
+            get_backend().download(os.path.join(clusterDIR, path), local_path, callback, digest)
+        except Exception as e:
+            metrics.add_bytes(-received[0])
+            if is_connection_lost(ssh, e):
+                raise
+            metrics.error(f"Error downloading {path}: {str(e)}")
+            return
+        if digests is not None:
+            digests.add(path, sizes[path], digest)
+        metrics.file_done(path, sizes[path], time.time() - started)
+        if on_file is not None:
+            on_file(path)
+    
+    def fetch_in_slot(path):
+        with controller.slot():
+            fetch(path)
+    
+    try:
+        if controller is None:
+            for path in paths:
+                fetch(path)
+        else:
+            controller.start(metrics)
+            try:
+                with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+                    list(executor.map(fetch_in_slot, paths))
+            finally:
+                controller.stop()
+    finally:
+        for transfer in open_backends:
+            transfer.close()
+        metrics.finish()
+    
+    if metrics.errors:
+        print(f'{RED}{metrics.errors} files failed to download.{RESET}')
+    print(f'{GREEN}Folder {folder_name} download complete.{RESET}')
 
-def download_folder(ssh, scp, localDIR, clusterDIR):
+def list_remote_files(ssh, clusterDIR, index=None, filters=None):
+    """remote_manifest of clusterDIR, from index (a HostIndex) when given; raises if clusterDIR is missing."""
+    if index is not None:
+        files = index.files(ssh, clusterDIR, missing_ok=False)
+        return filters.select(files) if filters else files
+    return remote_manifest(ssh, clusterDIR, filters)
+
+def list_remote_folder(ssh, clusterDIR, index=None, filters=None):
+    """Return ({path: size} of the files below clusterDIR, [symlinks and empty directories]).
+    
+    With a TransferFilter only matching files and symlinks are listed.
+    Raises FileNotFoundError if clusterDIR is missing.
+    """
+    if index is not None:
+        return split_entries(index.entries(ssh, clusterDIR, missing_ok=False), filters)
+    sizes = {path: size for path, (size, mtime) in remote_manifest(ssh, clusterDIR, filters).items()}
+    return sizes, remote_extra_entries(ssh, clusterDIR, filters)
+
+def get_remote_size(ssh, clusterDIR):
+    """Return the size in bytes of a remote directory, or 0 if it can't be determined."""
+    size_cmd = f"du -sb {shlex.quote(clusterDIR)} | cut -f1"
+    stdin, stdout, stderr = ssh.exec_command(size_cmd)
+    dir_size_output = stdout.read().decode().strip()
+    try:
+        dir_size = int(dir_size_output)
+        print(f"Remote directory size: {round(dir_size / (1024*1024), 2)} MB")
+    except ValueError:
+        print(f"Could not determine directory size: {dir_size_output}")
+        dir_size = 0
+    return dir_size
+
+def extract_member(tar, member, path, digest=None):
+    """Extract a single tar member, refusing unsafe paths when tarfile supports filters.
+    
+    With digest, a regular file is written out here instead of by tarfile so
+    its data is hashed on the way to disk.
+    """
+    if digest is None or not member.isfile():
+        if member.isfile():
+            unshare(os.path.join(path, member.name))
+        if hasattr(tarfile, 'data_filter'):
+            tar.extract(member, path=path, filter='data')
+        else:
+            tar.extract(member, path=path)
+        return
+    
+    if hasattr(tarfile, 'data_filter'):
+        member = tarfile.data_filter(member, path)
+    target = os.path.join(path, member.name)
+    if not os.path.realpath(target).startswith(os.path.realpath(path) + os.sep):
+        raise tarfile.TarError(f"Refusing to extract {member.name} outside {path}")
+    
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    unshare(target)
+    source = tar.extractfile(member)
+    with open(target, 'wb') as f:
+        while True:
+            data = source.read(CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+            f.write(data)
+    os.chmod(target, member.mode & 0o7777)
+    os.utime(target, (member.mtime, member.mtime))
+
+def send_file_list(channel, paths):
+    """Write NUL-separated paths to a remote command's stdin, then close it."""
+    try:
+        for path in paths:
+            channel.sendall(path.encode('utf-8', 'surrogateescape') + b'\0')
+    finally:
+        channel.shutdown_write()
+
+def download_folder_stream(ssh, localDIR, clusterDIR, paths=None, dir_size=None, on_file=None, digests=None,
+                           policy=None, sizes=None, index=None, filters=None):
+    """Download a folder by extracting the remote `tar -c` output as it arrives.
+    
+    No archive is written on either side and only one tar member is held in
+    memory at a time, so archiving, transfer and extraction overlap.
+    If paths is given, only those files (relative to clusterDIR, with sizes
+    {path: size} if known) are sent.
+    on_file(path) is called with the relative path of every extracted file.
+    With a DigestLog, every file is hashed as it is extracted.
+    policy (a CompressionPolicy) picks how the stream is compressed; without
+    one it is gzipped.
+    With a HostIndex (see clustertools.index) the size probe is answered
+    from the local metadata cache. With a TransferFilter the folder is
+    listed by a remote find that prunes excluded directories and only the
+    matching files are archived.
+    """
+    folder_name = os.path.basename(clusterDIR.rstrip('/'))
+    parent_dir = os.path.dirname(clusterDIR.rstrip('/')) or '/'
+    print(f"{YELLOW}Preparing remote folder for download...{RESET}")
+    metrics = TransferMetrics('Downloading', dir_size or 0, len(paths) if paths is not None else 0,
+                              name=folder_name, direction='download')
+    metrics.record_rtt(measure_rtt(ssh))
+    if policy is None:
+        policy = CompressionPolicy('gzip')
+    
+    if paths is None and filters:
+        metrics.phase('size_probe')
+        sizes, extra_entries = list_remote_folder(ssh, clusterDIR, index, filters)
+        if not sizes and not extra_entries:
+            metrics.finish()
+            print(f'{YELLOW}No files in {folder_name} match the filters.{RESET}')
+            return
+        paths = sorted(sizes) + extra_entries
+        dir_size = sum(sizes.values())
+        print(f"{len(sizes)} files match the filters ({round(dir_size / (1024*1024), 2)} MB)")
+        metrics.total_bytes = dir_size
+        metrics.total_files = len(sizes)
+    
+    # Check directory size first to estimate progress
+    if policy.mode == 'auto':
+        metrics.phase('size_probe')
+        if paths is None:
+            # The listing gives the size and the file names the policy looks at
+            sizes = {path: size for path, (size, mtime) in list_remote_files(ssh, clusterDIR, index).items()}
+            dir_size = sum(sizes.values())
+            print(f"Remote directory size: {round(dir_size / (1024*1024), 2)} MB")
+            metrics.total_bytes = dir_size
+        policy.decide_download(ssh, clusterDIR, sizes if sizes is not None else {path: 1 for path in paths})
+    else:
+        if dir_size is None:
+            metrics.phase('size_probe')
+            dir_size = index.size(ssh, clusterDIR) if index is not None else get_remote_size(ssh, clusterDIR)
+            metrics.total_bytes = dir_size
+        if policy.mode != 'none':
+            # A forced codec is still checked on both ends (falling back to gzip) and given the remote cores
+            policy.decide_download(ssh, clusterDIR, {})
+    codec = policy.codec_for(paths if paths is not None else list(sizes or ()))
+    option = policy.tar_option(codec)
+    
+    dest_dir = os.path.join(localDIR, folder_name)
+    os.makedirs(dest_dir, exist_ok=True)
+    
+    print(f"{YELLOW}Streaming {folder_name} to {dest_dir}...{RESET}")
+    metrics.phase('archive')
+    channel = ssh.get_transport().open_session()
+    if paths is None:
+        channel.exec_command(f"tar -cf - -C {shlex.quote(parent_dir)} {shlex.quote(folder_name)}{option}")
+    else:
+        # Feed the file list from a thread so tar output never blocks on our stdin writes
+        channel.exec_command(f"tar -cf - -C {shlex.quote(parent_dir)} --null -T -{option}")
+        threading.Thread(target=send_file_list, daemon=True,
+                         args=(channel, (os.path.join(folder_name, path) for path in paths))).start()
+    
+    try:
+        reader = DecompressingReader(channel.makefile('rb'), codec, rate_limiter(ssh))
+        start_time = time.time()
+        
+        try:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                # Archiving, transfer and extraction overlap from the first block on
+                metrics.phase('transfer')
+                last_done = time.time()
+                for member in tar:
+                    digest = digests.new() if digests is not None and member.isfile() else None
+                    extract_member(tar, member, localDIR, digest)
+                    # Drop the member list tarfile keeps so memory stays bounded
+                    tar.members = []
+                    
+                    if member.isfile():
+                        path = os.path.relpath(member.name, folder_name)
+                        if digest is not None:
+                            digests.add(path, member.size, digest)
+                        now = time.time()
+                        metrics.add_bytes(member.size)
+                        metrics.file_done(path, member.size, now - last_done)
+                        last_done = now
+                        if on_file is not None:
+                            on_file(path)
+        except (tarfile.TarError, EOFError, OSError) as e:
+            # A dropped connection shows up as a truncated archive
+            if not ssh.get_transport().is_active():
+                raise EOFError("Connection lost while streaming archive") from e
+            if channel.eof_received:
+                # The remote tar gave up (a missing or unreadable folder): report why
+                exit_status = channel.recv_exit_status()
+                error = channel.makefile_stderr('rb').read().decode().strip()
+                if exit_status not in (0, 1):
+                    print(f"\n{RED}Error creating archive: {error}{RESET}")
+                    raise Exception(f"Failed to create archive: {error}") from e
+            raise
+        finally:
+            reader.close()
+        
+        exit_status = channel.recv_exit_status()
+        error = channel.makefile_stderr('rb').read().decode()
+        if exit_status == 1:
+            # GNU tar uses 1 for "some files changed while being archived"
+            print(f"\n{YELLOW}Warning from remote tar: {error}{RESET}")
+        elif exit_status != 0:
+            print(f"\n{RED}Error creating archive: {error}{RESET}")
+            raise Exception(f"Failed to create archive: {error}")
+        
+        metrics.finish()
+        elapsed = time.time() - start_time
+        speed = reader.wire_bytes / elapsed / (1024*1024) if elapsed > 0 else 0
+        print(f"Extraction complete: {metrics.files} files ({round(metrics.bytes/(1024*1024), 2)} MB), "
+              f"{round(reader.wire_bytes/(1024*1024), 2)} MB transferred at {speed:.2f} MB/s")
+        policy.report.add(codec, reader.raw_bytes, reader.wire_bytes, reader.cpu_seconds)
+        policy.report.print_summary('decompression')
+    finally:
+        channel.close()
+    
+    print(f'{GREEN}Folder {folder_name} download complete.{RESET}')
+
+def download_folder_sharded(ssh, localDIR, clusterDIR, shards, policy=None, paths=None, sizes=None,
+                            on_file=None, digests=None, index=None, filters=None):
+    """Download a folder as several compressed tar streams running at once.
+    
+    The files are split into shards of balanced size. Each shard is archived
+    and compressed by its own remote tar on its own channel, with the codec
+    chosen by policy (a CompressionPolicy, auto by default), and extracted
+    here by its own thread as it arrives, so compression, transfer and
+    extraction overlap and use several cores at both ends. Already
+    compressed files travel in shards of their own, uncompressed. If paths
+    is given, only those files (relative to clusterDIR, with sizes
+    {path: size}) are sent; otherwise every file, symlink and empty
+    directory is, listed through index (a HostIndex) when given and
+    narrowed by filters (a TransferFilter) on the remote side.
+    """
+    folder_name = os.path.basename(clusterDIR.rstrip('/'))
+    parent_dir = os.path.dirname(clusterDIR.rstrip('/')) or '/'
+    dest_dir = os.path.join(localDIR, folder_name)
+    print(f"{YELLOW}Preparing remote folder for download...{RESET}")
+    metrics = TransferMetrics('Downloading', 0, 0, name=folder_name, direction='download')
+    metrics.record_rtt(measure_rtt(ssh))
+    
+    extra_entries = []
+    metrics.phase('size_probe')
+    if paths is None:
+        sizes, extra_entries = list_remote_folder(ssh, clusterDIR, index, filters)
+        paths = sorted(sizes)
+    if not paths and not extra_entries:
+        metrics.finish()
+        print(f'{GREEN}Folder {folder_name} is empty.{RESET}')
+        return
+    metrics.total_bytes = sum(sizes[path] for path in paths)
+    metrics.total_files = len(paths)
+    if policy is None:
+        policy = CompressionPolicy()
+    # The remote cores are split between the shards' compressors
+    policy.decide_download(ssh, clusterDIR, {path: sizes[path] for path in paths}, streams=shards)
+    
+    # Already compressed files get shards of their own so they aren't compressed again
+    packed = [path for path in paths if is_precompressed(path)]
+    rest = [path for path in paths if not is_precompressed(path)]
+    if packed and rest and policy.codec_for(packed) != policy.codec_for(rest):
+        packed_bytes = sum(sizes[path] for path in packed)
+        packed_shards = min(shards - 1, max(1, round(shards * packed_bytes / max(metrics.total_bytes, 1))))
+        classes = [(rest, shards - packed_shards), (packed, packed_shards)]
+    else:
+        classes = [(paths, shards)]
+    groups = [(group, policy.codec_for(files))
+              for files, count in classes
+              for group in plan_shards({path: sizes[path] for path in files}, count)]
+    if not groups:
+        groups = [([], policy.codec_for([]))]
+    groups[0] = (extra_entries + groups[0][0], groups[0][1])
+    
+    # Parent directories are created up front so shard threads never race on them
+    for path in set(os.path.dirname(path) for path in paths + extra_entries):
+        os.makedirs(os.path.join(dest_dir, path), exist_ok=True)
+    
+    codecs = ', '.join(sorted(set(codec for group, codec in groups)))
+    print(f"{YELLOW}Streaming {folder_name} to {dest_dir} in {len(groups)} shards ({codecs})...{RESET}")
+    metrics.phase('transfer')
+    warnings = []
+    
+    def fetch_shard(shard):
+        group, codec = shard
+        channel = ssh.get_transport().open_session()
+        channel.exec_command(shard_command(parent_dir, policy.tar_option(codec)))
+        threading.Thread(target=send_file_list, daemon=True,
+                         args=(channel, (os.path.join(folder_name, path) for path in group))).start()
+        try:
+            reader = DecompressingReader(channel.makefile('rb'), codec, rate_limiter(ssh))
+            try:
+                with tarfile.open(fileobj=reader, mode='r|') as tar:
+                    last_done = time.time()
+                    for member in tar:
+                        digest = digests.new() if digests is not None and member.isfile() else None
+                        extract_member(tar, member, localDIR, digest)
+                        tar.members = []
+                        
+                        if member.isfile():
+                            path = os.path.relpath(member.name, folder_name)
+                            if digest is not None:
+                                digests.add(path, member.size, digest)
+                            now = time.time()
+                            metrics.add_bytes(member.size)
+                            metrics.file_done(path, member.size, now - last_done)
+                            last_done = now
+                            if on_file is not None:
+                                on_file(path)
+            except (tarfile.TarError, EOFError, OSError) as e:
+                # A dropped connection shows up as a truncated shard
+                if not ssh.get_transport().is_active():
+                    raise EOFError("Connection lost while streaming shard") from e
+                error = channel.makefile_stderr('rb').read().decode()
+                raise Exception(f"Failed to download shard: {error or str(e)}") from e
+            finally:
+                reader.close()
+            policy.report.add(codec, reader.raw_bytes, reader.wire_bytes, reader.cpu_seconds)
+            
+            exit_status = channel.recv_exit_status()
+            error = channel.makefile_stderr('rb').read().decode()
+            if exit_status not in (0, 1):
+                raise Exception(f"Failed to archive shard: {error}")
+            if error:
+                # GNU tar uses 1 for "some files changed while being archived"
+                warnings.append(error.strip())
+        finally:
+            channel.close()
+    
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        # list() re-raises the first shard error
+        list(executor.map(fetch_shard, groups))
+    metrics.finish()
+    
+    for warning in warnings:
+        print(f"{YELLOW}Warning from remote tar: {warning}{RESET}")
+    elapsed = metrics.end_time - metrics.start_time
+    speed = metrics.bytes / elapsed / (1024*1024) if elapsed > 0 else 0
+    print(f"Extraction complete: {metrics.files} files ({round(metrics.bytes/(1024*1024), 2)} MB) at {speed:.2f} MB/s")
+    policy.report.print_summary('decompression')
+    print(f'{GREEN}Folder {folder_name} download complete.{RESET}')
+
+def download_folder_sync(ssh, localDIR, clusterDIR, delete=False, changed_only=True, journal=None, reconnect=None,
+                         backend='auto', request_size=DEFAULT_REQUEST_SIZE, max_requests=DEFAULT_MAX_REQUESTS,
+                         digests=None, shards=1, policy=None, index=None, filters=None, adaptive=False,
+                         store=None, force_delete=False):
+    """Download only the files that are new or changed compared with the local copy.
+    
+    Files arrive in a tar stream (or shards > 1 concurrent streams), compressed
+    as policy decides, or one by one when backend is 'scp' or 'sftp'. With changed_only=False every remote file is a candidate. With a journal,
+    files finished by an earlier interrupted run are skipped, finished files
+    are recorded as they are extracted, and a dropped connection is
+    re-established through reconnect() before continuing.
+    With a HostIndex the remote listing comes from the local metadata cache.
+    With a TransferFilter both sides only list matching files, so --delete
+    leaves excluded local files alone. adaptive is passed on to
+    download_file_list. With a HostStore, files whose content is cached
+    locally are placed from the store and the rest are added to it.
+    A missing remote folder raises FileNotFoundError, and delete refuses
+    to empty the local folder because the remote one lists no files unless
+    force_delete=True.
+    """
+    folder_name = os.path.basename(clusterDIR.rstrip('/'))
+    dest_dir = os.path.join(localDIR, folder_name)
+    
+    print(f"{YELLOW}Comparing remote folder with {dest_dir}...{RESET}")
+    remote_files = list_remote_files(ssh, clusterDIR, index, filters)
+    if changed_only:
+        local_files = local_manifest(dest_dir, filters=filters)
+        changed, extraneous = compare_manifests(remote_files, local_files)
+        
+        changed_size = sum(remote_files[path][0] for path in changed)
+        print(f"{len(changed)} of {len(remote_files)} files are new or changed ({round(changed_size / (1024*1024), 2)} MB)")
+        
+        if delete and extraneous:
+            check_delete(remote_files, extraneous, clusterDIR, force_delete)
+            print(f"{YELLOW}Deleting {len(extraneous)} local files missing on the cluster...{RESET}")
+            delete_local_files(dest_dir, extraneous)
+    else:
+        changed = sorted(remote_files)
+    
+    def remaining_files():
+        if journal is None:
+            return changed
+        return [path for path in changed if not journal.is_done(path, *remote_files[path])]
+    
+    if journal is not None and len(remaining_files()) < len(changed):
+        print(f"Skipping {len(changed) - len(remaining_files())} files completed by an earlier interrupted run")
+    
+    if not remaining_files():
+        print(f"{GREEN}Local folder is already up to date.{RESET}")
+        if journal is not None:
+            journal.remove()
+        return
+    
+    def on_file(path):
+        if path in remote_files:
+            journal.mark_done(path, *remote_files[path])
+    
+    def download(ssh, paths, digests):
+        sizes = {path: remote_files[path][0] for path in paths}
+        if backend in ('scp', 'sftp'):
+            return download_file_list(ssh, localDIR, clusterDIR, paths, sizes, backend,
+                                      request_size, max_requests, on_file if journal is not None else None, digests,
+                                      adaptive)
+        if shards > 1:
+            return download_folder_sharded(ssh, localDIR, clusterDIR, shards, policy, paths, sizes,
+                                           on_file if journal is not None else None, digests)
+        download_folder_stream(ssh, localDIR, clusterDIR, paths=paths, dir_size=sum(sizes.values()),
+                               on_file=on_file if journal is not None else None, digests=digests,
+                               policy=policy, sizes=sizes)
+    
+    def transfer(ssh):
+        paths = remaining_files()
+        if store is None:
+            return download(ssh, paths, digests)
+        
+        served = set(store.fetch(ssh, clusterDIR, {path: remote_files[path] for path in paths}, dest_dir))
+        if journal is not None:
+            for path in served:
+                on_file(path)
+        paths = [path for path in paths if path not in served]
+        if paths:
+            # Files are hashed on their way in, so storing them needs no second read
+            hashes = digests if digests is not None else DigestLog(STORE_ALGORITHM)
+            download(ssh, paths, hashes)
+            store.add(clusterDIR, {path: remote_files[path] for path in paths}, dest_dir, hashes)
+    
+    if journal is not None:
+        with_reconnect(transfer, ssh, reconnect)
+        journal.remove()
+    else:
+        transfer(ssh)
+
+def download_folder(ssh, scp, localDIR, clusterDIR, stream=True, sync=False, delete=False,
+                    resume=False, reconnect=None, hostname=None, backend='auto',
+                    request_size=DEFAULT_REQUEST_SIZE, max_requests=DEFAULT_MAX_REQUESTS,
+                    verify=False, algorithm=DEFAULT_ALGORITHM, manifest=None, shards=1, compression='auto',
+                    link_rate=None, index=None, filters=None, adaptive=False, store=None, force_delete=False):
+    """Download a folder from the cluster.
+    
+    With shards > 1 the folder is streamed as that many balanced shards,
+    each compressed by its own remote tar (see download_folder_sharded).
+    compression is 'auto' or a codec from COMPRESSION_MODES; auto picks one
+    from a sample of the data and the link throughput (link_rate in bytes/s
+    if known, measured otherwise).
+    With verify=True every file received is hashed on the way to disk and
+    checked against one batched remote hash pass; mismatched files are
+    fetched again and the result is written to a manifest.
+    With index (a HostIndex) remote listings and size probes are served
+    from the local metadata cache while it is fresh.
+    filters (a TransferFilter) limits the download to matching files; the
+    remote find listing the folder prunes what is excluded.
+    With adaptive=True the scp and sftp backends fetch files over as many
+    channels as raise the throughput.
+    With store (a HostStore) unchanged files already in the local content
+    store are linked into place and only the others are downloaded, as a
+    list of files, so symlinks and empty directories aren't reproduced.
+    force_delete lets delete empty the local folder when the remote one
+    lists no files.
+    """
+    digests = DigestLog(algorithm) if verify else None
+    policy = CompressionPolicy(compression, link_rate)
+    backend_options = dict(backend=backend, request_size=request_size, max_requests=max_requests,
+                           digests=digests, shards=shards, policy=policy, index=index, filters=filters,
+                           adaptive=adaptive, store=store, force_delete=force_delete)
+    if resume:
+        journal = TransferJournal('download', hostname, localDIR, clusterDIR)
+        download_folder_sync(ssh, localDIR, clusterDIR, delete, changed_only=sync,
+                             journal=journal, reconnect=reconnect, **backend_options)
+    elif sync or backend in ('scp', 'sftp') or store is not None:
+        download_folder_sync(ssh, localDIR, clusterDIR, delete, changed_only=sync, **backend_options)
+    elif stream and shards > 1:
+        download_folder_sharded(ssh, localDIR, clusterDIR, shards, policy, digests=digests, index=index,
+                                filters=filters)
+    elif stream:
+        download_folder_stream(ssh, localDIR, clusterDIR, digests=digests, policy=policy, index=index,
+                               filters=filters)
+    else:
+        download_folder_archive(ssh, localDIR, clusterDIR, backend, request_size, max_requests, digests,
+                                filters)
+    
+    if verify:
+        if reconnect is not None and not ssh.get_transport().is_active():
+            ssh, _ = reconnect()
+        
+        def retransmit(paths):
+            if store is not None:
+                # The store took in what arrived first; the refetched files are stored on the next run
+                store.forget(clusterDIR, paths)
+            if backend in ('scp', 'sftp'):
+                sizes = {path: digests.files[path][0] for path in paths}
+                download_file_list(ssh, localDIR, clusterDIR, paths, sizes, backend,
+                                   request_size, max_requests, digests=digests, adaptive=adaptive)
+            else:
+                sizes = {path: digests.files[path][0] for path in paths}
+                download_folder_stream(ssh, localDIR, clusterDIR, paths=paths, dir_size=sum(sizes.values()),
+                                       digests=digests, policy=policy, sizes=sizes)
+        
+        return verify_and_record(ssh, clusterDIR, digests, retransmit, 'download', localDIR, manifest)
+
+def download_folder_archive(ssh, localDIR, clusterDIR, backend='auto', request_size=DEFAULT_REQUEST_SIZE,
+                            max_requests=DEFAULT_MAX_REQUESTS, digests=None, filters=None):
+    """Download a folder through a temporary archive built on the cluster, then extract it.
+    
+    With a TransferFilter only the files a filtered remote find lists are archived.
+    """
     # Create a temporary directory for receiving the tgz file
     temp_dir = tempfile.mkdtemp()
     temp_archive = os.path.join(temp_dir, "archive.tgz")
@@ -65,80 +733,90 @@ def download_folder(ssh, scp, localDIR, clusterDIR):
         # Get the last folder name from the path
         folder_name = os.path.basename(clusterDIR.rstrip('/'))
         print(f"{YELLOW}Preparing remote folder for download...{RESET}")
+        metrics = TransferMetrics('Extracting', 0, 0, name=folder_name, direction='download')
+        metrics.record_rtt(measure_rtt(ssh))
         
         # Check directory size first to estimate progress
-        size_cmd = f"du -sb {clusterDIR} | cut -f1"
-        stdin, stdout, stderr = ssh.exec_command(size_cmd)
-        dir_size_output = stdout.read().decode().strip()
-        try:
-            dir_size = int(dir_size_output)
-            print(f"Remote directory size: {round(dir_size / (1024*1024), 2)} MB")
-        except ValueError:
-            print(f"Could not determine directory size: {dir_size_output}")
-            dir_size = 0
-        
-        # Create tar archive on remote server
-        print(f"{YELLOW}Creating archive of {folder_name}...{RESET}")
-        tar_command = f"cd {os.path.dirname(clusterDIR)} && tar -czf /tmp/temp_archive.tgz {folder_name}"
-        
-        # Start the tar command
-        stdin, stdout, stderr = ssh.exec_command(tar_command)
-        
-        # Instead of a tqdm progress bar, use a simpler animation
-        print("Creating archive: ", end="", flush=True)
-        spinner = ['⠋', '⠙', '⠹', '⠸', '⠼', '⠴', '⠦', '⠧', '⠇', '⠏']
-        i = 0
-        while not stdout.channel.exit_status_ready():
-            print(f"\rCreating archive: {spinner[i % len(spinner)]}", end="", flush=True)
-            time.sleep(0.1)
-            i += 1
-        
-        # Get the exit status after the command completes
-        exit_status = stdout.channel.recv_exit_status()
-        print("\rCreating archive: Done!          ")
-        
-        if exit_status != 0:
-            error = stderr.read().decode()
-            print(f"{RED}Error creating archive: {error}{RESET}")
-            raise Exception(f"Failed to create archive: {error}")
-        
-        # Get archive size
-        stdin, stdout, stderr = ssh.exec_command("stat -c %s /tmp/temp_archive.tgz")
-        try:
-            archive_size = int(stdout.read().decode().strip())
-            print(f"Archive size: {round(archive_size / (1024*1024), 2)} MB")
-        except (ValueError, IndexError):
-            # If we can't get the size, continue anyway
-            print("Could not determine archive size")
+        metrics.phase('size_probe')
+        if filters:
+            metrics.total_bytes = sum(size for size, mtime in remote_manifest(ssh, clusterDIR, filters).values())
+        else:
+            metrics.total_bytes = get_remote_size(ssh, clusterDIR)
         
-        # Download the archive
-        print(f"{YELLOW}Downloading archive...{RESET}")
-        scp.get("/tmp/temp_archive.tgz", temp_archive)
+        # Use a unique remote archive name so concurrent downloads don't collide
+        stdin, stdout, stderr = ssh.exec_command("mktemp /tmp/clustertools_XXXXXXXX.tgz")
+        remote_archive = stdout.read().decode().strip()
+        if stdout.channel.recv_exit_status() != 0 or not remote_archive:
+            raise Exception(f"Failed to create remote temporary file: {stderr.read().decode()}")
         
-        # Clean up remote temp file
-        ssh.exec_command("rm /tmp/temp_archive.tgz")
+        try:
+            # Create tar archive on remote server
+            metrics.phase('archive')
+            print(f"{YELLOW}Creating archive of {folder_name}...{RESET}")
+            tar_command = f"cd {shlex.quote(os.path.dirname(clusterDIR))} && tar -czf {remote_archive} {shlex.quote(folder_name)}"
+            if filters:
+                # Archive only what the filtered find lists
+                find_command = filters.find_command(folder_name, 'fl', '%p\\0')
+                tar_command = (f"cd {shlex.quote(os.path.dirname(clusterDIR))} && "
+                               f"{find_command} | tar -czf {remote_archive} --null -T -")
+            
+            # Start the tar command and wait for it to finish
+            stdin, stdout, stderr = ssh.exec_command(tar_command)
+            exit_status = stdout.channel.recv_exit_status()
+            
+            if exit_status != 0:
+                error = stderr.read().decode()
+                print(f"{RED}Error creating archive: {error}{RESET}")
+                raise Exception(f"Failed to create archive: {error}")
+            
+            # Get archive size
+            stdin, stdout, stderr = ssh.exec_command(f"stat -c %s {remote_archive}")
+            try:
+                archive_size = int(stdout.read().decode().strip())
+                print(f"Archive size: {round(archive_size / (1024*1024), 2)} MB")
+            except (ValueError, IndexError):
+                # If we can't get the size, continue anyway
+                print("Could not determine archive size")
+                archive_size = 0
+            
+            # Download the archive
+            metrics.phase('transfer')
+            print(f"{YELLOW}Downloading archive...{RESET}")
+            name = choose_backend(archive_size, backend)
+            transfer = make_backend(name, ssh, request_size, max_requests)
+            try:
+                if name == 'scp':
+                    transfer.download(remote_archive, temp_archive)
+                else:
+                    transfer.download(remote_archive, temp_archive,
+                                      lambda sent, size: progress(os.path.basename(remote_archive), size, sent))
+            finally:
+                transfer.close()
+        finally:
+            # Clean up remote temp file, also when the archive or download failed
+            stdin, stdout, stderr = ssh.exec_command(f"rm -f {remote_archive}")
+            stdout.channel.recv_exit_status()
         
         # Extract archive to destination with progress bar
         dest_dir = os.path.join(localDIR, folder_name)
         os.makedirs(dest_dir, exist_ok=True)
         
         print(f"{YELLOW}Extracting archive to {dest_dir}...{RESET}")
-        import tarfile
+        metrics.phase('extract')
         
-        # Count files in the archive
-        with tarfile.open(temp_archive, "r:gz") as tar:
-            members = tar.getmembers()
-            total_files = len(members)
-            
-            print(f"Extracting {total_files} files...")
-            
-            # Extract files with a simple counter instead of tqdm
-            for i, member in enumerate(members, 1):
-                if i % 100 == 0 or i == total_files:  # Update every 100 files or on the last file
-                    print(f"\rExtracting: {i}/{total_files} files ({(i/total_files)*100:.1f}%)", end="", flush=True)
-                tar.extract(member, path=localDIR)
-            
-            print("\rExtraction complete!                       ")
+        # Extract member by member without building the full member list
+        with tarfile.open(temp_archive, "r|gz") as tar:
+            for member in tar:
+                digest = digests.new() if digests is not None and member.isfile() else None
+                extract_member(tar, member, localDIR, digest)
+                tar.members = []
+                if member.isfile():
+                    if digest is not None:
+                        digests.add(os.path.relpath(member.name, folder_name), member.size, digest)
+                    metrics.add_bytes(member.size)
+                    metrics.file_done(member.name, member.size)
+        metrics.finish()
+        print(f"Extraction complete: {metrics.files} files")
         
         print(f'{GREEN}Folder {folder_name} download complete.{RESET}')
         
@@ -146,33 +824,47 @@ def download_folder(ssh, scp, localDIR, clusterDIR):
         # Clean up temp directory
         shutil.rmtree(temp_dir)
 
-def cluster2local(localDIR, clusterDIR, filename=None, username=None, password=None, hostname=None):
-    # Use get_ssh_connection instead of login2ssh
-    ssh, scp = get_ssh_connection(username, password, hostname)
+def cluster2local(localDIR, clusterDIR, filename=None, username=None, password=None, hostname=None, stream=True, sync=False, delete=False,
+                  delta=False, block_size=DEFAULT_BLOCK_SIZE, resume=False, backend='auto',
+                  request_size=DEFAULT_REQUEST_SIZE, max_requests=DEFAULT_MAX_REQUESTS, stripes=1,
+                  verify=False, algorithm=DEFAULT_ALGORITHM, manifest=None, shards=1, compression='auto',
+                  link_speed=None, cache=None, filters=None, tune=False, bwlimit=None, store=None,
+                  store_size=DEFAULT_MAX_SIZE, store_key='stat', store_link='auto', force_delete=False):
+    limiter = bandwidth_limiter(bwlimit * 125000 if bwlimit else None)
+    def connect():
+        # Use get_ssh_connection instead of login2ssh
+        ssh, scp = get_ssh_connection(username, password, hostname)
+        settings = None
+        if tune:
+            settings = tune_connection(ssh, 'download', link_speed * 125000 if link_speed else None, request_size)
+        # The cap applies to this transfer only, not to the shared connection
+        ssh = limit_rate(ssh, limiter)
+        return ssh, scp, settings
+    
+    def reconnect():
+        ssh, scp, settings = connect()
+        return ssh, scp
+    
+    ssh, scp, settings = connect()
+    if settings is not None:
+        # The sftp backend keeps enough reads in flight to fill the window
+        max_requests = max(max_requests, settings.max_requests)
+    
+    content_store = open_store(store, hostname, ssh, store_size, store_key, store_link)
     try:
         if filename:
-            download_file(scp, localDIR, clusterDIR, filename)
+            return download_file(scp, localDIR, clusterDIR, filename, ssh, delta, block_size, resume, reconnect,
+                                 backend, request_size, max_requests, stripes, verify, algorithm, manifest,
+                                 content_store)
         else:
-            download_folder(ssh, scp, localDIR, clusterDIR)
+            return download_folder(ssh, scp, localDIR, clusterDIR, stream, sync, delete, resume, reconnect, hostname,
+                                   backend, request_size, max_requests, verify, algorithm, manifest, shards, compression,
+                                   link_speed * 125000 if link_speed else None, open_index(cache, hostname, ssh),
+                                   as_filter(filters), adaptive=tune, store=content_store, force_delete=force_delete)
     finally:
         # Don't close the connection here, just print completion message
         print(f'{GREEN}Operation complete.{RESET}')
 
-# Add a new function to explicitly close the connection when needed
-def close_ssh_connection():
-    """Close the global SSH connection if it exists."""
-    global global_ssh, global_scp
-    if global_ssh is not None:
-        try:
-            global_scp.close()
-            global_ssh.close()
-            print(f"{GREEN}SSH connection closed{RESET}")
-        except Exception as e:
-            print(f"{RED}Error closing SSH connection: {str(e)}{RESET}")
-        finally:
-            global_ssh = None
-            global_scp = None
-
 def main():
     parser = argparse.ArgumentParser(description='Transfer files/folders from cluster server to local machine')
     parser.add_argument('-l', '--local_dir', required=True, help='Local directory path')
@@ -181,11 +873,68 @@ def main():
     parser.add_argument('--username', help='Username for FMRIB cluster', default=None)
     parser.add_argument('--password', help='Password for FMRIB cluster', default=None)
     parser.add_argument('--host', help='Destination hostname', default='clint.fmrib.ox.ac.uk')
+    parser.add_argument('--no-stream', dest='stream', action='store_false',
+                        help='Build a temporary archive on the cluster instead of streaming tar output')
+    parser.add_argument('--sync', action='store_true', help='Only download files that are new or changed locally')
+    parser.add_argument('--delete', action='store_true', help='With --sync, delete local files that no longer exist on the cluster')
+    parser.add_argument('--force-delete', action='store_true',
+                        help='Let --delete empty the local folder when the cluster folder lists no files')
+    parser.add_argument('--delta', action='store_true', help='Receive only the changed blocks of a single file (-f)')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Block size in bytes for --delta (default: 64 KiB)')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted download and reconnect automatically if the connection drops')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default='auto',
+                        help='Transfer backend; auto picks one from the file size, folders use a tar stream (default: auto)')
+    parser.add_argument('--request-size', type=int, default=DEFAULT_REQUEST_SIZE,
+                        help='Bytes per SFTP read request for the sftp backend (default: 32768)')
+    parser.add_argument('--max-requests', type=int, default=DEFAULT_MAX_REQUESTS,
+                        help='SFTP read requests kept in flight for the sftp backend (default: 128)')
+    parser.add_argument('--stripes', type=int, default=1,
+                        help='Fetch a single large file (-f) as this many byte ranges at once (default: 1)')
+    parser.add_argument('--progress', choices=PROGRESS_MODES, default='bar',
+                        help='Progress output: terminal bar, JSON lines on stderr, or none (default: bar)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Hash files as they arrive, check them against the cluster copies and refetch mismatches')
+    parser.add_argument('--verify-algorithm', choices=ALGORITHMS, default=DEFAULT_ALGORITHM,
+                        help='Hash used by --verify; xxh128 needs the xxhash package and xxhsum on the cluster (default: sha256)')
+    parser.add_argument('--manifest', default=None,
+                        help='Where --verify writes its manifest (default: ~/.cache/clustertools/manifests)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Stream a folder as this many balanced, concurrently compressed shards (default: 1)')
+    parser.add_argument('--compression', choices=COMPRESSION_MODES, default='auto',
+                        help='Codec for folder streams; auto picks one from a data sample and the link speed (default: auto)')
+    parser.add_argument('--link-speed', type=float, default=None,
+                        help='Link throughput in Mbit/s used by --compression auto instead of measuring it')
+    parser.add_argument('--cache', type=float, nargs='?', const=DEFAULT_TTL, default=None, metavar='SECONDS',
+                        help=f'Answer remote listings from the local metadata cache, trusting it for SECONDS '
+                             f'before refreshing it (default when given: {DEFAULT_TTL})')
+    parser.add_argument('--tune', action='store_true',
+                        help='Measure RTT and throughput, size channel windows to the bandwidth-delay product '
+                             'and adjust the parallel channels of the scp/sftp backends to the throughput')
+    parser.add_argument('--bwlimit', type=float, default=None, metavar='MBIT',
+                        help='Cap the transfer at this many Mbit/s')
+    parser.add_argument('--store', nargs='?', const=STORE_DIR, default=None, metavar='DIR',
+                        help=f'Serve unchanged files from a local content cache and add downloaded ones to it '
+                             f'(default when given: {STORE_DIR})')
+    parser.add_argument('--store-size', type=parse_size, default=DEFAULT_MAX_SIZE, metavar='SIZE',
+                        help='Evict the least recently used cached contents beyond this size (default: 20G)')
+    parser.add_argument('--store-key', choices=KEY_MODES, default='stat',
+                        help='Recognise cached files by remote path, size and mtime, or also by a hash '
+                             'computed on the cluster (default: stat)')
+    parser.add_argument('--store-link', choices=LINK_MODES, default='auto',
+                        help='How cached files are placed: reflink, hardlink or copy; auto tries them in turn (default: auto)')
+    add_filter_arguments(parser)
     
     args = parser.parse_args()
+    set_progress_output(args.progress)
     
     try:
-        cluster2local(args.local_dir, args.cluster_dir, args.filename, args.username, args.password, args.host)
+        cluster2local(args.local_dir, args.cluster_dir, args.filename, args.username, args.password, args.host, args.stream, args.sync, args.delete,
+                      args.delta, args.block_size, args.resume,
+                      args.backend, args.request_size, args.max_requests, args.stripes,
+                      args.verify, args.verify_algorithm, args.manifest, args.shards,
+                      args.compression, args.link_speed, args.cache, filter_from_args(args),
+                      args.tune, args.bwlimit, args.store, args.store_size, args.store_key, args.store_link,
+                      args.force_delete)
     finally:
         close_ssh_connection()
 
@@ -0,0 +1,475 @@
+"""Compression policy for tar streams: none, lz4, zstd or gzip.
+
+Files whose extension marks them as already compressed (.nii.gz, .npz,
+.h5, images, archives...) are never compressed again. For the rest the
+policy samples how well the data compresses, compares the measured link
+throughput with how fast each codec runs, and picks the codec that gets
+the data across soonest, or none when compressing wouldn't pay off. A
+CompressionReport adds up the bytes saved and the local CPU time spent.
+"""
+import gzip
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import weakref
+import zlib
+
+from clustertools.metrics import measure_rtt
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+CODECS = ['none', 'lz4', 'zstd', 'gzip']
+COMPRESSION_MODES = ['auto'] + CODECS
+
+PRECOMPRESSED_EXTENSIONS = (
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.zip', '.7z', '.rar',
+    '.npz', '.h5', '.hdf5', '.mat', '.parquet', '.sif',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.tif.gz', '.mp4', '.mkv', '.avi', '.mov', '.mp3', '.flac', '.ogg',
+)
+
+# Compressibility is sampled from the start of this many files
+SAMPLE_FILES = 16
+SAMPLE_BYTES = 64 * 1024
+
+# Bytes sent or received to measure link throughput
+LINK_PROBE_BYTES = 1024 * 1024
+
+# Compressing must make the transfer at least this much faster to be used
+MIN_GAIN = 1.1
+
+# Ratio and speed of each codec relative to gzip -1, which is what samples
+# are measured with, and whether it runs on several cores
+CODEC_PROFILES = {
+    'lz4': (1.3, 5.0, False),
+    'zstd': (0.85, 2.0, True),
+    'gzip': (0.93, 0.35, True),
+}
+
+# gzip -1 throughput of one core assumed for the cluster, where it isn't measured
+REMOTE_GZIP_SPEED = 50 * 1024 * 1024
+
+CHUNK_SIZE = 1024 * 1024
+
+# Measured link throughput in bytes/s, per connection transport and direction
+link_rates = weakref.WeakKeyDictionary()
+
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+def is_precompressed(path):
+    return path.lower().endswith(PRECOMPRESSED_EXTENSIONS)
+
+def local_codecs():
+    """Codecs that can be run here, in-process or through a command."""
+    codecs = {'none', 'gzip'}
+    if zstandard is not None or shutil.which('zstd'):
+        codecs.add('zstd')
+    if lz4frame is not None or shutil.which('lz4'):
+        codecs.add('lz4')
+    return codecs
+
+def probe_remote(ssh):
+    """Return (cpu_count, set of available compressors) of the remote host with one exec."""
+    command = "nproc 2>/dev/null || echo 1; for c in zstd pigz lz4; do command -v $c >/dev/null 2>&1 && echo $c; done"
+    stdin, stdout, stderr = ssh.exec_command(command)
+    lines = stdout.read().decode().split()
+    stdout.channel.recv_exit_status()
+    try:
+        cpus = int(lines[0])
+    except (IndexError, ValueError):
+        cpus = 1
+    return cpus, set(lines[1:]) | {'none', 'gzip'}
+
+def measure_link_rate(ssh, direction):
+    """Measure throughput in bytes/s of the link in one direction ('upload' or 'download').
+
+    LINK_PROBE_BYTES are pushed through a remote `cat` or `head`; the result
+    is cached for the connection.
+    """
+    transport = ssh.get_transport()
+    rates = link_rates.setdefault(transport, {})
+    if direction in rates:
+        return rates[direction]
+
+    # One round trip goes to starting the command rather than moving data;
+    # a broker's transport can't time one, so none is subtracted there
+    rtt = measure_rtt(ssh) or 0.0
+
+    channel = transport.open_session()
+    start = time.time()
+    try:
+        if direction == 'upload':
+            channel.exec_command("cat > /dev/null")
+            block = bytes(64 * 1024)
+            for _ in range(LINK_PROBE_BYTES // len(block)):
+                channel.sendall(block)
+            channel.shutdown_write()
+            channel.recv_exit_status()
+        else:
+            channel.exec_command(f"head -c {LINK_PROBE_BYTES} /dev/zero")
+            reader = channel.makefile('rb')
+            while reader.read(CHUNK_SIZE):
+                pass
+    finally:
+        channel.close()
+    elapsed = max(time.time() - start - rtt, 1e-3)
+    rates[direction] = LINK_PROBE_BYTES / elapsed
+    return rates[direction]
+
+def sample_local(paths):
+    """Compress the start of up to SAMPLE_FILES local files with gzip -1.
+
+    Returns (ratio, bytes per second of one core), or (1.0, None) if there
+    was nothing to sample.
+    """
+    step = max(1, len(paths) // SAMPLE_FILES)
+    raw = packed = 0
+    cpu = 0.0
+    for path in paths[::step][:SAMPLE_FILES]:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read(SAMPLE_BYTES)
+        except OSError:
+            continue
+        start = thread_time()
+        packed += len(zlib.compress(data, 1))
+        cpu += thread_time() - start
+        raw += len(data)
+    if not raw:
+        return 1.0, None
+    return packed / raw, raw / max(cpu, 1e-6)
+
+def sample_remote(ssh, root, paths):
+    """Compress the start of up to SAMPLE_FILES remote files with gzip -1 on the cluster.
+
+    Returns the compressed/raw ratio, 1.0 if there was nothing to sample.
+    """
+    step = max(1, len(paths) // SAMPLE_FILES)
+    sample = paths[::step][:SAMPLE_FILES]
+    if not sample:
+        return 1.0
+    script = (f"head -c {SAMPLE_BYTES} -- \"$1\" | wc -c; "
+              f"head -c {SAMPLE_BYTES} -- \"$1\" | gzip -1 -c | wc -c")
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(f"cd {shlex.quote(root)} && xargs -0 -r -n1 sh -c {shlex.quote(script)} _")
+    try:
+        channel.sendall(b''.join(path.encode('utf-8', 'surrogateescape') + b'\0' for path in sample))
+        channel.shutdown_write()
+        output = channel.makefile('rb').read().decode().split()
+        channel.recv_exit_status()
+    finally:
+        channel.close()
+    counts = [int(n) for n in output if n.isdigit()]
+    raw = sum(counts[0::2])
+    packed = sum(counts[1::2])
+    return packed / raw if raw else 1.0
+
+def choose_codec(ratio, speed, link_rate, available, threads=1):
+    """Pick the codec that moves data fastest: min(codec speed, link rate / codec ratio).
+
+    ratio and speed describe gzip -1 on a sample; CODEC_PROFILES scales them
+    for the other codecs. Returns 'none' unless a codec is MIN_GAIN faster
+    than sending the data as it is.
+    """
+    best, best_rate = 'none', link_rate * MIN_GAIN
+    for codec in CODECS[1:]:
+        if codec not in available:
+            continue
+        ratio_factor, speed_factor, parallel = CODEC_PROFILES[codec]
+        codec_speed = speed * speed_factor * (threads if parallel else 1)
+        rate = min(codec_speed, link_rate / min(1.0, ratio * ratio_factor))
+        if rate > best_rate:
+            best, best_rate = codec, rate
+    return best
+
+def tar_compress_option(codec, threads=1, available=()):
+    """Return the tar option compressing (or, with -x, decompressing) through codec."""
+    if codec == 'none':
+        return ''
+    if codec == 'gzip':
+        if 'pigz' in available:
+            return f" --use-compress-program={shlex.quote(f'pigz -p {threads}')}"
+        return ' -z'
+    if codec == 'zstd':
+        return f" --use-compress-program={shlex.quote(f'zstd -q -T{threads}')}"
+    return f" --use-compress-program={shlex.quote('lz4 -q')}"
+
+class CountingReader:
+    """File-like wrapper that counts the bytes read through it, paced by an optional RateLimiter."""
+
+    def __init__(self, fileobj, limiter=None):
+        self.fileobj = fileobj
+        self.limiter = limiter
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        if self.limiter is not None and data:
+            self.limiter.throttle(len(data))
+        return data
+
+def wait_with_cpu(proc):
+    """Wait for a process and return the CPU seconds it used."""
+    try:
+        pid, status, usage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        proc.wait()
+        return 0.0
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return usage.ru_utime + usage.ru_stime
+
+class DecompressingReader:
+    """Decompress codec data read from fileobj, counting wire bytes, raw bytes and local CPU time.
+
+    zstd and lz4 use the zstandard or lz4 packages when installed and the
+    zstd or lz4 commands otherwise. With a limiter (see clustertools.tuning)
+    wire bytes are read no faster than its rate.
+    """
+
+    def __init__(self, fileobj, codec, limiter=None):
+        self.codec = codec
+        self.source = CountingReader(fileobj, limiter)
+        self.raw_bytes = 0
+        self.cpu_seconds = 0.0
+        self.proc = None
+        self.error = None
+        if codec == 'none':
+            self.stream = self.source
+        elif codec == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.source, mode='rb')
+        elif codec == 'zstd' and zstandard is not None:
+            self.stream = zstandard.ZstdDecompressor().stream_reader(self.source)
+        elif codec == 'lz4' and lz4frame is not None:
+            self.stream = lz4frame.LZ4FrameFile(self.source, mode='rb')
+        else:
+            self.proc = subprocess.Popen([codec, '-d', '-c', '-q'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.stream = self.proc.stdout
+            self._thread = threading.Thread(target=self._feed, daemon=True)
+            self._thread.start()
+
+    @property
+    def wire_bytes(self):
+        return self.source.bytes_read
+
+    def _feed(self):
+        try:
+            while True:
+                data = self.source.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.proc.stdin.write(data)
+        except Exception as e:
+            self.error = e
+        finally:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+
+    def read(self, size=-1):
+        start = thread_time()
+        data = self.stream.read(size)
+        self.cpu_seconds += thread_time() - start
+        self.raw_bytes += len(data)
+        if not data and self.proc is not None and self.proc.returncode is None:
+            self._thread.join()
+            if self.error is not None:
+                raise self.error
+            self.cpu_seconds += wait_with_cpu(self.proc)
+            if self.proc.returncode != 0:
+                raise EOFError(f"{self.codec} could not decompress the stream")
+        return data
+
+    def close(self):
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.stdout.close()
+            self.proc.kill()
+            self.cpu_seconds += wait_with_cpu(self.proc)
+
+class CompressingWriter:
+    """Compress data written to it into fileobj, counting raw bytes, wire bytes and CPU time.
+
+    close() flushes the codec but leaves fileobj open. With a limiter wire
+    bytes are written no faster than its rate.
+    """
+
+    def __init__(self, fileobj, codec, threads=1, limiter=None):
+        self.fileobj = fileobj
+        self.limiter = limiter
+        self.codec = codec
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+        self.compressor = None
+        self.proc = None
+        self.error = None
+        if codec == 'gzip':
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif codec == 'zstd' and zstandard is not None:
+            self.compressor = zstandard.ZstdCompressor(level=3, threads=threads if threads > 1 else 0).compressobj()
+        elif codec == 'lz4' and lz4frame is not None:
+            self.compressor = lz4frame.LZ4FrameCompressor()
+            self._send(self.compressor.begin())
+        elif codec in ('zstd', 'lz4'):
+            args = ['zstd', '-q', '-c', f'-T{threads}'] if codec == 'zstd' else ['lz4', '-q', '-c']
+            self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+
+    def _send(self, data):
+        if data:
+            if self.limiter is not None:
+                self.limiter.throttle(len(data))
+            self.fileobj.write(data)
+            self.wire_bytes += len(data)
+
+    def _drain(self):
+        try:
+            for data in iter(lambda: self.proc.stdout.read1(CHUNK_SIZE), b''):
+                self._send(data)
+        except Exception as e:
+            self.error = e
+            self.proc.kill()
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        if self.proc is not None:
+            self.proc.stdin.write(data)
+        elif self.compressor is not None:
+            start = thread_time()
+            packed = self.compressor.compress(data)
+            self.cpu_seconds += thread_time() - start
+            self._send(packed)
+        else:
+            self._send(data)
+        return len(data)
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self._thread.join()
+            self.cpu_seconds += wait_with_cpu(self.proc)
+            if self.error is not None:
+                raise self.error
+            if self.proc.returncode != 0:
+                raise Exception(f"{self.codec} failed to compress the stream")
+        elif self.compressor is not None:
+            start = thread_time()
+            packed = self.compressor.flush()
+            self.cpu_seconds += thread_time() - start
+            self._send(packed)
+
+class CompressionReport:
+    """Bytes before and after compression and local CPU seconds, per codec."""
+
+    def __init__(self):
+        self.codecs = {}
+        self._lock = threading.Lock()
+
+    def add(self, codec, raw_bytes, wire_bytes, cpu_seconds):
+        with self._lock:
+            raw, wire, cpu = self.codecs.get(codec, (0, 0, 0.0))
+            self.codecs[codec] = (raw + raw_bytes, wire + wire_bytes, cpu + cpu_seconds)
+
+    def print_summary(self, work='compression'):
+        """Print one line per codec; work names what the local CPU did ('compression' or 'decompression')."""
+        for codec, (raw, wire, cpu) in sorted(self.codecs.items()):
+            if codec == 'none' or not raw:
+                continue
+            saved = raw - wire
+            print(f"Compression ({codec}): {round(raw/(1024*1024), 2)} MB sent as {round(wire/(1024*1024), 2)} MB, "
+                  f"saved {round(saved/(1024*1024), 2)} MB ({int(saved / raw * 100)}%) for {cpu:.2f}s of local {work} CPU")
+
+class CompressionPolicy:
+    """Chooses the codec of every tar stream of one transfer.
+
+    mode is 'auto' or a codec name, which is then used for every stream.
+    In auto mode decide_upload/decide_download pick the codec for data that
+    isn't already compressed; codec_for() gives 'none' for streams made of
+    already-compressed files. link_rate (bytes/s) skips measuring the link.
+    """
+
+    def __init__(self, mode='auto', link_rate=None):
+        self.mode = mode
+        self.link_rate = link_rate
+        self.codec = 'none' if mode == 'auto' else mode
+        self.available = {'none', 'gzip'}
+        self.threads = 1
+        self.report = CompressionReport()
+
+    def _check_forced(self, available):
+        self.available = available
+        if self.mode != 'auto' and self.mode not in available:
+            print(f"{YELLOW}{self.mode} is not available on both ends, using gzip{RESET}")
+            self.codec = 'gzip'
+
+    def decide_upload(self, ssh, local_paths, streams=1):
+        """Choose the codec for compressing local files from a local sample.
+
+        The local cores are shared between streams concurrent compressors.
+        """
+        cpus, remote = probe_remote(ssh)
+        self.threads = max(1, (os.cpu_count() or 1) // streams)
+        self._check_forced(local_codecs() & remote)
+        if self.mode != 'auto':
+            return self.codec
+        compressible = [path for path in local_paths if not is_precompressed(path)]
+        ratio, speed = sample_local(compressible)
+        if speed is None:
+            return self.codec
+        link_rate = self.link_rate or measure_link_rate(ssh, 'upload')
+        self.codec = choose_codec(ratio, speed, link_rate, self.available, self.threads)
+        self._print_decision(ratio, link_rate)
+        return self.codec
+
+    def decide_download(self, ssh, root, sizes, streams=1):
+        """Choose the codec the cluster compresses with, from a remote sample.
+
+        sizes maps paths relative to root to their size; the remote cores are
+        shared between streams concurrent compressors.
+        """
+        cpus, remote = probe_remote(ssh)
+        self.threads = max(1, cpus // streams)
+        self._check_forced(local_codecs() & remote)
+        if 'pigz' in remote:
+            self.available.add('pigz')
+        if self.mode != 'auto':
+            return self.codec
+        compressible = sorted(path for path in sizes if not is_precompressed(path) and sizes[path] > 0)
+        if not compressible:
+            return self.codec
+        ratio = sample_remote(ssh, root, compressible)
+        link_rate = self.link_rate or measure_link_rate(ssh, 'download')
+        self.codec = choose_codec(ratio, REMOTE_GZIP_SPEED, link_rate, self.available, self.threads)
+        self._print_decision(ratio, link_rate)
+        return self.codec
+
+    def _print_decision(self, ratio, link_rate):
+        print(f"Compression: {self.codec} (sample compresses to {ratio * 100:.1f}% with gzip -1, "
+              f"link {round(link_rate * 8 / 1e6, 1)} Mbit/s)")
+
+    def codec_for(self, paths):
+        """Codec for a stream of these files; 'none' if they are all already compressed."""
+        if self.mode == 'auto' and all(is_precompressed(path) for path in paths):
+            return 'none'
+        return self.codec
+
+    def tar_option(self, codec):
+        return tar_compress_option(codec, self.threads, self.available)
@@ -0,0 +1,86 @@
+import threading
+
+from scp import SCPClient
+from clustertools.login import login2ssh, progress
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+# Seconds between SSH keepalive packets on connections we create
+KEEPALIVE_INTERVAL = 30
+
+# Open connections, keyed by hostname
+connections = {}
+# Held while a connection is looked up or created, so concurrent transfers
+# to one host share a single login
+connections_lock = threading.RLock()
+
+def is_connection_alive(ssh):
+    """Check a connection through its transport state, without an exec round trip."""
+    try:
+        transport = ssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        # Cheap one-way packet; raises if the socket underneath is gone
+        if hasattr(transport, 'send_ignore'):
+            transport.send_ignore()
+        return True
+    except Exception:
+        return False
+
+def get_ssh_connection(username=None, password=None, hostname=None, use_broker=True):
+    """Get an SSH connection to hostname, reusing an existing one if available.
+
+    An open connection from this process is reused first, then a running
+    connection broker for the host (see clustertools.broker), and only then
+    is a new connection authenticated with login2ssh. Safe to call from
+    several threads; they share the connection.
+    """
+    with connections_lock:
+        return _get_ssh_connection(username, password, hostname, use_broker)
+
+def _get_ssh_connection(username, password, hostname, use_broker):
+    cached = connections.get(hostname)
+    if cached is not None:
+        if is_connection_alive(cached[0]):
+            print(f"{GREEN}Using existing SSH connection{RESET}")
+            return cached
+        # Connection is no longer active, close it and create a new one
+        close_ssh_connection(hostname, quiet=True)
+
+    if use_broker:
+        from clustertools.broker import connect_broker
+        ssh = connect_broker(hostname)
+        if ssh is not None:
+            print(f"{GREEN}Using connection broker for {hostname}{RESET}")
+            scp = SCPClient(ssh.get_transport(), progress=progress)
+            connections[hostname] = (ssh, scp)
+            return ssh, scp
+
+    # Create a new connection
+    ssh, scp = login2ssh(username, password, hostname)
+    ssh.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+    connections[hostname] = (ssh, scp)
+    return ssh, scp
+
+def close_ssh_connection(hostname=None, quiet=False):
+    """Close the connection to hostname, or every open connection if hostname is None.
+
+    Connections handed out by a broker are only detached; the broker keeps
+    its authenticated session for later invocations.
+    """
+    with connections_lock:
+        hostnames = list(connections) if hostname is None else [hostname]
+        closing = [connections.pop(name) for name in hostnames if name in connections]
+    for ssh, scp in closing:
+        try:
+            scp.close()
+            ssh.close()
+            if not quiet:
+                print(f"{GREEN}SSH connection closed{RESET}")
+        except Exception as e:
+            if not quiet:
+                print(f"{RED}Error closing SSH connection: {str(e)}{RESET}")
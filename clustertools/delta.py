@@ -0,0 +1,336 @@
+import hashlib
+import inspect
+import os
+import shlex
+import struct
+import sys
+import zlib
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+
+# The functions below run both locally and, shipped as source, on the cluster
+# through `python3 -c`, so they may only use the standard library and must not
+# refer to anything else defined in this module.
+
+def block_signatures(f, block_size):
+    """Return [(weak, strong)] checksums for each block of a file object."""
+    signatures = []
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return signatures
+        signatures.append((zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest()))
+
+def encode_signatures(signatures):
+    return b''.join(struct.pack('>I16s', weak, strong) for weak, strong in signatures)
+
+def decode_signatures(data):
+    return [struct.unpack_from('>I16s', data, i) for i in range(0, len(data) - 19, 20)]
+
+def compute_delta(f, signatures, block_size, write, mtime=0.0):
+    """Write instructions that turn the signed basis file into the contents of f.
+
+    Blocks are matched at any byte offset with a rolling Adler-32 checksum
+    confirmed by BLAKE2b, as rsync does. Rolling runs in pure Python, so after
+    16 blocks without a match the search mostly takes whole-block steps, and
+    rolls through one block in every eight so it finds the basis again at any
+    alignment. Ops are b'C' (copy a run of basis
+    blocks), b'L' (literal bytes) and a final b'E' carrying the SHA-256 and
+    mtime of the result. Returns (literal_bytes, copied_bytes).
+    """
+    index = {}
+    for i, (weak, strong) in enumerate(signatures):
+        index.setdefault(weak, []).append((strong, i))
+
+    modulus = 65521
+    sha = hashlib.sha256()
+    buf = b''
+    pos = 0
+    eof = False
+    literal = bytearray()
+    copy_start = copy_count = 0
+    literal_total = copied_total = 0
+    unmatched = 0
+    skipped = rolling = 0
+    weak = None
+
+    def flush_literal():
+        if literal:
+            write(b'L' + struct.pack('>I', len(literal)) + bytes(literal))
+            del literal[:]
+
+    def flush_copy():
+        if copy_count:
+            write(b'C' + struct.pack('>QI', copy_start, copy_count))
+
+    while True:
+        # Keep at least one full window buffered ahead of pos
+        while not eof and len(buf) - pos < block_size:
+            chunk = f.read(max(4 * block_size, 1024 * 1024))
+            if not chunk:
+                eof = True
+                break
+            sha.update(chunk)
+            buf = buf[pos:] + chunk
+            pos = 0
+
+        avail = len(buf) - pos
+        if avail == 0:
+            break
+
+        window = min(avail, block_size)
+        if weak is None:
+            weak = zlib.adler32(buf[pos:pos + window])
+
+        match = None
+        candidates = index.get(weak)
+        if candidates:
+            strong = hashlib.blake2b(buf[pos:pos + window], digest_size=16).digest()
+            for candidate, i in candidates:
+                if candidate == strong:
+                    match = i
+                    break
+
+        if match is not None:
+            flush_literal()
+            if copy_count and match == copy_start + copy_count:
+                copy_count += 1
+            else:
+                flush_copy()
+                copy_start, copy_count = match, 1
+            copied_total += window
+            pos += window
+            unmatched = skipped = rolling = 0
+            weak = None
+            continue
+
+        flush_copy()
+        copy_count = 0
+        if window < block_size or (unmatched >= 16 * block_size and not rolling):
+            # Emit the whole window as literal data instead of rolling through it
+            literal += buf[pos:pos + window]
+            literal_total += window
+            unmatched += window
+            pos += window
+            weak = None
+            skipped += 1
+            if skipped == 8:
+                # Roll through the next block, covering every offset an insert can leave
+                skipped = 0
+                rolling = block_size
+            if len(literal) >= 1024 * 1024:
+                flush_literal()
+            continue
+
+        out_byte = buf[pos]
+        literal.append(out_byte)
+        literal_total += 1
+        unmatched += 1
+        if rolling:
+            rolling -= 1
+        if len(literal) >= 1024 * 1024:
+            flush_literal()
+        pos += 1
+
+        if len(buf) - pos >= block_size:
+            # Roll the Adler-32 window forward by one byte
+            in_byte = buf[pos + block_size - 1]
+            a = ((weak & 0xffff) - out_byte + in_byte) % modulus
+            b = ((weak >> 16) - block_size * out_byte + a - 1) % modulus
+            weak = (b << 16) | a
+        else:
+            weak = None
+
+    flush_literal()
+    flush_copy()
+    write(b'E' + sha.digest() + struct.pack('>d', mtime))
+    return literal_total, copied_total
+
+def read_exact(f, n):
+    data = b''
+    while len(data) < n:
+        chunk = f.read(n - len(data))
+        if not chunk:
+            raise EOFError('Delta stream ended unexpectedly')
+        data += chunk
+    return data
+
+def apply_delta(basis, read, out, block_size):
+    """Rebuild a file into out from a basis file object and a delta op stream.
+
+    Returns (literal_bytes, copied_bytes, mtime) and raises ValueError if the
+    result doesn't match the SHA-256 carried by the stream.
+    """
+    sha = hashlib.sha256()
+    literal_total = copied_total = 0
+    while True:
+        op = read_exact(read, 1)
+        if op == b'C':
+            start, count = struct.unpack('>QI', read_exact(read, 12))
+            basis.seek(start * block_size)
+            remaining = count * block_size
+            while remaining > 0:
+                data = basis.read(min(remaining, 1024 * 1024))
+                if not data:
+                    break
+                out.write(data)
+                sha.update(data)
+                copied_total += len(data)
+                remaining -= len(data)
+        elif op == b'L':
+            length, = struct.unpack('>I', read_exact(read, 4))
+            data = read_exact(read, length)
+            out.write(data)
+            sha.update(data)
+            literal_total += length
+        elif op == b'E':
+            digest = read_exact(read, 32)
+            mtime, = struct.unpack('>d', read_exact(read, 8))
+            if digest != sha.digest():
+                raise ValueError('Checksum mismatch after applying delta')
+            return literal_total, copied_total, mtime
+        else:
+            raise ValueError(f'Unknown delta op {op!r}')
+
+def open_basis(path):
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        return open(os.devnull, 'rb')
+
+def patch_file(path, read, block_size):
+    """Apply a delta stream to path in place, atomically replacing it."""
+    tmp_path = path + '.clustertools-delta'
+    with open_basis(path) as basis, open(tmp_path, 'wb') as out:
+        try:
+            result = apply_delta(basis, read, out, block_size)
+            out.flush()
+            os.fsync(out.fileno())
+        except BaseException:
+            out.close()
+            os.remove(tmp_path)
+            raise
+    if os.path.exists(path):
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    os.replace(tmp_path, path)
+    if result[2]:
+        os.utime(path, (result[2], result[2]))
+    return result
+
+def helper_main(argv):
+    mode, path, block_size = argv[0], argv[1], int(argv[2])
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    if mode == 'signature':
+        with open_basis(path) as f:
+            stdout.write(encode_signatures(block_signatures(f, block_size)))
+    elif mode == 'delta':
+        signatures = decode_signatures(stdin.read())
+        with open(path, 'rb') as f:
+            compute_delta(f, signatures, block_size, stdout.write, os.stat(path).st_mtime)
+    elif mode == 'patch':
+        patch_file(path, stdin, block_size)
+    stdout.flush()
+
+HELPER_FUNCTIONS = [block_signatures, encode_signatures, decode_signatures, compute_delta,
+                    read_exact, apply_delta, open_basis, patch_file, helper_main]
+
+def helper_command(mode, path, block_size):
+    """Build the remote `python3 -c` command running the delta helper."""
+    source = "import hashlib, os, struct, sys, zlib\n"
+    source += "\n".join(inspect.getsource(func) for func in HELPER_FUNCTIONS)
+    source += "\nhelper_main(sys.argv[1:])\n"
+    return f"python3 -c {shlex.quote(source)} {mode} {shlex.quote(path)} {block_size}"
+
+def report_delta(size, wire_bytes):
+    """Print how much data the delta transfer avoided sending."""
+    saved = max(size - wire_bytes, 0)
+    percent = saved / size * 100 if size > 0 else 0
+    print(f"Delta transfer: {round(wire_bytes/(1024*1024), 2)} MB on the wire for a {round(size/(1024*1024), 2)} MB file "
+          f"(saved {round(saved/(1024*1024), 2)} MB, {percent:.1f}%)")
+
+class CountingWriter:
+    """File-like wrapper that counts the bytes written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+class CountingReader:
+    """File-like wrapper that counts the bytes read through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+def upload_delta(ssh, local_path, remote_path, block_size=DEFAULT_BLOCK_SIZE):
+    """Update a remote file from a local one by sending only the changed blocks.
+
+    Returns the number of bytes that crossed the wire.
+    """
+    # Fetch block signatures of the current remote copy
+    stdin, stdout, stderr = ssh.exec_command(helper_command('signature', remote_path, block_size))
+    signature_data = stdout.read()
+    if stdout.channel.recv_exit_status() != 0:
+        raise Exception(f"Remote delta helper failed: {stderr.read().decode()}")
+    signatures = decode_signatures(signature_data)
+
+    # Stream the delta into the remote patcher
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(helper_command('patch', remote_path, block_size))
+    try:
+        with channel.makefile('wb') as remote_stdin:
+            writer = CountingWriter(remote_stdin)
+            with open(local_path, 'rb') as f:
+                compute_delta(f, signatures, block_size, writer.write, os.stat(local_path).st_mtime)
+        channel.shutdown_write()
+        if channel.recv_exit_status() != 0:
+            error = channel.makefile_stderr('rb').read().decode()
+            raise Exception(f"Remote delta patch failed: {error}")
+    finally:
+        channel.close()
+
+    wire_bytes = len(signature_data) + writer.bytes_written
+    report_delta(os.path.getsize(local_path), wire_bytes)
+    return wire_bytes
+
+def download_delta(ssh, remote_path, local_path, block_size=DEFAULT_BLOCK_SIZE):
+    """Update a local file from a remote one by receiving only the changed blocks.
+
+    Returns the number of bytes that crossed the wire.
+    """
+    with open_basis(local_path) as f:
+        signature_data = encode_signatures(block_signatures(f, block_size))
+
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(helper_command('delta', remote_path, block_size))
+    try:
+        channel.sendall(signature_data)
+        channel.shutdown_write()
+        reader = CountingReader(channel.makefile('rb'))
+        try:
+            literal_bytes, copied_bytes, mtime = patch_file(local_path, reader, block_size)
+        except EOFError:
+            error = channel.makefile_stderr('rb').read().decode()
+            raise Exception(f"Remote delta helper failed: {error}")
+        channel.recv_exit_status()
+    finally:
+        channel.close()
+
+    wire_bytes = len(signature_data) + reader.bytes_read
+    report_delta(literal_bytes + copied_bytes, wire_bytes)
+    return wire_bytes
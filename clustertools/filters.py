@@ -0,0 +1,229 @@
+"""Include/exclude filters for folder transfers.
+
+Patterns use .gitignore syntax: a pattern without a slash matches a name
+at any depth (`*.log`, `.git`), a leading or inner slash anchors it to the
+transferred folder (`/build`, `data/raw/*.tmp`), a trailing slash only
+matches directories (`logs/`), `*` and `?` stay within one path component
+and `**` spans several. An excluded directory excludes everything below
+it; with include patterns only files matching one of them (or lying in a
+matching directory) are transferred. Size and mtime bounds apply to files.
+
+Downloads push the filter into the remote `find` that lists the folder, so
+excluded directories are pruned there and filtered files are never read,
+compressed or sent. Uploads apply it while walking the local folder.
+Filters select files and symlinks; directories are created as needed for
+them, so empty directories are left out of a filtered transfer.
+"""
+import argparse
+import re
+import shlex
+import time
+from datetime import datetime
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+# Characters that need a backslash to be literal in both Python re and POSIX ERE
+REGEX_SPECIALS = set('.^$+(){}|[]\\*?')
+
+def glob_regex(glob):
+    """Translate a gitignore glob (no leading/trailing slash) into a regex for re and find -regex."""
+    regex = ''
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**/', i) and (i == 0 or glob[i - 1] == '/'):
+            regex += '(.*/)?'
+            i += 3
+            continue
+        if glob.startswith('**', i) and i + 2 == len(glob) and (i == 0 or glob[i - 1] == '/'):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and ']' in glob[i + 2:] and '\\' not in glob[i:glob.index(']', i + 2)]:
+            end = glob.index(']', i + 2)
+            body = glob[i + 1:end]
+            if body[0] in '!^':
+                body = '^' + body[1:]
+            regex += f'[{body}]'
+            i = end
+        elif c == '\\' and i + 1 < len(glob):
+            i += 1
+            regex += '\\' + glob[i] if glob[i] in REGEX_SPECIALS else glob[i]
+        else:
+            regex += '\\' + c if c in REGEX_SPECIALS else c
+        i += 1
+    return regex
+
+def parse_pattern(pattern):
+    """Return (regex, dir_only) for a gitignore-style pattern, the regex matching relative paths."""
+    dir_only = pattern.endswith('/')
+    glob = pattern.strip('/')
+    # A slash anywhere but at the end ties the pattern to the top of the folder
+    anchored = '/' in pattern.rstrip('/')
+    regex = glob_regex(glob)
+    if not anchored and not regex.startswith('(.*/)?'):
+        regex = '(.*/)?' + regex
+    return regex, dir_only
+
+def read_patterns(path):
+    """Patterns of an ignore file: one per line, skipping blank lines and # comments."""
+    patterns = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            if line.startswith('!'):
+                print(f"{YELLOW}Ignoring negated pattern {line!r} in {path}; use --include instead{RESET}")
+                continue
+            patterns.append(line.rstrip())
+    return patterns
+
+def parse_size(value):
+    """Parse a size such as 500, 64k, 1.5M or 2G (binary units) into bytes."""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([kmgt]?)i?b?\s*', value.lower())
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid size {value!r}, expected e.g. 500, 64k, 1.5M or 2G")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+def parse_time(value):
+    """Parse an age such as 30m, 12h, 7d or 2w, or an ISO date, into an epoch timestamp."""
+    match = re.fullmatch(r'\s*([\d.]+)\s*([smhdw])\s*', value.lower())
+    if match:
+        return time.time() - float(match.group(1)) * AGE_UNITS[match.group(2)]
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time {value!r}, expected an age like 7d or a date like 2024-05-01")
+
+class TransferFilter:
+    """Selects the files of a folder transfer.
+
+    include and exclude are lists of gitignore-style patterns (exclude
+    wins); min_size/max_size bound file sizes in bytes and newer_than/
+    older_than bound mtimes as epoch timestamps. Every bound is inclusive
+    except newer_than, which like find -newermt is strict.
+    """
+
+    def __init__(self, include=(), exclude=(), min_size=None, max_size=None, newer_than=None, older_than=None):
+        self.include = [parse_pattern(pattern) for pattern in include]
+        self.exclude = [parse_pattern(pattern) for pattern in exclude]
+        self.min_size = min_size
+        self.max_size = max_size
+        self.newer_than = newer_than
+        self.older_than = older_than
+        # A path matches when it or a directory above it matches the pattern
+        self._include = [re.compile(regex + ('/.*' if dir_only else '(/.*)?')) for regex, dir_only in self.include]
+        self._exclude = [re.compile(regex + ('/.*' if dir_only else '(/.*)?')) for regex, dir_only in self.exclude]
+        self._exclude_dirs = [re.compile(regex) for regex, dir_only in self.exclude]
+
+    def __bool__(self):
+        return bool(self.include or self.exclude or self.min_size is not None or self.max_size is not None
+                    or self.newer_than is not None or self.older_than is not None)
+
+    @property
+    def needs_mtime(self):
+        return self.newer_than is not None or self.older_than is not None
+
+    def excludes_dir(self, rel_dir):
+        """True if a directory (relative to the folder) and everything below it is excluded."""
+        return any(regex.fullmatch(rel_dir) for regex in self._exclude_dirs)
+
+    def matches(self, rel_path, size, mtime=None):
+        """True if a file (relative to the folder) is transferred."""
+        if any(regex.fullmatch(rel_path) for regex in self._exclude):
+            return False
+        if self._include and not any(regex.fullmatch(rel_path) for regex in self._include):
+            return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        if self.max_size is not None and size > self.max_size:
+            return False
+        if self.newer_than is not None and mtime <= self.newer_than:
+            return False
+        if self.older_than is not None and mtime > self.older_than:
+            return False
+        return True
+
+    def select(self, manifest):
+        """Keep the entries of a {path: (size, mtime)} manifest that match."""
+        return {path: (size, mtime) for path, (size, mtime) in manifest.items() if self.matches(path, size, mtime)}
+
+    def find_arguments(self, root):
+        """Return (prune, test): find fragments to place before and after the type test.
+
+        prune skips excluded directories below root and ends in -o, test
+        holds the remaining predicates for the entries listed:
+            find ROOT -regextype posix-extended {prune} -type f {test} -printf ...
+        """
+        prefix = ''.join('\\' + c if c in REGEX_SPECIALS else c for c in root.rstrip('/')) + '/'
+
+        def any_regex(regexes):
+            return '\\( ' + ' -o '.join(f"-regex {shlex.quote(prefix + regex)}" for regex in regexes) + ' \\)'
+
+        prune = f"\\( -type d {any_regex([regex for regex, dir_only in self.exclude])} -prune \\) -o " if self.exclude else ''
+        tests = []
+        file_excludes = [regex for regex, dir_only in self.exclude if not dir_only]
+        if file_excludes:
+            tests.append('! ' + any_regex(file_excludes))
+        if self.include:
+            tests.append(any_regex([regex + ('/.*' if dir_only else '(/.*)?') for regex, dir_only in self.include]))
+        if self.min_size is not None and self.min_size > 0:
+            # Every file has at least 0 bytes, and -size +-1c isn't valid
+            tests.append(f"-size +{self.min_size - 1}c")
+        if self.max_size is not None:
+            tests.append(f"-size -{self.max_size + 1}c")
+        if self.newer_than is not None:
+            tests.append(f"-newermt @{self.newer_than:.6f}")
+        if self.older_than is not None:
+            tests.append(f"! -newermt @{self.older_than:.6f}")
+        return prune, ''.join(test + ' ' for test in tests)
+
+    def find_command(self, root, types='f', printf="%P\\0"):
+        """Remote find listing the entries of the given find -type letters below root that match."""
+        prune, test = self.find_arguments(root)
+        kinds = ' -o '.join(f"-type {kind}" for kind in types)
+        return (f"find {shlex.quote(root)} -mindepth 1 -regextype posix-extended {prune}"
+                f"\\( {kinds} \\) {test}-printf '{printf}'")
+
+def as_filter(filters):
+    """Accept a TransferFilter, a dict of its arguments (as in batch manifests) or None."""
+    if filters is None or isinstance(filters, TransferFilter):
+        return filters or None
+    return TransferFilter(**filters) or None
+
+def add_filter_arguments(parser):
+    """Add the filter options shared by the local2cluster and cluster2local CLIs."""
+    parser.add_argument('--include', action='append', default=[], metavar='PATTERN',
+                        help='Only transfer files matching this gitignore-style pattern (repeatable)')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                        help='Skip files and directories matching this gitignore-style pattern (repeatable)')
+    parser.add_argument('--exclude-from', action='append', default=[], metavar='FILE',
+                        help='Read exclude patterns from a .gitignore-style file (repeatable)')
+    parser.add_argument('--min-size', type=parse_size, default=None, metavar='SIZE',
+                        help='Only transfer files of at least this size, e.g. 10k or 1.5G')
+    parser.add_argument('--max-size', type=parse_size, default=None, metavar='SIZE',
+                        help='Only transfer files of at most this size')
+    parser.add_argument('--newer-than', type=parse_time, default=None, metavar='WHEN',
+                        help='Only transfer files modified after WHEN, an age (30m, 12h, 7d, 2w) or a date (2024-05-01)')
+    parser.add_argument('--older-than', type=parse_time, default=None, metavar='WHEN',
+                        help='Only transfer files last modified before WHEN')
+
+def filter_from_args(args):
+    """TransferFilter from parsed add_filter_arguments options, or None if none were given."""
+    exclude = list(args.exclude)
+    for path in args.exclude_from:
+        exclude += read_patterns(path)
+    return as_filter(TransferFilter(args.include, exclude, args.min_size, args.max_size,
+                                    args.newer_than, args.older_than))
@@ -0,0 +1,368 @@
+"""Local index of remote directory trees, so repeated listings skip the cluster.
+
+Every entry below a listed root is kept in a SQLite database with its
+type, size, mtime and mode. A listing younger than the index's ttl is
+answered from the database with no round trip at all. An older one is
+refreshed: one `find` pass reads the directory mtimes and the files
+modified since the last scan, and only directories whose mtime changed
+(entries were added, removed or renamed in them) have their files listed
+again. The refresh still walks the whole tree on the cluster, since a
+change deep down doesn't show in the mtimes of the directories above it;
+what it saves is sending back and storing the entries that didn't change.
+
+A file rewritten in place keeps its directory's mtime but gets a new one
+of its own, so the refresh picks it up. Only a file given back an old
+mtime (`cp -p`, `rsync -t`) goes unnoticed; invalidate() the subtree (or
+`clustertools cache clear`) when files on the cluster are changed that
+way. Transfers made through the index mark the directories they write so
+the next listing relists them.
+"""
+import os
+import posixpath
+import shlex
+import sqlite3
+import time
+from contextlib import contextmanager
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'clustertools', 'index.sqlite')
+
+# Seconds a listing is served from the index before it is refreshed
+DEFAULT_TTL = 600
+
+# Seconds of overlap when relisting files modified since the last scan,
+# covering clock skew between this machine and the cluster
+CLOCK_SLACK = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    host TEXT NOT NULL,
+    path BLOB NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL,
+    mode INTEGER NOT NULL,
+    PRIMARY KEY (host, path)
+);
+CREATE TABLE IF NOT EXISTS scans (
+    host TEXT NOT NULL,
+    root BLOB NOT NULL,
+    scanned_at REAL NOT NULL,
+    PRIMARY KEY (host, root)
+);
+"""
+
+# find -printf fields of one entry: type, path, size, mtime, octal mode
+ENTRY_FORMAT = '%y\\0%p\\0%s\\0%T@\\0%m\\0'
+
+def encode_path(path):
+    return path.encode('utf-8', 'surrogateescape')
+
+def decode_path(path):
+    return bytes(path).decode('utf-8', 'surrogateescape')
+
+def normalize_root(root):
+    return posixpath.normpath(root) if root else '.'
+
+def subtree_range(root):
+    """(low, high) bounds of the encoded paths strictly below root."""
+    prefix = encode_path(root.rstrip('/') + '/')
+    # '0' sorts right after '/', so the range ends before any sibling
+    return prefix, prefix[:-1] + b'0'
+
+def parse_entries(output):
+    """Parse NUL-separated ENTRY_FORMAT records into [(path, type, size, mtime, mode)]."""
+    fields = output.split(b'\0')
+    entries = []
+    for i in range(0, len(fields) - 4, 5):
+        entries.append((decode_path(fields[i + 1]), fields[i].decode(), int(fields[i + 2]),
+                        float(fields[i + 3]), int(fields[i + 4], 8)))
+    return entries
+
+def run_find(ssh, command, root):
+    """Run a find command; returns its output, or None if root doesn't exist."""
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read()
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        error = stderr.read().decode()
+        if 'No such file' in error and not output:
+            return None
+        raise Exception(f"Failed to list remote directory {root}: {error}")
+    return output
+
+def host_key(ssh, hostname=None):
+    """Name a host in the index by hostname, or by the connection's peer address."""
+    if hostname:
+        return hostname
+    peer = ssh.get_transport().getpeername()
+    return f"{peer[0]}:{peer[1]}"
+
+class RemoteIndex:
+    """SQLite cache of remote tree metadata shared by every host.
+
+    ttl is how many seconds a listing is trusted without contacting the
+    cluster; 0 refreshes on every listing, None
+    never expires listings.
+    """
+
+    def __init__(self, path=INDEX_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # One short-lived connection per call, so threads can share the index
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    def for_host(self, host):
+        return HostIndex(self, host)
+
+    def _scan(self, db, host, root):
+        """Most recent scan covering root (root itself or an ancestor), as (root, scanned_at)."""
+        best = None
+        for scan_root, scanned_at in db.execute('SELECT root, scanned_at FROM scans WHERE host = ?', (host,)):
+            scan_root = decode_path(scan_root)
+            covers = root == scan_root or root.startswith(scan_root.rstrip('/') + '/')
+            if covers and (best is None or abs(scanned_at) > abs(best[1])):
+                best = (scan_root, scanned_at)
+        return best
+
+    def _is_fresh(self, scanned_at):
+        # A negative scanned_at is a listing expired by mark_changed()
+        return scanned_at > 0 and (self.ttl is None or time.time() - scanned_at < self.ttl)
+
+    def entries(self, ssh, host, root, refresh=False, missing_ok=True):
+        """Return {relative_path: (type, size, mtime, mode)} for everything below a remote root.
+
+        type is find's letter: 'f' file, 'd' directory, 'l' symlink and so
+        on. Served from the index while fresh, refreshed otherwise; a
+        missing root gives an empty dict, or raises FileNotFoundError with
+        missing_ok=False.
+        """
+        root = normalize_root(root)
+        with self._connect() as db:
+            scan = self._scan(db, host, root)
+        if scan is None:
+            found = self._full_scan(ssh, host, root)
+        elif refresh or not self._is_fresh(scan[1]):
+            found = self._refresh_scan(ssh, host, root, scan[1])
+        else:
+            found = True
+        if not found:
+            if missing_ok:
+                return {}
+            raise FileNotFoundError(f"Remote directory {root} does not exist")
+        return self._read(host, root)
+
+    def files(self, ssh, host, root, refresh=False, missing_ok=True):
+        """Return {relative_path: (size, mtime)} of the regular files below root, like remote_manifest."""
+        return {path: (size, mtime)
+                for path, (kind, size, mtime, mode) in self.entries(ssh, host, root, refresh, missing_ok).items()
+                if kind == 'f'}
+
+    def size(self, ssh, host, root, refresh=False, missing_ok=True):
+        """Total size in bytes of the regular files below root."""
+        return sum(size for size, mtime in self.files(ssh, host, root, refresh, missing_ok).values())
+
+    def _read(self, host, root):
+        low, high = subtree_range(root)
+        offset = len(low)
+        with self._connect() as db:
+            rows = db.execute('SELECT path, type, size, mtime, mode FROM entries '
+                              'WHERE host = ? AND path >= ? AND path < ?', (host, low, high)).fetchall()
+        return {decode_path(path[offset:]): (kind, size, mtime, mode)
+                for path, kind, size, mtime, mode in rows if len(path) > offset}
+
+    def _store(self, db, host, entries):
+        db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                       [(host, encode_path(path), kind, size, mtime, mode)
+                        for path, kind, size, mtime, mode in entries])
+
+    def _delete_subtree(self, db, host, root, including_root=True):
+        low, high = subtree_range(root)
+        db.execute('DELETE FROM entries WHERE host = ? AND path >= ? AND path < ?', (host, low, high))
+        if including_root:
+            db.execute('DELETE FROM entries WHERE host = ? AND path = ?', (host, encode_path(root)))
+
+    def _mark_scanned(self, db, host, root):
+        # A scan of root supersedes the scans of directories below it
+        low, high = subtree_range(root)
+        db.execute('DELETE FROM scans WHERE host = ? AND root >= ? AND root < ?', (host, low, high))
+        db.execute('INSERT OR REPLACE INTO scans VALUES (?, ?, ?)', (host, encode_path(root), time.time()))
+
+    def _full_scan(self, ssh, host, root):
+        """List the whole tree below root in one find call; False if root is missing."""
+        print(f"{YELLOW}Indexing remote directory {root}...{RESET}")
+        output = run_find(ssh, f"find {shlex.quote(root)} -printf '{ENTRY_FORMAT}'", root)
+        with self._connect() as db:
+            self._delete_subtree(db, host, root)
+            if output is None:
+                db.execute('DELETE FROM scans WHERE host = ? AND root = ?', (host, encode_path(root)))
+                return False
+            self._store(db, host, parse_entries(output))
+            self._mark_scanned(db, host, root)
+        return True
+
+    def _refresh_scan(self, ssh, host, root, scanned_at):
+        """Relist the directories below root whose mtime changed and the files modified since scanned_at.
+
+        find still visits every entry below root to read the directory mtimes
+        and test the file ones; only what changed is sent back. False if root
+        is missing.
+        """
+        since = int(abs(scanned_at) - CLOCK_SLACK)
+        output = run_find(ssh, f"find {shlex.quote(root)} \\( -type d -o -newermt @{since} \\) "
+                               f"-printf '{ENTRY_FORMAT}'", root)
+        if output is None:
+            with self._connect() as db:
+                self._delete_subtree(db, host, root)
+                db.execute('DELETE FROM scans WHERE host = ? AND root = ?', (host, encode_path(root)))
+            return False
+        remote_dirs = {}
+        modified = []
+        for entry in parse_entries(output):
+            if entry[1] == 'd':
+                remote_dirs[entry[0]] = entry
+            else:
+                modified.append(entry)
+
+        low, high = subtree_range(root)
+        with self._connect() as db:
+            rows = db.execute("SELECT path, mtime FROM entries WHERE host = ? AND type = 'd' "
+                              "AND (path = ? OR (path >= ? AND path < ?))",
+                              (host, encode_path(root), low, high)).fetchall()
+        cached_dirs = {decode_path(path): mtime for path, mtime in rows}
+
+        removed = [path for path in cached_dirs if path not in remote_dirs]
+        changed = sorted(path for path, entry in remote_dirs.items() if cached_dirs.get(path) != entry[3])
+        listing = b''
+        if changed:
+            print(f"{YELLOW}Refreshing {len(changed)} changed of {len(remote_dirs)} remote directories...{RESET}")
+            command = ("xargs -0 -r sh -c 'exec find \"$@\" -mindepth 1 -maxdepth 1 ! -type d "
+                       f"-printf \"{ENTRY_FORMAT}\"' sh")
+            stdin, stdout, stderr = ssh.exec_command(command)
+            stdin.write(b''.join(encode_path(path) + b'\0' for path in changed))
+            stdin.channel.shutdown_write()
+            listing = stdout.read()
+            stdout.channel.recv_exit_status()
+
+        with self._connect() as db:
+            for path in removed:
+                self._delete_subtree(db, host, path)
+            for path in changed:
+                # Drop the directory's own non-directory entries; its subdirectories are relisted above
+                low, high = subtree_range(path)
+                depth = len(low)
+                db.execute("DELETE FROM entries WHERE host = ? AND type != 'd' AND path >= ? AND path < ? "
+                           "AND instr(substr(path, ?), X'2F') = 0", (host, low, high, depth + 1))
+            # Files rewritten in place, in directories whose mtime didn't change
+            self._store(db, host, list(remote_dirs.values()) + modified + parse_entries(listing))
+            self._mark_scanned(db, host, root)
+        return True
+
+    def mark_changed(self, host, root, dirs=()):
+        """Note that directories below root were written, so the next listing relists them.
+
+        dirs are relative to root; root itself is always included.
+        """
+        root = normalize_root(root)
+        paths = [root] + [posixpath.join(root, d) for d in dirs if d not in ('', '.')]
+        with self._connect() as db:
+            db.executemany("UPDATE entries SET mtime = NULL WHERE host = ? AND path = ? AND type = 'd'",
+                           [(host, encode_path(path)) for path in set(paths)])
+            scan = self._scan(db, host, root)
+            if scan is not None:
+                # Expire the covering listing so its next use refreshes; the sign marks
+                # it expired and the scan time is kept for the modified-files pass
+                db.execute('UPDATE scans SET scanned_at = -ABS(scanned_at) WHERE host = ? AND root = ?',
+                           (host, encode_path(scan[0])))
+
+    def invalidate(self, host=None, root=None):
+        """Forget a remote root (and everything below it), a whole host, or everything."""
+        with self._connect() as db:
+            if host is None:
+                db.execute('DELETE FROM entries')
+                db.execute('DELETE FROM scans')
+            elif root is None:
+                db.execute('DELETE FROM entries WHERE host = ?', (host,))
+                db.execute('DELETE FROM scans WHERE host = ?', (host,))
+            else:
+                root = normalize_root(root)
+                self._delete_subtree(db, host, root)
+                low, high = subtree_range(root)
+                db.execute('DELETE FROM scans WHERE host = ? AND (root = ? OR (root >= ? AND root < ?))',
+                           (host, encode_path(root), low, high))
+
+    def summary(self):
+        """Return [(host, root, entries, age_seconds)] for every indexed root."""
+        now = time.time()
+        summary = []
+        with self._connect() as db:
+            for host, root, scanned_at in db.execute('SELECT host, root, scanned_at FROM scans ORDER BY host, root'):
+                low, high = subtree_range(decode_path(root))
+                count, = db.execute('SELECT COUNT(*) FROM entries WHERE host = ? AND path >= ? AND path < ?',
+                                    (host, low, high)).fetchone()
+                summary.append((host, decode_path(root), count, now - abs(scanned_at)))
+        return summary
+
+class HostIndex:
+    """A RemoteIndex bound to one host, as handed to the transfer functions."""
+
+    def __init__(self, index, host):
+        self.index = index
+        self.host = host
+
+    def entries(self, ssh, root, refresh=False, missing_ok=True):
+        return self.index.entries(ssh, self.host, root, refresh, missing_ok)
+
+    def files(self, ssh, root, refresh=False, missing_ok=True):
+        return self.index.files(ssh, self.host, root, refresh, missing_ok)
+
+    def size(self, ssh, root, refresh=False, missing_ok=True):
+        return self.index.size(ssh, self.host, root, refresh, missing_ok)
+
+    def mark_changed(self, root, dirs=()):
+        self.index.mark_changed(self.host, root, dirs)
+
+    def invalidate(self, root=None):
+        self.index.invalidate(self.host, root)
+
+def split_entries(entries, filters=None):
+    """Split index entries into ({path: size} of files, [symlinks and empty directories]).
+
+    With a TransferFilter only matching files and symlinks are kept.
+    """
+    if filters:
+        sizes = {path: size for path, (kind, size, mtime, mode) in entries.items()
+                 if kind == 'f' and filters.matches(path, size, mtime)}
+        extra = sorted(path for path, (kind, size, mtime, mode) in entries.items()
+                       if kind == 'l' and filters.matches(path, size, mtime))
+        return sizes, extra
+    sizes = {path: size for path, (kind, size, mtime, mode) in entries.items() if kind == 'f'}
+    parents = {posixpath.dirname(path) for path in entries}
+    extra = sorted(path for path, (kind, size, mtime, mode) in entries.items()
+                   if kind == 'l' or (kind == 'd' and path not in parents))
+    return sizes, extra
+
+def open_index(ttl, hostname, ssh):
+    """HostIndex for a connection when ttl is set (seconds, see RemoteIndex), otherwise None."""
+    if ttl is None:
+        return None
+    return RemoteIndex(ttl=ttl).for_host(host_key(ssh, hostname))
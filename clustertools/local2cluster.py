@@ -1,7 +1,23 @@
 import os
 import argparse
+import shlex
+import tarfile
+import threading
 import time
-from clustertools.login import login2ssh
+from concurrent.futures import ThreadPoolExecutor
+from clustertools.connection import get_ssh_connection, close_ssh_connection
+from clustertools.sync import remote_manifest, compare_manifests, check_delete, delete_remote_files, local_manifest
+from clustertools.delta import DEFAULT_BLOCK_SIZE, upload_delta
+from clustertools.resume import TransferJournal, is_connection_lost, resumable_upload, with_reconnect
+from clustertools.backends import BACKEND_NAMES, DEFAULT_REQUEST_SIZE, choose_backend, make_backend
+from clustertools.stripe import STRIPE_THRESHOLD, striped_upload
+from clustertools.metrics import PROGRESS_MODES, TransferMetrics, measure_rtt, set_progress_output
+from clustertools.verify import ALGORITHMS, DEFAULT_ALGORITHM, DigestLog, HashingReader, verify_and_record
+from clustertools.compression import COMPRESSION_MODES, CompressingWriter, CompressionPolicy, is_precompressed
+from clustertools.index import DEFAULT_TTL, open_index
+from clustertools.filters import add_filter_arguments, as_filter, filter_from_args
+from clustertools.watch import DEBOUNCE, MAX_DELAY, POLL_INTERVAL, open_watcher, plan_changes
+from clustertools.tuning import MAX_CHANNELS, AdaptiveConcurrency, bandwidth_limiter, limit_rate, rate_limiter, tune_connection
 from tqdm import tqdm
 
 # Color constants
@@ -10,37 +26,304 @@ GREEN = '\033[92m'
 YELLOW = '\033[93m'
 RESET = '\033[0m'
 
-# Add these global variables for connection reuse
-global_ssh = None
-global_scp = None
+# Keep each batched mkdir command comfortably below the remote ARG_MAX
+MKDIR_BATCH_CHARS = 100000
 
-def get_ssh_connection(username=None, password=None, hostname=None):
-    """Get an SSH connection, reusing an existing one if available."""
-    global global_ssh, global_scp
+# Files below this size are packed into tar batches instead of sent one by one
+SMALL_FILE_THRESHOLD = 1024 * 1024
+TAR_BATCH_SIZE = 64 * 1024 * 1024
+
+def ensure_remote_dirs(ssh, dirs, known=None):
+    """Create remote directories with batched `mkdir -p` calls, skipping known ones.
+    
+    known is a set of directories already created during the same transfer;
+    it is updated in place. It is never shared between transfers, so a
+    directory removed on the cluster in the meantime is created again.
+    """
+    if known is None:
+        known = set()
+    missing = sorted(d for d in set(dirs) if d not in known)
+    if not missing:
+        return
+    
+    # Drop directories that are a parent of another one; mkdir -p creates them anyway
+    leaves = [d for i, d in enumerate(missing)
+              if not (i + 1 < len(missing) and missing[i + 1].startswith(d.rstrip('/') + '/'))]
+    
+    batch = []
+    batch_len = 0
+    for i, d in enumerate(leaves):
+        quoted = shlex.quote(d)
+        batch.append(quoted)
+        batch_len += len(quoted) + 1
+        if batch_len < MKDIR_BATCH_CHARS and i < len(leaves) - 1:
+            continue
+        
+        stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {' '.join(batch)}")
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            error = stderr.read().decode()
+            raise Exception(f"Failed to create remote directories: {error}")
+        batch = []
+        batch_len = 0
+    
+    # Every ancestor of a created directory exists as well
+    for d in leaves:
+        while d and d not in known:
+            known.add(d)
+            d = os.path.dirname(d.rstrip('/'))
+    known.update(missing)
+
+def journal_file(journal, target_dir, item):
+    """Record a finished file of a folder upload in the resume journal."""
+    if journal is not None:
+        local_file_path, remote_dir, remote_file_path, file_size = item
+        journal.mark_done(os.path.relpath(remote_file_path, target_dir), file_size,
+                          os.path.getmtime(local_file_path))
+
+def upload_files_parallel(ssh, file_list, progress, workers, target_dir=None, journal=None,
+                          backend='auto', request_size=DEFAULT_REQUEST_SIZE, digests=None,
+                          controller=None):
+    """Upload files over a pool of channels sharing the SSH transport.
+    
+    Each file goes through the backend picked for its size by choose_backend,
+    unless backend names one. With a journal, files are sent over SFTP so
+    partial ones are resumed, and finished ones are recorded. With a
+    DigestLog, every file is hashed as it is sent. With an
+    AdaptiveConcurrency, it decides how many of the channels send at once.
+    Returns the entries that failed to upload.
+    """
+    if controller is not None:
+        workers = controller.maximum
+    local = threading.local()
+    open_backends = []
+    failed = []
+    
+    def get_backend(name):
+        if not hasattr(local, 'backends'):
+            local.backends = {}
+        if name not in local.backends:
+            local.backends[name] = make_backend(name, ssh, request_size)
+            open_backends.append(local.backends[name])
+        return local.backends[name]
     
-    # Check if we already have an active connection
-    if global_ssh is not None:
+    def upload_one(item):
+        local_file_path, remote_dir, remote_file_path, file_size = item
+        path = os.path.relpath(remote_file_path, target_dir) if target_dir else remote_file_path
+        digest = digests.new() if digests is not None else None
+        sent_so_far = [0]
+        started = time.time()
+        
+        def callback(sent, size):
+            progress.add_bytes(sent - sent_so_far[0])
+            sent_so_far[0] = sent
+        
         try:
-            # Test if the connection is still active
-            global_ssh.exec_command('echo test', timeout=5)
-            print(f"{GREEN}Using existing SSH connection{RESET}")
-            return global_ssh, global_scp
-        except Exception:
-            # Connection is no longer active, close it and create a new one
+            if journal is not None:
+                resumable_upload(get_backend('sftp').sftp, local_file_path, remote_file_path,
+                                 callback=callback, digest=digest)
+            else:
+                # Backends keep the local mtime so later sync runs can compare trees
+                get_backend(choose_backend(file_size, backend, digests is not None)).upload(
+                    local_file_path, remote_file_path, callback, digest)
+            journal_file(journal, target_dir, item)
+            if digests is not None:
+                digests.add(path, file_size, digest)
+            progress.file_done(path, file_size, time.time() - started)
+        except Exception as e:
+            progress.add_bytes(-sent_so_far[0])
+            if is_connection_lost(ssh, e):
+                raise
+            failed.append(item)
+            progress.error(f"Error uploading {local_file_path}: {str(e)}")
+    
+    def upload_in_slot(item):
+        with controller.slot():
+            upload_one(item)
+    
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(upload_one if controller is None else upload_in_slot, file_list))
+    finally:
+        for transfer in open_backends:
             try:
-                global_scp.close()
-                global_ssh.close()
-            except:
+                transfer.close()
+            except Exception:
                 pass
-            global_ssh = None
-            global_scp = None
     
-    # Create a new connection
-    global_ssh, global_scp = login2ssh(username, password, hostname)
-    return global_ssh, global_scp
+    return failed
+
+def plan_upload(file_list, small_file_threshold=SMALL_FILE_THRESHOLD, batch_size=TAR_BATCH_SIZE, codec='none'):
+    """Split a folder upload into tar-packed batches of small files and direct transfers.
+    
+    Files smaller than small_file_threshold bytes are grouped into batches of
+    roughly batch_size bytes; everything else is uploaded file by file.
+    Already compressed files never share a batch with other files, so each
+    batch can be compressed or not as a whole. With a codec other than
+    'none' (and packing enabled) files that aren't already compressed are
+    packed whatever their size, so they get compressed too.
+    Returns (batches, large_files).
+    """
+    batches = []
+    large_files = []
+    # One open batch for already compressed files, one for the rest
+    batch = {True: [], False: []}
+    batch_bytes = {True: 0, False: 0}
+    
+    for item in file_list:
+        file_size = item[3]
+        precompressed = is_precompressed(item[0])
+        pack_anyway = codec != 'none' and small_file_threshold > 0 and not precompressed
+        if file_size >= small_file_threshold and not pack_anyway:
+            large_files.append(item)
+            continue
+        
+        batch[precompressed].append(item)
+        batch_bytes[precompressed] += file_size
+        if batch_bytes[precompressed] >= batch_size:
+            batches.append(batch[precompressed])
+            batch[precompressed] = []
+            batch_bytes[precompressed] = 0
+    
+    batches.extend(group for group in batch.values() if group)
+    
+    return batches, large_files
+
+def upload_tar_batch(ssh, batch, target_dir, progress, journal=None, digests=None, policy=None):
+    """Stream a batch of files as a tar archive straight into a remote `tar -x`.
+    
+    Nothing is written to disk on either side besides the extracted files.
+    With a DigestLog, every file is hashed as it is packed. With a
+    CompressionPolicy the stream is compressed with the codec it picks for
+    the batch.
+    Returns the number of bytes uploaded.
+    """
+    codec = policy.codec_for([item[0] for item in batch]) if policy is not None else 'none'
+    channel = ssh.get_transport().open_session()
+    option = policy.tar_option(codec) if policy is not None else ''
+    channel.exec_command(f"tar -xf - -C {shlex.quote(target_dir)}{option}")
+    # Read stderr while sending, so warnings from the remote tar can't fill
+    # the channel window and stall the upload
+    stderr = []
+    stderr_thread = threading.Thread(target=lambda: stderr.append(channel.makefile_stderr('rb').read()),
+                                     daemon=True)
+    stderr_thread.start()
+    
+    sent = 0
+    packed = []
+    hashed = []
+    try:
+        with channel.makefile('wb') as remote_stdin:
+            writer = CompressingWriter(remote_stdin, codec, policy.threads if policy is not None else 1,
+                                       rate_limiter(ssh))
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                for local_file_path, remote_dir, remote_file_path, file_size in batch:
+                    arcname = os.path.relpath(remote_file_path, target_dir)
+                    with open(local_file_path, 'rb') as f:
+                        tarinfo = tar.gettarinfo(fileobj=f, arcname=arcname)
+                        if digests is not None:
+                            digest = digests.new()
+                            hashed.append((arcname, tarinfo.size, digest))
+                            f = HashingReader(f, digest)
+                        tar.addfile(tarinfo, f)
+                    # Drop the member list tarfile keeps: its members point back at it, and
+                    # the cycle would hold the channel until the garbage collector runs
+                    tar.members = []
+                    sent += tarinfo.size
+                    packed.append((arcname, tarinfo.size))
+            writer.close()
+        channel.shutdown_write()
+        
+        exit_status = channel.recv_exit_status()
+        stderr_thread.join()
+        if exit_status != 0:
+            error = b''.join(stderr).decode()
+            raise Exception(f"Remote tar extraction failed: {error}")
+        # Files only count as uploaded once the remote tar extracted them
+        for arcname, size in packed:
+            progress.add_bytes(size)
+            progress.file_done(arcname, size)
+        for item in batch:
+            journal_file(journal, target_dir, item)
+        for arcname, size, digest in hashed:
+            digests.add(arcname, size, digest)
+        if policy is not None:
+            policy.report.add(codec, writer.raw_bytes, writer.wire_bytes, writer.cpu_seconds)
+    finally:
+        channel.close()
+    
+    return sent
+
+def upload_file_list(ssh, file_list, target_dir, progress, workers=1,
+                     small_file_threshold=SMALL_FILE_THRESHOLD, batch_size=TAR_BATCH_SIZE, journal=None,
+                     backend='auto', request_size=DEFAULT_REQUEST_SIZE, digests=None, policy=None,
+                     controller=None, known_dirs=None, failures=None):
+    """Upload (local_path, remote_dir, remote_path, size) entries below target_dir.
+    
+    Files go through plan_upload as given; backend picks how the direct ones
+    are sent and policy how the tar batches are compressed. With an
+    AdaptiveConcurrency the number of channels follows it instead of workers.
+    known_dirs is the set of remote directories this transfer already created.
+    Returns the number of files that failed, and adds their entries to the
+    list failures if given. A dropped connection is raised instead, so the
+    caller can reconnect and resume.
+    """
+    batches, large_files = plan_upload(file_list, small_file_threshold, batch_size,
+                                       policy.codec if policy is not None else 'none')
+    failed = 0
+    
+    # Create every directory needed by the direct transfers once, up front
+    ensure_remote_dirs(ssh, set(item[1] for item in large_files), known_dirs)
+    
+    def send_batch(batch):
+        if controller is None:
+            return upload_tar_batch(ssh, batch, target_dir, progress, journal, digests, policy)
+        with controller.slot():
+            return upload_tar_batch(ssh, batch, target_dir, progress, journal, digests, policy)
+    
+    if batches:
+        pool_size = controller.maximum if controller is not None else max(1, workers)
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            futures = [executor.submit(send_batch, batch) for batch in batches]
+            for batch, future in zip(batches, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    if is_connection_lost(ssh, e):
+                        raise
+                    failed += len(batch)
+                    if failures is not None:
+                        failures.extend(batch)
+                    progress.error(f"Error uploading batch of {len(batch)} small files: {str(e)}")
+    
+    if large_files:
+        failed_files = upload_files_parallel(ssh, large_files, progress, max(1, workers), target_dir, journal,
+                                             backend, request_size, digests, controller)
+        failed += len(failed_files)
+        if failures is not None:
+            failures.extend(failed_files)
+    
+    return failed
 
-def upload_file(ssh, scp, localDIR, clusterDIR, filename):
-    """Upload a single file to the cluster."""
+def upload_file(ssh, scp, localDIR, clusterDIR, filename, delta=False, block_size=DEFAULT_BLOCK_SIZE,
+                resume=False, reconnect=None, backend='auto', request_size=DEFAULT_REQUEST_SIZE, stripes=1,
+                verify=False, algorithm=DEFAULT_ALGORITHM, manifest=None):
+    """Upload a single file to the cluster.
+    
+    The transfer backend is picked from the file size by choose_backend
+    unless backend names one ('scp', 'sftp' or 'tar'). With stripes > 1,
+    files of at least STRIPE_THRESHOLD bytes are split into that many byte
+    ranges sent concurrently over separate SFTP channels.
+    
+    With delta=True only the blocks that differ from the existing remote copy
+    are sent, falling back to a full upload if the remote helper can't run.
+    With resume=True the file is sent over SFTP into a partial file that a
+    later run (or an automatic reconnect through reconnect()) continues.
+    With verify=True the file is hashed as it is sent and compared with a
+    hash computed on the cluster; on a mismatch it is sent again, and the
+    result is written to a manifest (see clustertools.verify). Delta
+    transfers already check a SHA-256 of the result and aren't hashed again.
+    """
     file_path_local = os.path.join(localDIR, filename)
     file_path_cluster = os.path.join(clusterDIR, filename)
 
@@ -60,18 +343,118 @@ def upload_file(ssh, scp, localDIR, clusterDIR, filename):
     # Ensure the remote directory exists
     remote_dir = os.path.dirname(file_path_cluster)
     try:
-        ssh.exec_command(f"mkdir -p {remote_dir}")
+        ensure_remote_dirs(ssh, [remote_dir])
     except Exception as e:
         print(f"{YELLOW}Warning creating remote directory: {str(e)}{RESET}")
     
-    # Upload the file (progress bar handled by SCPClient)
-    scp.put(file_path_local, file_path_cluster)
+    if delta:
+        try:
+            upload_delta(ssh, file_path_local, file_path_cluster, block_size)
+            print(f'{GREEN}File {filename} upload complete.{RESET}')
+            return True
+        except Exception as e:
+            print(f"{YELLOW}Delta transfer failed ({str(e).strip()}), uploading the whole file{RESET}")
+    
+    digests = DigestLog(algorithm) if verify else None
+    
+    def send():
+        if resume:
+            progress = TransferMetrics('Uploading', file_size, 1, name=filename)
+            
+            def transfer(ssh):
+                sent_so_far = [0]
+                # A fresh hash per attempt; resumable_upload rehashes the part sent before
+                digest = digests.new() if digests is not None else None
+                
+                def callback(sent, size):
+                    progress.add_bytes(sent - sent_so_far[0])
+                    sent_so_far[0] = sent
+                
+                sftp = ssh.open_sftp()
+                try:
+                    resumable_upload(sftp, file_path_local, file_path_cluster, callback=callback, digest=digest)
+                except Exception:
+                    progress.add_bytes(-sent_so_far[0])
+                    raise
+                finally:
+                    sftp.close()
+                progress.file_done()
+                return digest
+            
+            digest = with_reconnect(transfer, ssh, reconnect)
+            progress.finish()
+        elif stripes > 1 and file_size >= STRIPE_THRESHOLD:
+            # Every stripe is already checked against a remote hash of its range
+            digest = None
+            progress = TransferMetrics('Uploading', file_size, 1, name=filename)
+            striped_upload(ssh, file_path_local, file_path_cluster, stripes,
+                           lambda sent, size: progress.set_bytes(sent), request_size)
+            progress.file_done()
+            progress.finish()
+        else:
+            digest = digests.new() if digests is not None else None
+            name = choose_backend(file_size, backend, verify)
+            print(f"Using {name} backend")
+            transfer = make_backend(name, ssh, request_size)
+            try:
+                if name == 'scp':
+                    # Progress bar handled by SCPClient
+                    transfer.upload(file_path_local, file_path_cluster, digest=digest)
+                else:
+                    progress = TransferMetrics('Uploading', file_size, 1, name=filename)
+                    transfer.upload(file_path_local, file_path_cluster, lambda sent, size: progress.set_bytes(sent),
+                                    digest)
+                    progress.file_done()
+                    progress.finish()
+            finally:
+                transfer.close()
+        if digests is not None:
+            digests.add(filename, file_size, digest)
     
+    send()
     print(f'{GREEN}File {filename} upload complete.{RESET}')
+    if verify:
+        return verify_and_record(ssh, clusterDIR, digests, lambda paths: send(), 'upload', localDIR, manifest)
     return True
 
-def upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots=True):
-    """Upload a folder to the cluster."""
+def upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots=True, workers=1,
+                  small_file_threshold=SMALL_FILE_THRESHOLD, batch_size=TAR_BATCH_SIZE,
+                  sync=False, delete=False, resume=False, reconnect=None, hostname=None,
+                  backend='auto', request_size=DEFAULT_REQUEST_SIZE, verify=False, algorithm=DEFAULT_ALGORITHM,
+                  manifest=None, compression='auto', link_rate=None, index=None, filters=None, adaptive=False,
+                  force_delete=False):
+    """Upload a folder to the cluster.
+    
+    Files smaller than small_file_threshold bytes are streamed in tar batches of
+    about batch_size bytes into a remote `tar -x`; set it to 0 to disable packing.
+    With workers > 1 files are sent concurrently over that many channels.
+    With sync=True only files that are new or changed since the last upload are
+    sent, and delete=True also removes remote files that no longer exist locally.
+    With resume=True finished files are recorded in a local journal so a rerun
+    skips them, partial files are continued, and a dropped connection is
+    re-established through reconnect() with backoff.
+    backend='tar' packs every file and 'scp' or 'sftp' disable packing.
+    With verify=True every file sent is hashed on the way out and checked
+    against one batched remote hash pass; mismatched files are sent again
+    and the result is written to a manifest.
+    compression is 'auto' or a codec from COMPRESSION_MODES for the tar
+    batches; auto picks one from a sample of the files and the link
+    throughput (link_rate in bytes/s if known, measured otherwise).
+    With index (a HostIndex) the sync listing comes from the local metadata
+    cache, and the directories written are marked for relisting.
+    filters (a TransferFilter) is applied while walking the folder: excluded
+    directories aren't descended into and only matching files are sent or
+    compared, so --delete leaves excluded remote files alone.
+    With adaptive=True workers is only the starting number of channels: one
+    is added while that raises the throughput and dropped when it doesn't.
+    A missing local folder raises FileNotFoundError, and delete refuses to
+    empty the remote folder because the local one lists no files unless
+    force_delete=True.
+    Returns False if any file failed to upload.
+    """
+    if not os.path.isdir(localDIR):
+        raise FileNotFoundError(f"Local directory {localDIR} does not exist")
+    
     # Get local folder name
     folder_name = os.path.basename(os.path.normpath(localDIR))
     target_dir = os.path.join(clusterDIR, folder_name)
@@ -79,12 +462,12 @@ def upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots=True):
     print(f"{YELLOW}Preparing to upload folder {folder_name} to {clusterDIR}...{RESET}")
     
     # Create the target directory on the remote server - WAIT FOR COMPLETION
-    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {target_dir}")
-    exit_status = stdout.channel.recv_exit_status()
-    if exit_status != 0:
-        error = stderr.read().decode()
-        print(f"{RED}Error creating directory: {error}{RESET}")
-        raise Exception(f"Failed to create directory {target_dir}: {error}")
+    known_dirs = set()
+    try:
+        ensure_remote_dirs(ssh, [target_dir], known_dirs)
+    except Exception as e:
+        print(f"{RED}Error creating directory: {str(e)}{RESET}")
+        raise
     
     # Calculate total upload size for reporting
     total_size = 0
@@ -93,13 +476,18 @@ def upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots=True):
     
     # Walk through the local directory and collect file information
     for dirpath, dirnames, filenames in os.walk(localDIR):
+        # Use a cleaner relative path construction
+        rel_path = os.path.relpath(dirpath, localDIR)
+        if filters:
+            # Prune excluded directories before os.walk descends into them
+            rel_dir = rel_path.replace("\\", "/")
+            dirnames[:] = [d for d in dirnames
+                           if not filters.excludes_dir(d if rel_dir == "." else f"{rel_dir}/{d}")]
         for filename in filenames:
             if skip_dots and filename.startswith("._"):
                 continue
                 
             local_file_path = os.path.join(dirpath, filename)
-            # Use a cleaner relative path construction
-            rel_path = os.path.relpath(dirpath, localDIR)
             remote_dir = os.path.normpath(os.path.join(target_dir, rel_path)).replace("\\", "/")
             
             # Avoid using "./" in paths
@@ -109,94 +497,321 @@ def upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots=True):
                 remote_file_path = os.path.join(remote_dir, filename).replace("\\", "/")
             
             file_size = os.path.getsize(local_file_path)
+            if filters:
+                rel_file = os.path.relpath(local_file_path, localDIR).replace("\\", "/")
+                mtime = os.path.getmtime(local_file_path) if filters.needs_mtime else None
+                if not filters.matches(rel_file, file_size, mtime):
+                    continue
             total_size += file_size
             file_count += 1
             file_list.append((local_file_path, remote_dir, remote_file_path, file_size))
     
     print(f"Found {file_count} files to upload, total size: {round(total_size / (1024*1024), 2)} MB")
     
-    # Create all needed directories first in a single operation
-    all_dirs = set(item[1] for item in file_list)
-    remote_dirs_str = " ".join(all_dirs)
-    stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {remote_dirs_str}")
-    exit_status = stdout.channel.recv_exit_status()
+    if sync:
+        # Only send files that are new or differ in size/mtime from the cluster copy
+        print(f"{YELLOW}Comparing with remote folder...{RESET}")
+        local_files = {os.path.relpath(item[2], target_dir): (item[3], os.path.getmtime(item[0]))
+                       for item in file_list}
+        if index is not None:
+            remote_files = index.files(ssh, target_dir)
+            remote_files = filters.select(remote_files) if filters else remote_files
+        else:
+            # The destination may not exist yet
+            remote_files = remote_manifest(ssh, target_dir, filters, missing_ok=True)
+        changed, extraneous = compare_manifests(local_files, remote_files)
+        
+        changed = set(changed)
+        file_list = [item for item in file_list if os.path.relpath(item[2], target_dir) in changed]
+        total_size = sum(item[3] for item in file_list)
+        print(f"{len(file_list)} of {file_count} files are new or changed ({round(total_size / (1024*1024), 2)} MB)")
+        file_count = len(file_list)
+        
+        if delete:
+            if skip_dots:
+                # Skipped files are never considered extraneous
+                extraneous = [path for path in extraneous if not os.path.basename(path).startswith("._")]
+            if extraneous:
+                check_delete(local_files, extraneous, localDIR, force_delete)
+                print(f"{YELLOW}Deleting {len(extraneous)} remote files missing locally...{RESET}")
+                delete_remote_files(ssh, target_dir, extraneous)
+                if index is not None:
+                    index.mark_changed(target_dir, {os.path.dirname(path) for path in extraneous})
+        
+        if not file_list:
+            print(f"{GREEN}Remote folder is already up to date.{RESET}")
+            return True
+    
+    # Pack small files into tar batches, send the rest file by file
+    if backend == 'tar':
+        small_file_threshold = float('inf')
+    elif backend != 'auto':
+        small_file_threshold = 0
+    policy = CompressionPolicy(compression, link_rate)
+    if small_file_threshold > 0:
+        policy.decide_upload(ssh, [item[0] for item in file_list], streams=max(1, workers))
+    batches, large_files = plan_upload(file_list, small_file_threshold, batch_size, policy.codec)
+    packed_files = sum(len(batch) for batch in batches)
+    packed_size = sum(item[3] for batch in batches for item in batch)
+    direct_size = sum(item[3] for item in large_files)
     
-    if exit_status != 0:
-        error = stderr.read().decode()
-        print(f"{RED}Error creating directories: {error}{RESET}")
-        # Continue anyway - we'll try to create directories individually
+    journal = None
+    if resume:
+        journal = TransferJournal('upload', hostname, localDIR, target_dir)
+        finished = [item for item in file_list
+                    if journal.is_done(os.path.relpath(item[2], target_dir), item[3], os.path.getmtime(item[0]))]
+        if finished:
+            print(f"Skipping {len(finished)} files completed by an earlier interrupted run")
     
     # Upload files with progress tracking
-    uploaded_size = 0
-    start_time = time.time()
+    progress = TransferMetrics('Uploading', total_size, file_count, name=folder_name, direction='upload')
+    progress.record_rtt(measure_rtt(ssh))
+    progress.phase('transfer')
+    start_time = progress.start_time
+    digests = DigestLog(algorithm) if verify else None
     
-    for i, (local_file_path, remote_dir, remote_file_path, file_size) in enumerate(file_list, 1):
-        # Make sure the remote directory exists - wait for completion this time
-        stdin, stdout, stderr = ssh.exec_command(f"mkdir -p {remote_dir}")
-        exit_status = stdout.channel.recv_exit_status()
-        
-        if exit_status != 0:
-            error = stderr.read().decode()
-            print(f"{RED}Error creating directory {remote_dir}: {error}{RESET}")
-            continue
-            
-        # Calculate overall progress
-        percent = int((uploaded_size / total_size) * 100) if total_size > 0 else 0
-        elapsed = time.time() - start_time
-        speed = uploaded_size / elapsed / (1024*1024) if elapsed > 0 else 0
-        eta = (total_size - uploaded_size) / (speed * 1024 * 1024) if speed > 0 else 0
-        eta_str = f"{int(eta / 60)}m {int(eta % 60)}s" if eta > 0 else "calculating..."
-        
-        # Display overall progress
-        print(f"\rUploading: {i}/{file_count} files ({percent}%, {speed:.2f} MB/s, ETA: {eta_str})", end="", flush=True)
-        
-        try:
-            # Upload the file
-            filename = os.path.basename(local_file_path)
-            scp.put(local_file_path, remote_file_path)
-            
-            # Update progress
-            uploaded_size += file_size
-        except Exception as e:
-            print(f"\n{RED}Error uploading {local_file_path}: {str(e)}{RESET}")
-            # Continue with next file
+    def transfer(ssh):
+        remaining = file_list
+        if journal is not None:
+            remaining = [item for item in file_list
+                         if not journal.is_done(os.path.relpath(item[2], target_dir), item[3], os.path.getmtime(item[0]))]
+        return upload_file_list(ssh, remaining, target_dir, progress, workers,
+                                small_file_threshold, batch_size, journal, backend, request_size, digests, policy,
+                                controller, known_dirs)
+    
+    controller = None
+    if adaptive:
+        limiter = rate_limiter(ssh)
+        controller = AdaptiveConcurrency(max(1, workers), max(MAX_CHANNELS, workers),
+                                         rate_cap=limiter.rate if limiter else None)
+        controller.start(progress)
+    
+    try:
+        if resume:
+            failed = with_reconnect(transfer, ssh, reconnect)
+            if not failed:
+                journal.remove()
+            else:
+                journal.close()
+        else:
+            failed = transfer(ssh)
+    finally:
+        if index is not None:
+            # Overwritten files keep their directory's mtime, so name the directories explicitly
+            index.mark_changed(target_dir, {os.path.relpath(item[1], target_dir) for item in file_list})
+        if controller is not None:
+            controller.stop()
+    progress.finish()
     
     # Final progress update
+    uploaded_size = progress.bytes
     elapsed = time.time() - start_time
     speed = total_size / elapsed / (1024*1024) if elapsed > 0 and uploaded_size > 0 else 0
-    print(f"\r{GREEN}Upload complete: {file_count} files ({round(total_size/(1024*1024), 2)} MB) at {speed:.2f} MB/s{RESET}")
+    if failed:
+        print(f"{RED}Upload finished with errors: {failed} of {file_count} files failed "
+              f"({round(total_size/(1024*1024), 2)} MB) at {speed:.2f} MB/s{RESET}")
+    else:
+        print(f"{GREEN}Upload complete: {file_count} files ({round(total_size/(1024*1024), 2)} MB) at {speed:.2f} MB/s{RESET}")
+    print(f"  Packed: {packed_files} files ({round(packed_size/(1024*1024), 2)} MB) in {len(batches)} tar batches")
+    print(f"  Direct: {len(large_files)} files ({round(direct_size/(1024*1024), 2)} MB)")
+    if failed:
+        print(f"  Failed: {failed} files")
+    policy.report.print_summary()
+    
+    if failed:
+        return False
+    
+    if verify:
+        if reconnect is not None and not ssh.get_transport().is_active():
+            ssh, _ = reconnect()
+        items = {os.path.relpath(item[2], target_dir): item for item in file_list}
+        
+        def retransmit(paths):
+            retry = [items[path] for path in paths]
+            retry_progress = TransferMetrics('Retransmitting', sum(item[3] for item in retry), len(retry),
+                                             name=folder_name, direction='upload')
+            upload_file_list(ssh, retry, target_dir, retry_progress, workers,
+                             small_file_threshold, batch_size, None, backend, request_size, digests, policy,
+                             known_dirs=known_dirs)
+            retry_progress.finish()
+        
+        return verify_and_record(ssh, target_dir, digests, retransmit, 'upload', localDIR, manifest)
     
     return True
 
-def local2cluster(localDIR, clusterDIR, filename=None, username=None, password=None, hostname='sftp.fmrib.ox.ac.uk', skip_dots=True):
+def rename_remote(ssh, target_dir, moves):
+    """Apply (source, destination, file_pairs) renames below target_dir in one remote shell.
+    
+    A rename whose source is gone or whose destination already exists is
+    skipped. Returns the moves that weren't made.
+    """
+    script = ''
+    for i, (source, destination, pairs) in enumerate(moves):
+        source_path = shlex.quote(os.path.join(target_dir, source))
+        destination_path = shlex.quote(os.path.join(target_dir, destination))
+        parent = shlex.quote(os.path.dirname(os.path.join(target_dir, destination)))
+        script += (f"if [ -e {source_path} ] && [ ! -e {destination_path} ] && mkdir -p {parent} "
+                   f"&& mv {source_path} {destination_path}; then :; else echo {i}; fi\n")
+    
+    channel = ssh.get_transport().open_session()
+    try:
+        # The script goes through stdin so no argument list limit applies
+        channel.exec_command("sh -s")
+        channel.sendall(script.encode('utf-8', 'surrogateescape'))
+        channel.shutdown_write()
+        output = channel.makefile('rb').read().decode()
+        channel.recv_exit_status()
+    finally:
+        channel.close()
+    
+    skipped = set(int(line) for line in output.split())
+    return [move for i, move in enumerate(moves) if i in skipped]
+
+def watch_folder(ssh, scp, localDIR, clusterDIR, skip_dots=True, workers=1,
+                 small_file_threshold=SMALL_FILE_THRESHOLD, batch_size=TAR_BATCH_SIZE, delete=False,
+                 reconnect=None, hostname=None, backend='auto', request_size=DEFAULT_REQUEST_SIZE,
+                 compression='auto', link_rate=None, index=None, filters=None, debounce=DEBOUNCE, poll=None,
+                 stop=None, force_delete=False):
+    """Keep the cluster copy of a folder in step with local changes until interrupted.
+    
+    The folder is first brought up to date as by upload_folder(sync=True).
+    From then on the changes reported by a watcher (inotify, or a walk of
+    the folder every poll seconds) are collected until debounce seconds
+    pass without one, or MAX_DELAY since the first, and applied as one
+    batch: changed files are sent through upload_file_list and, with
+    delete=True, renamed files and directories are renamed on the cluster
+    and those deleted locally are deleted remotely. Without delete nothing
+    is removed on the cluster and renamed files are sent under their new
+    names. A dropped connection
+    is re-established through reconnect(). Runs until Ctrl-C, or until the
+    threading.Event stop is set.
+    """
+    folder_name = os.path.basename(os.path.normpath(localDIR))
+    target_dir = os.path.join(clusterDIR, folder_name)
+    
+    # Watch before the first upload so nothing changed during it is missed
+    watcher = open_watcher(localDIR, skip_dots, filters, poll)
+    pending = set()
+    try:
+        state = local_manifest(localDIR, skip_dots, filters)
+        upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots, workers, small_file_threshold, batch_size,
+                      sync=True, delete=delete, hostname=hostname, backend=backend, request_size=request_size,
+                      compression=compression, link_rate=link_rate, index=index, filters=filters,
+                      force_delete=force_delete)
+        policy = CompressionPolicy(compression, link_rate)
+        if small_file_threshold > 0 and backend in ('auto', 'tar') and state:
+            policy.decide_upload(ssh, [os.path.join(localDIR, path) for path in state], streams=max(1, workers))
+        
+        def apply(ssh):
+            if delete:
+                skipped = rename_remote(ssh, target_dir, changes.moves) if changes.moves else []
+            else:
+                # The old paths stay on the cluster, so renamed files go up as new ones
+                skipped = changes.moves
+            # A rename the cluster couldn't make is done the long way
+            uploads = changes.uploads + [destination for move in skipped for source, destination in move[2]]
+            deletes = changes.deletes + [source for move in skipped for source, destination in move[2]] if delete else []
+            removed_dirs = changes.removed_dirs if delete else []
+            failures = []
+            
+            if uploads:
+                items = []
+                for path in uploads:
+                    remote_file_path = os.path.join(target_dir, path)
+                    items.append((os.path.join(localDIR, path), os.path.dirname(remote_file_path),
+                                  remote_file_path, changes.scanned[path][0]))
+                progress = TransferMetrics('Uploading', sum(item[3] for item in items), len(items),
+                                           name=folder_name, direction='upload')
+                progress.phase('transfer')
+                try:
+                    # Each batch opens its own backends, so a reconnect never leaves a stale SCPClient behind
+                    failed = upload_file_list(ssh, items, target_dir, progress, workers,
+                                              small_file_threshold, batch_size, backend=backend,
+                                              request_size=request_size, policy=policy, failures=failures)
+                finally:
+                    progress.finish()
+                if failed:
+                    print(f"{RED}{failed} files failed to upload; they are sent again when they next change{RESET}")
+            if deletes:
+                delete_remote_files(ssh, target_dir, deletes)
+            if removed_dirs:
+                delete_remote_files(ssh, target_dir, removed_dirs, recursive=True)
+            
+            if index is not None:
+                touched = uploads + deletes + removed_dirs + [path for move in changes.moves for path in move[:2]]
+                index.mark_changed(target_dir, {os.path.dirname(path) for path in touched})
+            return ssh, [os.path.relpath(item[2], target_dir) for item in failures]
+        
+        print(f"{YELLOW}Watching {localDIR} for changes ({watcher.method}), press Ctrl-C to stop...{RESET}")
+        first = last = None
+        while stop is None or not stop.is_set():
+            timeout = max(0.05, min(last + debounce, first + MAX_DELAY) - time.time()) if pending else 1.0
+            changed = watcher.changes(timeout)
+            now = time.time()
+            if changed:
+                pending |= changed
+                first = first or now
+                last = now
+            if not pending or (now - last < debounce and now - first < MAX_DELAY):
+                continue
+            
+            changes = plan_changes(localDIR, state, pending, skip_dots, filters)
+            pending = set()
+            first = last = None
+            if changes:
+                print(f"{time.strftime('%H:%M:%S')} {changes.summary()}")
+                ssh, failed = with_reconnect(apply, ssh, reconnect)
+                # Files that failed to upload keep their old state, so their next change resends them
+                changes.commit(state, failed)
+    except KeyboardInterrupt:
+        if pending:
+            print(f"\n{YELLOW}Stopped watching; {len(pending)} pending changes are picked up by the next run{RESET}")
+        else:
+            print(f"\n{GREEN}Stopped watching.{RESET}")
+    finally:
+        watcher.close()
+
+def local2cluster(localDIR, clusterDIR, filename=None, username=None, password=None, hostname='sftp.fmrib.ox.ac.uk', skip_dots=True, workers=1,
+                  small_file_threshold=SMALL_FILE_THRESHOLD, batch_size=TAR_BATCH_SIZE,
+                  sync=False, delete=False, delta=False, block_size=DEFAULT_BLOCK_SIZE, resume=False,
+                  backend='auto', request_size=DEFAULT_REQUEST_SIZE, stripes=1,
+                  verify=False, algorithm=DEFAULT_ALGORITHM, manifest=None, compression='auto', link_speed=None,
+                  cache=None, filters=None, tune=False, bwlimit=None, watch=False, debounce=DEBOUNCE, poll=None,
+                  force_delete=False):
     """Transfer files from local machine to cluster server."""
-    # Use get_ssh_connection to reuse existing connections
-    ssh, scp = get_ssh_connection(username, password, hostname)
+    if watch and filename:
+        raise ValueError("Watch mode needs a folder, not a single file")
+    limiter = bandwidth_limiter(bwlimit * 125000 if bwlimit else None)
+    def reconnect():
+        # Use get_ssh_connection to reuse existing connections
+        ssh, scp = get_ssh_connection(username, password, hostname)
+        if tune:
+            tune_connection(ssh, 'upload', link_speed * 125000 if link_speed else None, request_size)
+        # The cap applies to this transfer only, not to the shared connection
+        ssh = limit_rate(ssh, limiter)
+        return ssh, scp
+    
+    ssh, scp = reconnect()
     
     try:
         if filename:
-            upload_file(ssh, scp, localDIR, clusterDIR, filename)
+            return upload_file(ssh, scp, localDIR, clusterDIR, filename, delta, block_size, resume, reconnect,
+                               backend, request_size, stripes, verify, algorithm, manifest)
+        elif watch:
+            return watch_folder(ssh, scp, localDIR, clusterDIR, skip_dots, workers, small_file_threshold, batch_size,
+                                delete, reconnect, hostname, backend, request_size, compression,
+                                link_speed * 125000 if link_speed else None, open_index(cache, hostname, ssh),
+                                as_filter(filters), debounce, poll, force_delete=force_delete)
         else:
-            upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots)
+            return upload_folder(ssh, scp, localDIR, clusterDIR, skip_dots, workers,
+                                 small_file_threshold, batch_size, sync, delete, resume, reconnect, hostname,
+                                 backend, request_size, verify, algorithm, manifest, compression,
+                                 link_speed * 125000 if link_speed else None, open_index(cache, hostname, ssh),
+                                 as_filter(filters), adaptive=tune, force_delete=force_delete)
     finally:
         # Don't close the connection here, just print completion message
         print(f'{GREEN}Operation complete.{RESET}')
 
-# Add a function to explicitly close the connection when needed
-def close_ssh_connection():
-    """Close the global SSH connection if it exists."""
-    global global_ssh, global_scp
-    if global_ssh is not None:
-        try:
-            global_scp.close()
-            global_ssh.close()
-            print(f"{GREEN}SSH connection closed{RESET}")
-        except Exception as e:
-            print(f"{RED}Error closing SSH connection: {str(e)}{RESET}")
-        finally:
-            global_ssh = None
-            global_scp = None
-
 def main():
     parser = argparse.ArgumentParser(description='Transfer files/folders from local machine to cluster server')
     parser.add_argument('-l', '--local_dir', required=True, help='Local directory path')
@@ -206,11 +821,64 @@ def main():
     parser.add_argument('--username', help='Username for cluster', default=None)
     parser.add_argument('--password', help='Password for cluster', default=None)
     parser.add_argument('--host', help='Hostname', default='sftp.fmrib.ox.ac.uk')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel upload channels for folders (default: 1)')
+    parser.add_argument('--small-file-threshold', type=int, default=SMALL_FILE_THRESHOLD,
+                        help='Pack files smaller than this many bytes into tar batches, 0 disables packing (default: 1 MiB)')
+    parser.add_argument('--batch-size', type=int, default=TAR_BATCH_SIZE,
+                        help='Target size in bytes of each tar batch of small files (default: 64 MiB)')
+    parser.add_argument('--sync', action='store_true', help='Only upload files that are new or changed on the cluster')
+    parser.add_argument('--delete', action='store_true', help='With --sync, delete remote files that no longer exist locally')
+    parser.add_argument('--force-delete', action='store_true',
+                        help='Let --delete empty the remote folder when the local folder lists no files')
+    parser.add_argument('--delta', action='store_true', help='Send only the changed blocks of a single file (-f)')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE, help='Block size in bytes for --delta (default: 64 KiB)')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted upload and reconnect automatically if the connection drops')
+    parser.add_argument('--backend', choices=BACKEND_NAMES, default='auto',
+                        help='Transfer backend; auto picks one from the file sizes (default: auto)')
+    parser.add_argument('--request-size', type=int, default=DEFAULT_REQUEST_SIZE,
+                        help='Bytes per SFTP write request for the sftp backend (default: 32768)')
+    parser.add_argument('--stripes', type=int, default=1,
+                        help='Split a single large file (-f) into this many byte ranges sent concurrently (default: 1)')
+    parser.add_argument('--progress', choices=PROGRESS_MODES, default='bar',
+                        help='Progress output: terminal bar, JSON lines on stderr, or none (default: bar)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Hash files as they are sent, check them against the cluster copies and resend mismatches')
+    parser.add_argument('--verify-algorithm', choices=ALGORITHMS, default=DEFAULT_ALGORITHM,
+                        help='Hash used by --verify; xxh128 needs the xxhash package and xxhsum on the cluster (default: sha256)')
+    parser.add_argument('--manifest', default=None,
+                        help='Where --verify writes its manifest (default: ~/.cache/clustertools/manifests)')
+    parser.add_argument('--compression', choices=COMPRESSION_MODES, default='auto',
+                        help='Codec for tar batches; auto picks one from a data sample and the link speed (default: auto)')
+    parser.add_argument('--link-speed', type=float, default=None,
+                        help='Link throughput in Mbit/s used by --compression auto instead of measuring it')
+    parser.add_argument('--cache', type=float, nargs='?', const=DEFAULT_TTL, default=None, metavar='SECONDS',
+                        help=f'Answer the --sync listing from the local metadata cache, trusting it for SECONDS '
+                             f'before refreshing it (default when given: {DEFAULT_TTL})')
+    parser.add_argument('--tune', action='store_true',
+                        help='Measure RTT and throughput, size channel windows to the bandwidth-delay product '
+                             'and add or drop parallel channels (starting from -j) as the throughput responds')
+    parser.add_argument('--bwlimit', type=float, default=None, metavar='MBIT',
+                        help='Cap the transfer at this many Mbit/s')
+    parser.add_argument('--watch', action='store_true',
+                        help='After uploading, keep watching the folder and upload changes as they happen (Ctrl-C to stop)')
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE, metavar='SECONDS',
+                        help=f'With --watch, wait for this long without changes before uploading a batch (default: {DEBOUNCE:g})')
+    parser.add_argument('--poll', type=float, nargs='?', const=POLL_INTERVAL, default=None, metavar='SECONDS',
+                        help=f'With --watch, detect changes by walking the folder every SECONDS instead of with inotify, '
+                             f'e.g. on network filesystems (default when given: {POLL_INTERVAL:g})')
+    add_filter_arguments(parser)
     
     args = parser.parse_args()
+    set_progress_output(args.progress)
     
     try:
-        local2cluster(args.local_dir, args.cluster_dir, args.filename, args.username, args.password, args.host, args.skip_dots)
+        local2cluster(args.local_dir, args.cluster_dir, args.filename, args.username, args.password, args.host, args.skip_dots, args.jobs,
+                      args.small_file_threshold, args.batch_size, args.sync, args.delete,
+                      args.delta, args.block_size, args.resume,
+                      args.backend, args.request_size, args.stripes,
+                      args.verify, args.verify_algorithm, args.manifest, args.compression, args.link_speed,
+                      args.cache, filter_from_args(args), args.tune, args.bwlimit, args.watch, args.debounce, args.poll,
+                      args.force_delete)
     finally:
         close_ssh_connection()
 
@@ -1,7 +1,10 @@
+import os
 import paramiko
 import getpass
+import threading
 import time
 from scp import SCPClient
+from clustertools.metrics import TransferMetrics
 
 # Color constants
 RED = '\033[91m'
@@ -9,55 +12,24 @@ GREEN = '\033[92m'
 YELLOW = '\033[93m'
 RESET = '\033[0m'
 
-# Global variables to track progress
-_last_percent = 0
-_last_update_time = 0
-_file_size = 0
-_start_time = 0
+# SCP progress state per thread, so concurrent transfers don't clobber each other
+_scp_transfers = threading.local()
 
 def progress(filename, size, sent):
-    """Simple progress tracking for SCP transfers."""
-    global _last_percent, _last_update_time, _file_size, _start_time
-    
-    # Initialize tracking variables on first call
-    if sent == 0:
-        _file_size = size
-        _last_percent = 0
-        _start_time = time.time()
-        _last_update_time = 0
-        print(f"Downloading {filename} ({round(size / (1024*1024), 2)} MB)...")
-    
-    # Calculate current progress
-    percent = int((sent / size) * 100)
-    
-    # Only update the display if percent changed or it's been more than a second
-    current_time = time.time()
-    if percent != _last_percent or (current_time - _last_update_time) > 1:
-        _last_percent = percent
-        _last_update_time = current_time
-        
-        # Calculate speed
-        elapsed = current_time - _start_time
-        if elapsed > 0:
-            speed = sent / elapsed / (1024*1024)  # MB/s
-            
-            # Calculate ETA
-            if sent > 0:
-                eta = elapsed * (size - sent) / sent
-                eta_str = f"{int(eta / 60)}m {int(eta % 60)}s"
-            else:
-                eta_str = "calculating..."
-                
-            # Print progress bar
-            bar_length = 30
-            filled_length = int(bar_length * percent // 100)
-            bar = '█' * filled_length + '░' * (bar_length - filled_length)
-            
-            print(f"\r[{bar}] {percent}% {round(sent/(1024*1024), 1)}/{round(size/(1024*1024), 1)} MB ({speed:.2f} MB/s) ETA: {eta_str}", end="", flush=True)
-            
-            # Print newline when complete
-            if sent >= size:
-                print("\nDownload complete!")
+    """SCP progress callback reporting through clustertools.metrics."""
+    metrics = getattr(_scp_transfers, 'metrics', None)
+    if metrics is not None and metrics.end_time is not None and sent >= size > 0:
+        # scp repeats the final callback; the transfer is already reported
+        return
+    if sent == 0 or metrics is None or metrics.end_time is not None:
+        if isinstance(filename, bytes):
+            filename = filename.decode('utf-8', 'replace')
+        metrics = TransferMetrics('Transferring', size, 1, name=os.path.basename(filename))
+        _scp_transfers.metrics = metrics
+    metrics.set_bytes(sent)
+    if sent >= size:
+        metrics.file_done()
+        metrics.finish()
 
 def login2ssh(username=None, password=None, hostname=None, max_retries=3):
     if username is None:
@@ -0,0 +1,285 @@
+"""Transfer metrics and progress events.
+
+Every transfer gets a TransferMetrics object that counts bytes and files,
+times phases and records per-file latency and the connection round-trip
+time. Changes are published as event dicts to subscribers registered with
+subscribe(). The terminal progress bar is one such subscriber and
+JSONLinesWriter another, for scripts and schedulers:
+
+    {"event": "start", "transfer": 3, "label": "Uploading", "total_bytes": 1048576, "total_files": 12, ...}
+    {"event": "progress", "transfer": 3, "bytes": 524288, "files": 6, "rate": 2097152.0, "eta": 0.25, ...}
+    {"event": "file", "transfer": 3, "path": "sub/a.txt", "size": 4096, "latency": 0.012, ...}
+    {"event": "phase", "transfer": 3, "phase": "transfer", "seconds": 0.5, ...}
+    {"event": "rtt", "transfer": 3, "seconds": 0.021, ...}
+    {"event": "error", "transfer": 3, "message": "...", ...}
+    {"event": "end", "transfer": 3, "bytes": 1048576, "files": 12, "seconds": 0.51, "phases": {...}, ...}
+
+Standard phase names are size_probe, archive, transfer and extract.
+
+A transfer started inside cancel_scope(event) raises TransferCancelled at
+its next progress update once event is set.
+"""
+import contextlib
+import itertools
+import json
+import sys
+import threading
+import time
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+# Minimum seconds between progress events of one transfer
+PROGRESS_INTERVAL = 0.2
+
+_subscribers = []
+_subscribers_lock = threading.Lock()
+_transfer_ids = itertools.count(1)
+
+# Cancel event of the transfers started by each thread
+_cancel_scope = threading.local()
+
+class TransferCancelled(BaseException):
+    """Raised inside a transfer whose cancel event was set.
+
+    Like KeyboardInterrupt it isn't an Exception, so per-file error handling
+    doesn't swallow it and the transfer unwinds through its cleanup.
+    """
+
+@contextlib.contextmanager
+def cancel_scope(event):
+    """Make transfers started in this thread stop once the threading.Event is set."""
+    previous = getattr(_cancel_scope, 'event', None)
+    _cancel_scope.event = event
+    try:
+        yield
+    finally:
+        _cancel_scope.event = previous
+
+def subscribe(callback):
+    """Call callback(event) for every event of every transfer."""
+    with _subscribers_lock:
+        _subscribers.append(callback)
+
+def unsubscribe(callback):
+    with _subscribers_lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+def emit(event):
+    with _subscribers_lock:
+        subscribers = list(_subscribers)
+    for callback in subscribers:
+        try:
+            callback(event)
+        except Exception as e:
+            # A broken subscriber must not break the transfer
+            print(f"\n{RED}Progress subscriber failed: {str(e)}{RESET}", file=sys.stderr)
+
+def measure_rtt(ssh):
+    """Time one request/reply exchange on the SSH transport, in seconds, or None."""
+    try:
+        transport = ssh.get_transport()
+        start = time.time()
+        # Servers answer unknown global requests with a failure message
+        transport.global_request('keepalive@openssh.com', wait=True)
+        return time.time() - start
+    except Exception:
+        return None
+
+class TransferMetrics:
+    """Thread-safe counters and timings of one transfer, published as events."""
+
+    def __init__(self, label, total_bytes=0, total_files=1, **info):
+        self.id = next(_transfer_ids)
+        self.label = label
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.info = info
+        self.bytes = 0
+        self.files = 0
+        self.errors = 0
+        self.rtt = None
+        self.phases = {}
+        self.file_latencies = []
+        self.start_time = time.time()
+        self.end_time = None
+        self._phase = None
+        self._phase_start = None
+        self._last_progress = 0
+        self._lock = threading.Lock()
+        # Threads helping this transfer check the event of the thread that started it
+        self.cancel_event = getattr(_cancel_scope, 'event', None)
+        self._emit('start', total_bytes=total_bytes, total_files=total_files, **info)
+
+    def _emit(self, kind, **fields):
+        event = {'event': kind, 'transfer': self.id, 'label': self.label, 'time': time.time()}
+        event.update(fields)
+        emit(event)
+
+    def _progress_event(self):
+        now = time.time()
+        elapsed = now - self.start_time
+        rate = self.bytes / elapsed if elapsed > 0 else 0
+        eta = (self.total_bytes - self.bytes) / rate if rate > 0 and self.total_bytes else None
+        return dict(bytes=self.bytes, files=self.files, total_bytes=self.total_bytes,
+                    total_files=self.total_files, rate=rate, eta=eta)
+
+    def _maybe_progress(self, force=False):
+        # Called with the lock held; throttles events so tiny files don't flood subscribers
+        now = time.time()
+        if not force and now - self._last_progress < PROGRESS_INTERVAL:
+            return None
+        self._last_progress = now
+        return self._progress_event()
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise TransferCancelled(f"{self.label} cancelled")
+
+    def add_bytes(self, n):
+        if n > 0:
+            self.check_cancelled()
+        with self._lock:
+            self.bytes += n
+            event = self._maybe_progress(force=self.total_bytes and self.bytes >= self.total_bytes)
+        if event is not None:
+            self._emit('progress', **event)
+
+    def set_bytes(self, n):
+        """Set the byte count outright, for callbacks that report running totals."""
+        self.check_cancelled()
+        with self._lock:
+            self.bytes = n
+            event = self._maybe_progress(force=self.total_bytes and n >= self.total_bytes)
+        if event is not None:
+            self._emit('progress', **event)
+
+    def file_done(self, path=None, size=None, latency=None):
+        """Count a finished file; latency is the seconds it took, if known."""
+        self.check_cancelled()
+        with self._lock:
+            self.files += 1
+            if latency is not None:
+                self.file_latencies.append(latency)
+            event = self._maybe_progress(force=self.files == self.total_files)
+        if path is not None:
+            self._emit('file', path=path, size=size, latency=latency)
+        if event is not None:
+            self._emit('progress', **event)
+
+    def error(self, message):
+        with self._lock:
+            self.errors += 1
+        self._emit('error', message=message)
+
+    def record_rtt(self, seconds):
+        if seconds is not None:
+            self.rtt = seconds
+            self._emit('rtt', seconds=seconds)
+
+    def phase(self, name):
+        """Start phase name, ending the current one; phases run one after another."""
+        if name is not None:
+            self.check_cancelled()
+        now = time.time()
+        with self._lock:
+            ended, started = self._phase, self._phase_start
+            self._phase, self._phase_start = name, now
+            if ended is not None:
+                self.phases[ended] = self.phases.get(ended, 0) + now - started
+        if ended is not None:
+            self._emit('phase', phase=ended, seconds=now - started)
+
+    def summary(self):
+        with self._lock:
+            latencies = sorted(self.file_latencies)
+            end = self.end_time or time.time()
+            summary = dict(bytes=self.bytes, files=self.files, errors=self.errors,
+                           seconds=end - self.start_time, phases=dict(self.phases), rtt=self.rtt)
+        if latencies:
+            summary['file_latency'] = {'mean': sum(latencies) / len(latencies),
+                                       'p50': latencies[len(latencies) // 2],
+                                       'max': latencies[-1]}
+        return summary
+
+    def finish(self):
+        """End the current phase and publish the summary."""
+        if self.end_time is not None:
+            return
+        self.phase(None)
+        with self._lock:
+            event = self._progress_event()
+        self._emit('progress', **event)
+        self.end_time = time.time()
+        self._emit('end', **self.summary())
+
+class ProgressBar:
+    """Terminal subscriber: a bar for single files, a file counter for folders."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def _write(self, text):
+        stream = self.stream or sys.stdout
+        stream.write(text)
+        stream.flush()
+
+    def __call__(self, event):
+        with self._lock:
+            kind = event['event']
+            if kind == 'start' and event.get('total_files') == 1 and event.get('name'):
+                self._write(f"{event['label']} {event['name']} ({round(event['total_bytes'] / (1024*1024), 2)} MB)...\n")
+            elif kind == 'progress':
+                self._write(self._format(event))
+            elif kind == 'error':
+                self._write(f"\n{RED}{event['message']}{RESET}\n")
+            elif kind == 'end':
+                self._write("\n")
+
+    def _format(self, event):
+        total_bytes = event['total_bytes']
+        percent = int(event['bytes'] / total_bytes * 100) if total_bytes > 0 else 0
+        speed = event['rate'] / (1024*1024)
+        eta = event['eta']
+        eta_str = f"{int(eta / 60)}m {int(eta % 60)}s" if eta is not None and speed > 0 else "calculating..."
+        if event['total_files'] == 1:
+            bar_length = 30
+            filled_length = int(bar_length * min(percent, 100) // 100)
+            bar = '█' * filled_length + '░' * (bar_length - filled_length)
+            return (f"\r[{bar}] {percent}% {round(event['bytes']/(1024*1024), 1)}/{round(total_bytes/(1024*1024), 1)} MB "
+                    f"({speed:.2f} MB/s) ETA: {eta_str}")
+        files = f"{event['files']}/{event['total_files']}" if event['total_files'] else event['files']
+        return f"\r{event['label']}: {files} files ({percent}%, {speed:.2f} MB/s, ETA: {eta_str})"
+
+class JSONLinesWriter:
+    """Subscriber writing every event as one JSON object per line."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            stream = self.stream or sys.stderr
+            stream.write(line + '\n')
+            stream.flush()
+
+PROGRESS_MODES = ['bar', 'json', 'none']
+
+terminal_bar = ProgressBar()
+_output = terminal_bar
+subscribe(_output)
+
+def set_progress_output(mode):
+    """Choose the built-in output: 'bar' (terminal, default), 'json' (JSON lines on stderr) or 'none'."""
+    global _output
+    unsubscribe(_output)
+    _output = {'bar': terminal_bar, 'json': JSONLinesWriter(), 'none': None}[mode]
+    if _output is not None:
+        subscribe(_output)
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+import paramiko
+
+from clustertools.verify import update_from_file
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+# Partial files are written next to their destination with this suffix
+PART_SUFFIX = '.clustertools-part'
+
+# Size and mtime of the source a partial file was copied from, kept next to it
+SOURCE_SUFFIX = PART_SUFFIX + '.source'
+
+# Journals of completed files for interrupted folder transfers
+JOURNAL_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'clustertools', 'journals')
+
+CHUNK_SIZE = 1024 * 1024
+
+# Errors that mean the connection went away rather than the transfer itself failing
+CONNECTION_ERRORS = (paramiko.SSHException, EOFError, socket.error, ConnectionError)
+
+def is_connection_lost(ssh, error):
+    """Return True if error was caused by a dropped SSH connection."""
+    if not isinstance(error, CONNECTION_ERRORS):
+        return False
+    transport = ssh.get_transport() if ssh is not None else None
+    return transport is None or not transport.is_active()
+
+def with_reconnect(operation, ssh, reconnect, max_retries=5, initial_delay=2, max_delay=60):
+    """Run operation(ssh), reconnecting with exponential backoff when the connection drops.
+
+    reconnect() must return a fresh (ssh, scp) pair. The operation is expected
+    to pick up where it stopped, so completed data isn't sent again.
+    """
+    delay = initial_delay
+    for attempt in range(max_retries + 1):
+        try:
+            return operation(ssh)
+        except Exception as e:
+            if reconnect is None or attempt == max_retries or not is_connection_lost(ssh, e):
+                raise
+            print(f"\n{YELLOW}Connection lost ({str(e) or type(e).__name__}), reconnecting in {delay}s...{RESET}")
+            time.sleep(delay)
+            delay = min(delay * 2, max_delay)
+            try:
+                ssh, scp = reconnect()
+            except Exception as reconnect_error:
+                print(f"{RED}Reconnect failed: {str(reconnect_error)}{RESET}")
+
+def part_source(size, mtime):
+    """Contents of the SOURCE_SUFFIX file recording what a partial file was copied from."""
+    return json.dumps({'size': size, 'mtime': mtime})
+
+def resumable_upload(sftp, local_path, remote_path, callback=None, digest=None):
+    """Upload a file over SFTP, continuing a previous partial upload if there is one.
+
+    Data goes to remote_path + PART_SUFFIX, which is renamed into place once
+    complete. The local file's size and mtime are kept beside it, and a
+    partial upload of a file that changed since is started over. Returns the
+    number of bytes sent in this call. With digest, the whole file is hashed
+    into it: the part sent earlier from the local file, the rest as it is sent.
+    """
+    part_path = remote_path + PART_SUFFIX
+    source_path = remote_path + SOURCE_SUFFIX
+    st = os.stat(local_path)
+    source = part_source(st.st_size, st.st_mtime)
+    try:
+        offset = sftp.stat(part_path).st_size
+        with sftp.open(source_path, 'r') as f:
+            recorded = f.read().decode()
+    except FileNotFoundError:
+        offset = 0
+    if offset > st.st_size or (offset and recorded != source):
+        offset = 0
+    if not offset:
+        with sftp.open(source_path, 'w') as f:
+            f.write(source)
+
+    if offset:
+        print(f"Resuming {os.path.basename(local_path)} from {round(offset/(1024*1024), 2)} MB")
+    if digest is not None and offset:
+        update_from_file(digest, local_path, offset)
+
+    sent = 0
+    with open(local_path, 'rb') as local_file, sftp.open(part_path, 'r+b' if offset else 'wb') as remote_file:
+        remote_file.set_pipelined(True)
+        remote_file.seek(offset)
+        local_file.seek(offset)
+        while True:
+            data = local_file.read(CHUNK_SIZE)
+            if not data:
+                break
+            remote_file.write(data)
+            if digest is not None:
+                digest.update(data)
+            sent += len(data)
+            if callback:
+                callback(offset + sent, st.st_size)
+
+    sftp.posix_rename(part_path, remote_path)
+    sftp.utime(remote_path, (st.st_atime, st.st_mtime))
+    sftp.remove(source_path)
+    return sent
+
+def resumable_download(sftp, remote_path, local_path, callback=None, digest=None):
+    """Download a file over SFTP, continuing a previous partial download if there is one.
+
+    Data goes to local_path + PART_SUFFIX, which is renamed into place once
+    complete. The remote file's size and mtime are kept beside it, and a
+    partial download of a file that changed since is started over. Returns
+    the number of bytes received in this call. With digest, the whole file is
+    hashed into it, the part received earlier from disk.
+    """
+    part_path = local_path + PART_SUFFIX
+    source_path = local_path + SOURCE_SUFFIX
+    attr = sftp.stat(remote_path)
+    source = part_source(attr.st_size, attr.st_mtime)
+    try:
+        offset = os.path.getsize(part_path)
+        with open(source_path) as f:
+            recorded = f.read()
+    except FileNotFoundError:
+        offset = 0
+    if offset > attr.st_size or (offset and recorded != source):
+        offset = 0
+    if not offset:
+        with open(source_path, 'w') as f:
+            f.write(source)
+
+    if offset:
+        print(f"Resuming {os.path.basename(remote_path)} from {round(offset/(1024*1024), 2)} MB")
+    if digest is not None and offset:
+        update_from_file(digest, part_path, offset)
+
+    received = 0
+    with sftp.open(remote_path, 'rb') as remote_file, open(part_path, 'r+b' if offset else 'wb') as local_file:
+        remote_file.seek(offset)
+        local_file.seek(offset)
+        local_file.truncate()
+        remote_file.prefetch(attr.st_size)
+        while True:
+            data = remote_file.read(CHUNK_SIZE)
+            if not data:
+                break
+            local_file.write(data)
+            if digest is not None:
+                digest.update(data)
+            received += len(data)
+            if callback:
+                callback(offset + received, attr.st_size)
+
+    os.replace(part_path, local_path)
+    os.utime(local_path, (attr.st_atime, attr.st_mtime))
+    os.remove(source_path)
+    return received
+
+class TransferJournal:
+    """Append-only local record of files completed by an interrupted folder transfer."""
+
+    def __init__(self, direction, hostname, local_dir, remote_dir):
+        key = '\0'.join([direction, str(hostname), os.path.abspath(local_dir), remote_dir])
+        self.path = os.path.join(JOURNAL_DIR, hashlib.sha1(key.encode()).hexdigest() + '.jsonl')
+        self.done = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line may be cut short by the interruption
+                        continue
+                    self.done[entry['path']] = (entry['size'], entry['mtime'])
+        self._file = None
+        self._lock = threading.Lock()
+
+    def is_done(self, path, size, mtime):
+        return self.done.get(path) == (size, mtime)
+
+    def mark_done(self, path, size, mtime):
+        with self._lock:
+            if self._file is None:
+                os.makedirs(JOURNAL_DIR, exist_ok=True)
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps({'path': path, 'size': size, 'mtime': mtime}) + '\n')
+            self._file.flush()
+            self.done[path] = (size, mtime)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Forget the journal once the whole transfer has completed."""
+        self.close()
+        self.done = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
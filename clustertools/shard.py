@@ -0,0 +1,43 @@
+import shlex
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+DEFAULT_SHARDS = 4
+
+def plan_shards(sizes, shards):
+    """Split {path: size} into at most shards lists of paths with balanced total sizes.
+
+    Largest files are placed first, each into the currently lightest shard.
+    Paths keep their sorted order within a shard so tar reads directories
+    together.
+    """
+    groups = [[] for _ in range(max(1, min(shards, len(sizes))))]
+    totals = [0] * len(groups)
+    for path in sorted(sizes, key=lambda p: (-sizes[p], p)):
+        lightest = totals.index(min(totals))
+        groups[lightest].append(path)
+        totals[lightest] += sizes[path]
+    return [sorted(group) for group in groups if group]
+
+def remote_extra_entries(ssh, root, filters=None):
+    """Return the symlinks and empty directories below a remote root, relative to it.
+
+    These carry no data to balance, so they all travel in the first shard.
+    With a TransferFilter only matching symlinks are returned.
+    """
+    if filters:
+        command = filters.find_command(root, 'l')
+    else:
+        command = f"find {shlex.quote(root)} -mindepth 1 \\( -type l -o -type d -empty \\) -printf '%P\\0'"
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read()
+    stdout.channel.recv_exit_status()
+    return [path.decode('utf-8', 'surrogateescape') for path in output.split(b'\0') if path]
+
+def shard_command(parent_dir, tar_option=''):
+    """Remote command archiving the NUL-separated paths on stdin, compressed through tar_option."""
+    return f"tar -cf - -C {shlex.quote(parent_dir)} --no-recursion --null -T -{tar_option}"
@@ -0,0 +1,398 @@
+"""Content-addressed local cache of downloaded files.
+
+Every file downloaded through the store is kept once under the SHA-256 of
+its content, and the remote file it came from (host, path, size and
+mtime) is recorded as a key to that content. A later download of an
+unchanged remote file, by anyone using the same store, is served locally
+instead: the cached copy is reflinked into place where the filesystem
+supports it (btrfs, XFS), hardlinked otherwise, or copied. Files with
+identical content are stored once whatever their path or host. With
+key='hash' files missing from the keys are hashed on the cluster and
+served when the content is already cached under another path.
+
+A hardlinked file shares its storage with the cache. Tools that replace
+files when saving are safe; writing into one in place changes the cached
+copy too, which the store notices from its size and mtime and discards.
+Use link='copy' (or a filesystem with reflinks) to keep files separate.
+
+The store is bounded by max_size: the least recently used contents are
+evicted first. Hits, misses and the bytes they account for are counted
+in the store and shown by `clustertools store stats`.
+"""
+import errno
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+
+from clustertools.index import encode_path, host_key
+from clustertools.sync import MTIME_TOLERANCE
+from clustertools.verify import new_digest, remote_digests, update_from_file
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+STORE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'clustertools', 'store')
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+STORE_ALGORITHM = 'sha256'
+LINK_MODES = ['auto', 'reflink', 'hardlink', 'copy']
+KEY_MODES = ['stat', 'hash']
+
+# ioctl cloning a whole file on Linux (linux/fs.h)
+FICLONE = 0x40049409
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS keys (
+    host TEXT NOT NULL,
+    path BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (host, path)
+);
+CREATE INDEX IF NOT EXISTS keys_digest ON keys (digest);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+STAT_NAMES = ['hits', 'hit_bytes', 'misses', 'miss_bytes', 'evictions']
+
+def format_size(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+def reflink(source, destination):
+    """Clone source into a new file at destination sharing its blocks; raises OSError where unsupported."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this system")
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(destination)
+            raise
+
+def unshare(path):
+    """Remove a local file about to be rewritten if it has other hardlinks, such as into the store.
+
+    Writing into it in place would change every linked copy.
+    """
+    try:
+        if os.lstat(path).st_nlink > 1:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class ContentStore:
+    """A directory of content-addressed files with a SQLite catalogue.
+
+    link is how cached files are placed: 'auto' tries a reflink, then a
+    hardlink, then a copy; 'reflink', 'hardlink' and 'copy' use only that
+    (a hardlink or reflink that fails still falls back to a copy).
+    """
+
+    def __init__(self, path=STORE_DIR, max_size=DEFAULT_MAX_SIZE, link='auto'):
+        if link not in LINK_MODES:
+            raise ValueError(f"Unknown link mode {link!r}, expected one of {', '.join(LINK_MODES)}")
+        self.path = path
+        self.max_size = max_size
+        self.link = link
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # One short-lived connection per call, so threads and processes can share the store
+        db = sqlite3.connect(os.path.join(self.path, 'store.sqlite'), timeout=60)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            yield db
+            db.commit()
+        finally:
+            db.close()
+
+    def for_host(self, host, key='stat'):
+        return HostStore(self, host, key)
+
+    def object_path(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest[2:])
+
+    def _place(self, source, destination, mtime=None, copy=True):
+        """Put a copy of source at the new path destination, as cheaply as the link mode allows.
+
+        A hardlink is only used when source already has mtime, as the two
+        names share it. With copy=False an OSError is raised instead of
+        falling back to a copy. Returns the method used.
+        """
+        if self.link in ('auto', 'reflink'):
+            try:
+                reflink(source, destination)
+                shutil.copystat(source, destination)
+                if mtime is not None:
+                    os.utime(destination, (mtime, mtime))
+                return 'reflink'
+            except OSError:
+                pass
+        if self.link in ('auto', 'hardlink'):
+            if mtime is None or abs(os.stat(source).st_mtime - mtime) <= MTIME_TOLERANCE:
+                try:
+                    os.link(source, destination)
+                    return 'hardlink'
+                except OSError:
+                    pass
+        if not copy:
+            raise OSError(errno.EOPNOTSUPP, "files can't be linked here")
+        shutil.copy2(source, destination)
+        if mtime is not None:
+            os.utime(destination, (mtime, mtime))
+        return 'copy'
+
+    def _valid(self, db, digest):
+        """os.stat of a cached object, or None (dropping its record) if it is missing or was modified."""
+        row = db.execute('SELECT size, mtime FROM objects WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        try:
+            st = os.stat(self.object_path(digest))
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_size != row[0] or st.st_mtime != row[1]:
+            self._drop(db, digest)
+            return None
+        return st
+
+    def _drop(self, db, digest):
+        try:
+            os.remove(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+        db.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+        db.execute('DELETE FROM keys WHERE digest = ?', (digest,))
+
+    def link_out(self, digest, destination, mtime=None, copy=True):
+        """Place the cached content digest at destination (replacing it); False if it isn't cached."""
+        with self._connect() as db:
+            if self._valid(db, digest) is None:
+                return False
+            db.execute('UPDATE objects SET last_used = ? WHERE digest = ?', (time.time(), digest))
+        os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+        temp_path = f"{destination}.clustertools-{uuid.uuid4().hex[:8]}"
+        try:
+            self._place(self.object_path(digest), temp_path, mtime, copy)
+            os.replace(temp_path, destination)
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            return False
+        finally:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+        return True
+
+    def add_file(self, local_path, digest=None):
+        """Store the content of a local file (hashing it unless its hex digest is given); returns the digest.
+
+        The file itself becomes the cached copy where the link mode allows
+        a hardlink. If the content was already cached, the file is replaced
+        by a link to it, so identical files take the space of one.
+        """
+        if digest is None:
+            hasher = new_digest(STORE_ALGORITHM)
+            update_from_file(hasher, local_path)
+            digest = hasher.hexdigest()
+        object_path = self.object_path(digest)
+        st = os.stat(local_path)
+        with self._connect() as db:
+            existing = self._valid(db, digest)
+        if existing is not None:
+            if not os.path.samestat(existing, st) and self.link != 'copy':
+                try:
+                    self.link_out(digest, local_path, st.st_mtime, copy=False)
+                except OSError:
+                    # Linking isn't possible here; the file keeps its own copy
+                    pass
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            temp_path = f"{object_path}.{uuid.uuid4().hex[:8]}"
+            try:
+                self._place(local_path, temp_path, st.st_mtime)
+                try:
+                    os.link(temp_path, object_path)
+                except FileExistsError:
+                    # Stored by another process meanwhile; the content is the same
+                    pass
+            finally:
+                os.remove(temp_path)
+        st = os.stat(object_path)
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO objects (digest, size, mtime, last_used) VALUES (?, ?, ?, ?)',
+                       (digest, st.st_size, st.st_mtime, time.time()))
+        return digest
+
+    def record(self, host, remote_path, size, mtime, digest):
+        """Note that the remote file host:remote_path with size and mtime has the content digest."""
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO keys (host, path, size, mtime, digest) VALUES (?, ?, ?, ?, ?)',
+                       (host, encode_path(remote_path), size, mtime, digest))
+
+    def lookup(self, host, remote_paths):
+        """Return {remote_path: (size, mtime, digest)} of the recorded keys among remote_paths."""
+        found = {}
+        with self._connect() as db:
+            for remote_path in remote_paths:
+                row = db.execute('SELECT size, mtime, digest FROM keys WHERE host = ? AND path = ?',
+                                 (host, encode_path(remote_path))).fetchone()
+                if row is not None:
+                    found[remote_path] = row
+        return found
+
+    def forget(self, host, remote_paths):
+        """Drop the keys of remote files, leaving their contents cached."""
+        with self._connect() as db:
+            db.executemany('DELETE FROM keys WHERE host = ? AND path = ?',
+                           [(host, encode_path(remote_path)) for remote_path in remote_paths])
+
+    def cached(self, digests):
+        """The subset of digests whose content is in the store."""
+        with self._connect() as db:
+            return {digest for digest in digests
+                    if db.execute('SELECT 1 FROM objects WHERE digest = ?', (digest,)).fetchone()}
+
+    def count(self, hits=0, hit_bytes=0, misses=0, miss_bytes=0, evictions=0):
+        values = dict(hits=hits, hit_bytes=hit_bytes, misses=misses, miss_bytes=miss_bytes, evictions=evictions)
+        with self._connect() as db:
+            db.executemany('INSERT INTO stats (name, value) VALUES (?, ?) '
+                           'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                           [(name, value) for name, value in values.items() if value])
+
+    def evict(self):
+        """Remove least recently used contents until the store fits in max_size; returns how many."""
+        evicted = 0
+        with self._connect() as db:
+            total, = db.execute('SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()
+            if total <= self.max_size:
+                return 0
+            for digest, size in db.execute('SELECT digest, size FROM objects ORDER BY last_used').fetchall():
+                if total <= self.max_size:
+                    break
+                self._drop(db, digest)
+                total -= size
+                evicted += 1
+        self.count(evictions=evicted)
+        return evicted
+
+    def stats(self):
+        """Counters since the store was created, with its current number of contents and size."""
+        with self._connect() as db:
+            stats = dict.fromkeys(STAT_NAMES, 0)
+            stats.update(db.execute('SELECT name, value FROM stats'))
+            stats['objects'], stats['size'] = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+            stats['keys'], = db.execute('SELECT COUNT(*) FROM keys').fetchone()
+        return stats
+
+    def clear(self):
+        """Forget every key and delete every cached content."""
+        with self._connect() as db:
+            db.execute('DELETE FROM objects')
+            db.execute('DELETE FROM keys')
+            db.execute('DELETE FROM stats')
+        shutil.rmtree(os.path.join(self.path, 'objects'))
+        os.makedirs(os.path.join(self.path, 'objects'))
+
+class HostStore:
+    """A ContentStore bound to one host, as handed to the transfer functions.
+
+    key is 'stat' to recognise remote files by path, size and mtime only,
+    or 'hash' to also hash the unrecognised ones on the cluster and serve
+    those whose content is cached.
+    """
+
+    def __init__(self, store, host, key='stat'):
+        if key not in KEY_MODES:
+            raise ValueError(f"Unknown store key {key!r}, expected one of {', '.join(KEY_MODES)}")
+        self.store = store
+        self.host = host
+        self.key = key
+
+    def fetch(self, ssh, root, manifest, local_root):
+        """Place the cached files of a {path: (size, mtime)} manifest below local_root.
+
+        Paths are relative to the remote root. Returns the paths served;
+        the rest are counted as misses and need downloading.
+        """
+        remote_paths = {path: os.path.join(root, path) for path in manifest}
+        keys = self.store.lookup(self.host, remote_paths.values())
+        found = {}
+        for path, (size, mtime) in manifest.items():
+            key = keys.get(remote_paths[path])
+            if key is not None and key[0] == size and abs(key[1] - mtime) <= MTIME_TOLERANCE:
+                found[path] = key[2]
+        if self.key == 'hash':
+            rest = [path for path in manifest if path not in found and manifest[path][0] > 0]
+            hashes = remote_digests(ssh, root, rest, STORE_ALGORITHM) if rest else {}
+            cached = self.store.cached(hashes.values())
+            for path, digest in hashes.items():
+                if digest in cached:
+                    found[path] = digest
+                    self.store.record(self.host, remote_paths[path], *manifest[path], digest)
+
+        served = [path for path, digest in sorted(found.items())
+                  if self.store.link_out(digest, os.path.join(local_root, path), manifest[path][1])]
+        hit_bytes = sum(manifest[path][0] for path in served)
+        miss_bytes = sum(size for size, mtime in manifest.values()) - hit_bytes
+        self.store.count(len(served), hit_bytes, len(manifest) - len(served), miss_bytes)
+        if manifest:
+            print(f"Content cache: {len(served)} of {len(manifest)} files served locally "
+                  f"({format_size(hit_bytes)}), {format_size(miss_bytes)} to download")
+        return served
+
+    def add(self, root, manifest, local_root, digests=None):
+        """Store the downloaded files of a {path: (size, mtime)} manifest found below local_root.
+
+        digests (a DigestLog) supplies hashes computed during the transfer
+        when it used STORE_ALGORITHM; other files are hashed from disk.
+        Files missing locally are skipped. Evicts what no longer fits.
+        """
+        for path, (size, mtime) in manifest.items():
+            local_path = os.path.join(local_root, path)
+            if not os.path.isfile(local_path) or os.path.islink(local_path):
+                continue
+            hexdigest = None
+            if digests is not None and digests.algorithm == STORE_ALGORITHM:
+                hexdigest = digests.files.get(path, (None, None))[1]
+            try:
+                digest = self.store.add_file(local_path, hexdigest)
+            except OSError as e:
+                print(f"{YELLOW}Could not cache {path}: {e}{RESET}")
+                continue
+            self.store.record(self.host, os.path.join(root, path), size, mtime, digest)
+        self.store.evict()
+
+    def forget(self, root, paths):
+        """Drop the keys of remote files (relative to root) so they are downloaded again next time."""
+        self.store.forget(self.host, [os.path.join(root, path) for path in paths])
+
+def open_store(path, hostname, ssh, max_size=DEFAULT_MAX_SIZE, key='stat', link='auto'):
+    """HostStore for a connection when path is set, otherwise None."""
+    if path is None:
+        return None
+    return ContentStore(path, max_size, link).for_host(host_key(ssh, hostname), key)
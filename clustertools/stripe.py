@@ -0,0 +1,208 @@
+import hashlib
+import os
+import shlex
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from clustertools.backends import DEFAULT_MAX_REQUESTS, DEFAULT_REQUEST_SIZE
+from clustertools.resume import PART_SUFFIX
+from clustertools.tuning import rate_limiter
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+DEFAULT_STRIPES = 4
+
+# Files smaller than this aren't worth splitting
+STRIPE_THRESHOLD = 64 * 1024 * 1024
+
+# Stripe boundaries are aligned to this many bytes
+STRIPE_ALIGNMENT = 1024 * 1024
+
+# Attempts per stripe before the whole transfer is given up
+STRIPE_RETRIES = 3
+
+CHUNK_SIZE = 1024 * 1024
+
+def plan_stripes(size, stripes):
+    """Split size bytes into at most stripes aligned (offset, length) ranges."""
+    stripe_size = -(-size // max(1, stripes))
+    stripe_size = max(STRIPE_ALIGNMENT, -(-stripe_size // STRIPE_ALIGNMENT) * STRIPE_ALIGNMENT)
+    return [(offset, min(stripe_size, size - offset)) for offset in range(0, size, stripe_size)]
+
+def remote_range_hash(ssh, path, offset, length):
+    """Return the SHA-256 hex digest of a byte range of a remote file."""
+    # dd stops after the range by itself (tail | head would die of SIGPIPE), and
+    # pipefail keeps an unreadable file from passing for the hash of no data
+    pipeline = (f"dd if={shlex.quote(path)} bs={CHUNK_SIZE} skip={offset} count={length} "
+                f"iflag=skip_bytes,count_bytes status=none | sha256sum")
+    command = f"bash -o pipefail -c {shlex.quote(pipeline)}"
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read().decode().strip()
+    if stdout.channel.recv_exit_status() != 0 or not output:
+        raise Exception(f"Failed to hash remote range of {path}: {stderr.read().decode().strip()}")
+    return output.split()[0]
+
+class StripeProgress:
+    """Adds up bytes moved by concurrent stripes and reports the total to callback."""
+
+    def __init__(self, size, callback):
+        self.size = size
+        self.callback = callback
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.bytes += n
+            if self.callback:
+                self.callback(self.bytes, self.size)
+
+def run_stripes(ssh, ranges, transfer_stripe, progress):
+    """Run transfer_stripe(ssh, offset, length, progress) for every range concurrently.
+
+    Each stripe opens its own channels on ssh. A stripe that fails or
+    doesn't verify is retried on its own, up to STRIPE_RETRIES times.
+    The bandwidth cap of ssh applies to all stripes together.
+    """
+    limiter = rate_limiter(ssh)
+
+    def run(index):
+        offset, length = ranges[index]
+        for attempt in range(1, STRIPE_RETRIES + 1):
+            moved = [0]
+
+            def add(n):
+                if limiter is not None and n > 0:
+                    limiter.throttle(n)
+                moved[0] += n
+                progress.add(n)
+
+            try:
+                transfer_stripe(ssh, offset, length, add)
+                return
+            except Exception as e:
+                progress.add(-moved[0])
+                if attempt == STRIPE_RETRIES or not ssh.get_transport().is_active():
+                    raise
+                print(f"\n{YELLOW}Stripe at {offset} failed ({str(e)}), retrying ({attempt}/{STRIPE_RETRIES - 1}){RESET}")
+
+    progress.add(0)
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        # list() re-raises the first stripe error
+        list(executor.map(run, range(len(ranges))))
+
+def striped_upload(ssh, local_path, remote_path, stripes=DEFAULT_STRIPES, callback=None,
+                   request_size=DEFAULT_REQUEST_SIZE):
+    """Upload one large file as byte ranges sent concurrently over several SFTP channels.
+
+    The remote file is preallocated as remote_path + PART_SUFFIX, every
+    stripe writes at its own offset and is checked against a remote SHA-256
+    of its range, then the file is renamed into place. All stripes share
+    the transport of ssh, so they hide round-trip latency but not the cost
+    of its cipher. If the upload fails the part file is removed, unless the
+    connection is gone.
+    """
+    st = os.stat(local_path)
+    part_path = remote_path + PART_SUFFIX
+    ranges = plan_stripes(st.st_size, stripes)
+    progress = StripeProgress(st.st_size, callback)
+
+    sftp = ssh.open_sftp()
+    try:
+        with sftp.open(part_path, 'wb'):
+            pass
+        sftp.truncate(part_path, st.st_size)
+
+        def send_stripe(stripe_ssh, offset, length, add):
+            sha = hashlib.sha256()
+            stripe_sftp = stripe_ssh.open_sftp()
+            try:
+                with open(local_path, 'rb') as local_file, stripe_sftp.open(part_path, 'r+b') as remote_file:
+                    remote_file.MAX_REQUEST_SIZE = request_size
+                    remote_file.set_pipelined(True)
+                    local_file.seek(offset)
+                    remote_file.seek(offset)
+                    remaining = length
+                    while remaining > 0:
+                        data = local_file.read(min(CHUNK_SIZE, remaining))
+                        if not data:
+                            raise EOFError(f"{local_path} shrank during upload")
+                        remote_file.write(data)
+                        sha.update(data)
+                        remaining -= len(data)
+                        add(len(data))
+            finally:
+                stripe_sftp.close()
+            if remote_range_hash(stripe_ssh, part_path, offset, length) != sha.hexdigest():
+                raise ValueError("checksum mismatch")
+
+        print(f"Uploading in {len(ranges)} stripes")
+        try:
+            run_stripes(ssh, ranges, send_stripe, progress)
+        except BaseException:
+            # A preallocated file with holes mustn't be mistaken for a partial upload
+            if ssh.get_transport().is_active():
+                sftp.remove(part_path)
+            raise
+
+        sftp.chmod(part_path, st.st_mode & 0o7777)
+        sftp.posix_rename(part_path, remote_path)
+        sftp.utime(remote_path, (st.st_atime, st.st_mtime))
+    finally:
+        sftp.close()
+
+def striped_download(ssh, remote_path, local_path, stripes=DEFAULT_STRIPES, callback=None,
+                     request_size=DEFAULT_REQUEST_SIZE, max_requests=DEFAULT_MAX_REQUESTS):
+    """Download one large file as byte ranges fetched concurrently over several SFTP channels.
+
+    The data lands in a preallocated local_path + PART_SUFFIX, every stripe
+    is hashed as it arrives and checked against a remote SHA-256 of its
+    range, then the file is renamed into place.
+    """
+    part_path = local_path + PART_SUFFIX
+    sftp = ssh.open_sftp()
+    try:
+        attr = sftp.stat(remote_path)
+    finally:
+        sftp.close()
+    ranges = plan_stripes(attr.st_size, stripes)
+    progress = StripeProgress(attr.st_size, callback)
+
+    with open(part_path, 'wb') as f:
+        if hasattr(os, 'posix_fallocate') and attr.st_size:
+            os.posix_fallocate(f.fileno(), 0, attr.st_size)
+        else:
+            f.truncate(attr.st_size)
+
+    def fetch_stripe(stripe_ssh, offset, length, add):
+        sha = hashlib.sha256()
+        stripe_sftp = stripe_ssh.open_sftp()
+        try:
+            with stripe_sftp.open(remote_path, 'rb') as remote_file, open(part_path, 'r+b') as local_file:
+                remote_file.MAX_REQUEST_SIZE = request_size
+                local_file.seek(offset)
+                chunks = [(start, min(CHUNK_SIZE, offset + length - start))
+                          for start in range(offset, offset + length, CHUNK_SIZE)]
+                for data in remote_file.readv(chunks, max_requests):
+                    local_file.write(data)
+                    sha.update(data)
+                    add(len(data))
+        finally:
+            stripe_sftp.close()
+        if remote_range_hash(stripe_ssh, remote_path, offset, length) != sha.hexdigest():
+            raise ValueError("checksum mismatch")
+
+    print(f"Downloading in {len(ranges)} stripes")
+    try:
+        run_stripes(ssh, ranges, fetch_stripe, progress)
+    except BaseException:
+        os.remove(part_path)
+        raise
+
+    os.chmod(part_path, attr.st_mode & 0o7777)
+    os.replace(part_path, local_path)
+    os.utime(local_path, (attr.st_atime, attr.st_mtime))
@@ -0,0 +1,150 @@
+import os
+import shlex
+import stat
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+# Modification times closer than this (in seconds) count as unchanged
+MTIME_TOLERANCE = 1.0
+
+# Keep each batched rm command comfortably below the remote ARG_MAX
+RM_BATCH_CHARS = 100000
+
+def remote_manifest(ssh, root, filters=None, missing_ok=False):
+    """Return {relative_path: (size, mtime)} for every file under a remote directory.
+
+    The whole tree is listed with a single `find -printf` call; if the remote
+    find doesn't support -printf the tree is walked over SFTP instead.
+    A missing directory raises FileNotFoundError, or gives an empty
+    manifest with missing_ok=True (for a destination that doesn't exist
+    yet). With a TransferFilter only matching files are listed, and
+    excluded directories are pruned by find.
+    """
+    if filters:
+        command = filters.find_command(root, 'f', '%P\\0%s\\0%T@\\0')
+    else:
+        command = f"find {shlex.quote(root)} -type f -printf '%P\\0%s\\0%T@\\0'"
+    stdin, stdout, stderr = ssh.exec_command(command)
+    output = stdout.read()
+    exit_status = stdout.channel.recv_exit_status()
+
+    if exit_status != 0:
+        error = stderr.read().decode()
+        if 'No such file' in error:
+            if missing_ok:
+                return {}
+            raise FileNotFoundError(f"Remote directory {root} does not exist")
+        if '-printf' in error or 'unknown primary' in error:
+            print(f"{YELLOW}Remote find lacks -printf, listing over SFTP instead{RESET}")
+            manifest = sftp_manifest(ssh, root, missing_ok)
+            return filters.select(manifest) if filters else manifest
+        raise Exception(f"Failed to list remote directory {root}: {error}")
+
+    manifest = {}
+    fields = output.split(b'\0')
+    for i in range(0, len(fields) - 2, 3):
+        path = fields[i].decode('utf-8', 'surrogateescape')
+        manifest[path] = (int(fields[i + 1]), float(fields[i + 2]))
+    return manifest
+
+def sftp_manifest(ssh, root, missing_ok=False):
+    """Walk a remote directory with SFTP listdir_attr and build its manifest."""
+    sftp = ssh.open_sftp()
+    manifest = {}
+    try:
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            try:
+                entries = sftp.listdir_attr(os.path.join(root, rel_dir) if rel_dir else root)
+            except FileNotFoundError:
+                if not rel_dir and not missing_ok:
+                    raise FileNotFoundError(f"Remote directory {root} does not exist")
+                continue
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.filename) if rel_dir else entry.filename
+                if stat.S_ISDIR(entry.st_mode):
+                    pending.append(rel_path)
+                elif stat.S_ISREG(entry.st_mode):
+                    manifest[rel_path] = (entry.st_size, float(entry.st_mtime))
+    finally:
+        sftp.close()
+    return manifest
+
+def local_manifest(root, skip_dots=False, filters=None, subdir=None):
+    """Return {relative_path: (size, mtime)} for every file under a local directory.
+
+    With a TransferFilter only matching files are listed. With subdir only
+    that directory below root is walked, paths staying relative to root.
+    """
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, subdir) if subdir else root):
+        if filters:
+            rel_dir = os.path.relpath(dirpath, root).replace("\\", "/")
+            dirnames[:] = [d for d in dirnames
+                           if not filters.excludes_dir(d if rel_dir == '.' else f"{rel_dir}/{d}")]
+        for filename in filenames:
+            if skip_dots and filename.startswith("._"):
+                continue
+            local_file_path = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(local_file_path, root).replace("\\", "/")
+            st = os.stat(local_file_path)
+            if filters and not filters.matches(rel_path, st.st_size, st.st_mtime):
+                continue
+            manifest[rel_path] = (st.st_size, st.st_mtime)
+    return manifest
+
+def check_delete(source, extraneous, root, force=False):
+    """Refuse to delete destination files when the source listing is empty, unless forced.
+
+    An empty source usually means the wrong folder was given rather than
+    one whose contents were all removed on purpose.
+    """
+    if extraneous and not source and not force:
+        raise Exception(f"Refusing to delete {len(extraneous)} files: the source folder {root} lists no files. "
+                        f"Pass --force-delete (force_delete=True) if the destination should be emptied")
+
+def compare_manifests(source, dest, tolerance=MTIME_TOLERANCE):
+    """Compare a source and destination manifest.
+
+    Returns (changed, extraneous): paths that are new or differ in size or
+    mtime on the source side, and paths that only exist on the destination.
+    """
+    changed = []
+    for path, (size, mtime) in source.items():
+        existing = dest.get(path)
+        if existing is None or existing[0] != size or abs(existing[1] - mtime) > tolerance:
+            changed.append(path)
+
+    extraneous = [path for path in dest if path not in source]
+    return sorted(changed), sorted(extraneous)
+
+def delete_remote_files(ssh, root, paths, recursive=False):
+    """Delete files (or with recursive=True, whole directories) under a remote directory with batched `rm` calls."""
+    batch = []
+    batch_len = 0
+    for i, path in enumerate(paths):
+        quoted = shlex.quote(os.path.join(root, path))
+        batch.append(quoted)
+        batch_len += len(quoted) + 1
+        if batch_len < RM_BATCH_CHARS and i < len(paths) - 1:
+            continue
+
+        stdin, stdout, stderr = ssh.exec_command(f"rm {'-rf' if recursive else '-f'} {' '.join(batch)}")
+        if stdout.channel.recv_exit_status() != 0:
+            error = stderr.read().decode()
+            print(f"{RED}Error deleting remote files: {error}{RESET}")
+        batch = []
+        batch_len = 0
+
+def delete_local_files(root, paths):
+    """Delete files under a local directory, ignoring ones that are already gone."""
+    for path in paths:
+        try:
+            os.remove(os.path.join(root, path))
+        except FileNotFoundError:
+            pass
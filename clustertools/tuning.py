@@ -0,0 +1,260 @@
+"""Tuning for links with a large bandwidth-delay product.
+
+paramiko opens every channel with a 2 MiB receive window, so one stream
+moves at most 2 MiB per round trip: 20 MB/s at 100 ms, whatever the link
+could carry. tune_connection() measures the round-trip time and
+throughput of a connection and sizes the windows of the channels opened
+on it afterwards (and the SFTP reads kept in flight) to the
+bandwidth-delay product. Uploads are bound by the window the server
+advertises instead, which is reported; AdaptiveConcurrency makes up for
+it by adding channels while that raises the throughput.
+
+limit_rate() caps the bytes per second moved by the transfers handed the
+client it returns, together, so a shared link isn't saturated. The cap
+travels with that client rather than the connection: other transfers
+reusing the connection, at the same time or later, aren't held back.
+"""
+import math
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from clustertools.compression import measure_link_rate
+from clustertools.metrics import measure_rtt
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+# paramiko's own channel window, and the most we grow it to
+MIN_WINDOW = 2 * 1024 * 1024
+MAX_WINDOW = 64 * 1024 * 1024
+# Windows are sized to this multiple of the measured bandwidth-delay product
+WINDOW_HEADROOM = 2
+MAX_SFTP_REQUESTS = 1024
+RTT_SAMPLES = 3
+
+# Adaptive concurrency: most channels at once (OpenSSH allows 10 sessions
+# per connection by default), seconds between adjustments, the throughput
+# gain that justifies another channel, and how many intervals to wait
+# after a step that didn't pay off
+MAX_CHANNELS = 8
+ADJUST_INTERVAL = 2.0
+MIN_GAIN = 0.05
+HOLD_INTERVALS = 5
+
+# Seconds of traffic a rate limiter lets through in one burst
+BURST_SECONDS = 0.25
+
+TCP_RMEM_PATH = '/proc/sys/net/ipv4/tcp_rmem'
+
+# LinkSettings per connection transport
+link_settings = weakref.WeakKeyDictionary()
+
+def format_bytes(n):
+    return f"{n / (1024 * 1024):.1f} MiB"
+
+def format_rate(rate):
+    return f"{rate * 8 / 1e6:.1f} Mbit/s"
+
+def kernel_receive_buffer():
+    """Largest TCP receive buffer the kernel autotunes to, in bytes, or None if unknown."""
+    try:
+        with open(TCP_RMEM_PATH) as f:
+            return int(f.read().split()[2])
+    except (OSError, ValueError, IndexError):
+        return None
+
+class LinkSettings:
+    """What tune_connection measured and chose for a connection."""
+
+    def __init__(self, rtt, rate, window_size, max_requests, server_window=None):
+        self.rtt = rtt
+        self.rate = rate
+        self.window_size = window_size
+        self.max_requests = max_requests
+        self.server_window = server_window
+
+    @property
+    def bdp(self):
+        return self.rtt * self.rate
+
+    def print_summary(self):
+        print(f"Link tuning: RTT {self.rtt * 1000:.1f} ms, {format_rate(self.rate)}, "
+              f"bandwidth-delay product {format_bytes(self.bdp)}")
+        print(f"  Channel window {format_bytes(self.window_size)}, {self.max_requests} SFTP reads in flight")
+        if self.server_window is not None:
+            limited = self.server_window < self.bdp
+            print(f"  Server window {format_bytes(self.server_window)} for uploads"
+                  f"{', so uploads gain from more channels' if limited else ''}")
+        kernel = kernel_receive_buffer()
+        if kernel is not None and kernel < self.bdp:
+            print(f"{YELLOW}  The kernel's TCP receive buffer tops out at {format_bytes(kernel)}, below the "
+                  f"bandwidth-delay product; raise net.ipv4.tcp_rmem for full speed{RESET}")
+
+def tune_connection(ssh, direction='download', link_rate=None, request_size=32768):
+    """Size the channel windows of a connection to its bandwidth-delay product.
+
+    The RTT is the best of RTT_SAMPLES keepalive round trips; the rate is
+    link_rate (bytes/s) if given, otherwise measured in direction.
+    Channels opened after the call use the new window. Returns the
+    LinkSettings, which are also kept for the connection, or None for a
+    connection held by a broker, whose session sets its own windows.
+    """
+    transport = ssh.get_transport()
+    if not hasattr(transport, 'default_window_size'):
+        print(f"{YELLOW}Link tuning skipped: the connection broker's session sets the windows{RESET}")
+        return None
+    if transport in link_settings:
+        return link_settings[transport]
+
+    samples = [rtt for rtt in (measure_rtt(ssh) for _ in range(RTT_SAMPLES)) if rtt is not None]
+    rtt = min(samples) if samples else 0.0
+    rate = link_rate or measure_link_rate(ssh, direction)
+    window = int(min(MAX_WINDOW, max(MIN_WINDOW, rtt * rate * WINDOW_HEADROOM)))
+    transport.default_window_size = window
+
+    channel = transport.open_session()
+    try:
+        # The window the server grants us bounds what one upload channel can have in flight
+        server_window = channel.out_window_size
+    finally:
+        channel.close()
+
+    max_requests = min(MAX_SFTP_REQUESTS, math.ceil(window / request_size))
+    settings = LinkSettings(rtt, rate, window, max_requests, server_window)
+    link_settings[transport] = settings
+    settings.print_summary()
+    return settings
+
+class RateLimiter:
+    """Token bucket holding the bytes moved through it to rate bytes per second.
+
+    Safe to share between threads; a caller that overdraws the bucket
+    sleeps until its bytes are paid for.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = rate * BURST_SECONDS
+        self._allowance = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def throttle(self, n):
+        with self._lock:
+            now = time.monotonic()
+            self._allowance = min(self.burst, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= n
+            wait = -self._allowance / self.rate if self._allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class RateLimitedClient:
+    """An SSH client wrapper carrying the RateLimiter of one transfer.
+
+    Everything but the limiter is the wrapped client's.
+    """
+
+    def __init__(self, ssh, limiter):
+        self.ssh = ssh
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.ssh, name)
+
+def bandwidth_limiter(rate):
+    """A RateLimiter for rate bytes/s to share between limit_rate() calls, or None for no cap."""
+    if not rate:
+        return None
+    print(f"Bandwidth capped at {format_rate(rate)}")
+    return RateLimiter(rate)
+
+def limit_rate(ssh, limiter):
+    """Wrap ssh so the transfers given the result move at most limiter.rate bytes/s together."""
+    return RateLimitedClient(ssh, limiter) if limiter is not None else ssh
+
+def rate_limiter(ssh):
+    """The RateLimiter of a transfer's client, or None if it isn't capped."""
+    if isinstance(ssh, RateLimitedClient):
+        return ssh.limiter
+    return None
+
+class AdaptiveConcurrency:
+    """Adjusts how many channels run at once from the throughput they reach.
+
+    Transfers run inside slot(), at most limit at a time. While started,
+    the byte rate of a TransferMetrics is sampled every interval: when all
+    slots are busy one more is added, a step that raised the rate by
+    MIN_GAIN is followed by another, and one that didn't is undone and not
+    retried for HOLD_INTERVALS. It doesn't grow past a rate cap.
+    """
+
+    def __init__(self, initial=1, maximum=MAX_CHANNELS, interval=ADJUST_INTERVAL, rate_cap=None):
+        self.maximum = max(1, maximum)
+        self.limit = max(1, min(initial, self.maximum))
+        self.initial = self.limit
+        self.peak = self.limit
+        self.interval = interval
+        self.rate_cap = rate_cap
+        self.active = 0
+        self._base_rate = None
+        self._hold = 0
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.active -= 1
+                self._condition.notify()
+
+    def _set_limit(self, limit):
+        with self._condition:
+            self.limit = limit
+            self.peak = max(self.peak, limit)
+            self._condition.notify_all()
+
+    def adjust(self, rate):
+        """Take one throughput sample (bytes/s) and move the limit."""
+        if self._base_rate is not None:
+            improved = rate >= self._base_rate * (1 + MIN_GAIN)
+            self._base_rate = None
+            if not improved:
+                self._set_limit(self.limit - 1)
+                self._hold = HOLD_INTERVALS
+                return
+        if self._hold:
+            self._hold -= 1
+            return
+        capped = self.rate_cap is not None and rate >= self.rate_cap * 0.9
+        if self.limit < self.maximum and self.active >= self.limit and not capped:
+            self._base_rate = rate
+            self._set_limit(self.limit + 1)
+
+    def start(self, metrics):
+        """Sample metrics.bytes every interval on a background thread until stop()."""
+        def run():
+            last_bytes, last_time = metrics.bytes, time.time()
+            while not self._stopped.wait(self.interval):
+                now = time.time()
+                self.adjust((metrics.bytes - last_bytes) / (now - last_time))
+                last_bytes, last_time = metrics.bytes, now
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.peak != self.initial:
+            print(f"Channels: started with {self.initial}, peaked at {self.peak}, ended with {self.limit}")
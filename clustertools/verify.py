@@ -0,0 +1,211 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import shlex
+import threading
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+# Local hash constructors and the matching remote command for each algorithm
+ALGORITHMS = ['sha256', 'xxh128']
+DEFAULT_ALGORITHM = 'sha256'
+REMOTE_COMMANDS = {'sha256': 'sha256sum', 'xxh128': 'xxhsum -H2'}
+
+# Rounds of retransmitting mismatched files before giving up on them
+VERIFY_RETRIES = 2
+
+# Manifests of verified transfers, unless a path is given
+MANIFEST_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'clustertools', 'manifests')
+
+CHUNK_SIZE = 1024 * 1024
+
+def new_digest(algorithm=DEFAULT_ALGORITHM):
+    """Return a fresh hash object for algorithm ('sha256' or 'xxh128')."""
+    if algorithm == 'sha256':
+        return hashlib.sha256()
+    if algorithm == 'xxh128':
+        if xxhash is None:
+            raise ValueError("xxh128 verification needs the xxhash package (pip install xxhash)")
+        return xxhash.xxh3_128()
+    raise ValueError(f"Unknown hash algorithm {algorithm!r}, expected one of {', '.join(ALGORITHMS)}")
+
+def update_from_file(digest, path, length=None):
+    """Hash the first length bytes of a local file (all of it by default) into digest."""
+    with open(path, 'rb') as f:
+        remaining = length
+        while remaining is None or remaining > 0:
+            data = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+
+class HashingReader:
+    """File-like wrapper that hashes the data read through it."""
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+class DigestLog:
+    """Thread-safe record of the hashes computed while files were in flight.
+
+    Paths are relative to the remote root of the transfer. A file added
+    with digest None was checked by other means (striped transfers verify
+    every range) and isn't compared again.
+    """
+
+    def __init__(self, algorithm=DEFAULT_ALGORITHM):
+        new_digest(algorithm)
+        self.algorithm = algorithm
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def new(self):
+        return new_digest(self.algorithm)
+
+    def add(self, path, size, digest):
+        with self._lock:
+            self.files[path] = (size, digest.hexdigest() if digest is not None else None)
+
+    def hashed_paths(self):
+        with self._lock:
+            return sorted(path for path, (size, hexdigest) in self.files.items() if hexdigest is not None)
+
+def unescape_name(name):
+    # sha256sum marks names containing a backslash or newline with a leading
+    # backslash and escapes those characters
+    return re.sub(rb'\\(.)', lambda m: {b'n': b'\n', b'r': b'\r'}.get(m.group(1), m.group(1)), name)
+
+def remote_digests(ssh, root, paths, algorithm=DEFAULT_ALGORITHM):
+    """Hash files below a remote root with one batched command.
+
+    Paths are relative to root and streamed NUL-separated into `xargs`, so
+    any number of files costs a single exec. Returns {path: hexdigest};
+    files that couldn't be read are left out.
+    """
+    if not paths:
+        return {}
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(f"cd {shlex.quote(root)} && xargs -0 -r {REMOTE_COMMANDS[algorithm]} --")
+
+    def send_paths():
+        try:
+            for path in paths:
+                channel.sendall(path.encode('utf-8', 'surrogateescape') + b'\0')
+        finally:
+            channel.shutdown_write()
+
+    threading.Thread(target=send_paths, daemon=True).start()
+    try:
+        output = channel.makefile('rb').read()
+        exit_status = channel.recv_exit_status()
+        error = channel.makefile_stderr('rb').read().decode()
+    finally:
+        channel.close()
+
+    digests = {}
+    for line in output.split(b'\n'):
+        if not line:
+            continue
+        escaped = line.startswith(b'\\')
+        if escaped:
+            line = line[1:]
+        hexdigest, _, name = line.partition(b' ')
+        # Binary-mode output marks the name with '*' instead of a second space
+        name = name[1:]
+        if escaped:
+            name = unescape_name(name)
+        digests[name.decode('utf-8', 'surrogateescape')] = hexdigest.decode().lower()
+
+    if exit_status != 0 and not digests:
+        raise Exception(f"Remote {REMOTE_COMMANDS[algorithm]} failed: {error.strip()}")
+    return digests
+
+def verify_transfer(ssh, remote_root, digests, retransmit, retries=VERIFY_RETRIES):
+    """Compare in-flight hashes with the remote copies and resend files that differ.
+
+    retransmit(paths) must transfer those paths again, adding fresh hashes to
+    digests. Only files transferred in this run are checked.
+    Returns ({path: remote hexdigest}, [paths still mismatched]).
+    """
+    paths = digests.hashed_paths()
+    print(f"{YELLOW}Verifying {len(paths)} files ({digests.algorithm})...{RESET}")
+    remote = remote_digests(ssh, remote_root, paths, digests.algorithm)
+    mismatched = [path for path in paths if remote.get(path) != digests.files[path][1]]
+
+    for attempt in range(1, retries + 1):
+        if not mismatched:
+            break
+        print(f"{YELLOW}{len(mismatched)} files failed verification, retransmitting ({attempt}/{retries})...{RESET}")
+        retransmit(mismatched)
+        remote.update(remote_digests(ssh, remote_root, mismatched, digests.algorithm))
+        mismatched = [path for path in mismatched if remote.get(path) != digests.files[path][1]]
+
+    if mismatched:
+        print(f"{RED}{len(mismatched)} files still differ from the remote copy:{RESET}")
+        for path in mismatched[:20]:
+            print(f"{RED}  {path}{RESET}")
+    else:
+        print(f"{GREEN}All {len(paths)} files verified.{RESET}")
+    return remote, mismatched
+
+def write_manifest(digests, remote, mismatched, direction, local_dir, remote_dir, path=None):
+    """Write the result of a verified transfer as JSON and return its path.
+
+    Without path the manifest goes to MANIFEST_DIR, named after the
+    direction, the transferred folder or file and the time.
+    """
+    if path is None:
+        name = os.path.basename(remote_dir.rstrip('/')) or 'root'
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        os.makedirs(MANIFEST_DIR, exist_ok=True)
+        path = os.path.join(MANIFEST_DIR, f"{direction}-{name}-{stamp}.json")
+
+    mismatched = set(mismatched)
+    files = []
+    for file_path, (size, hexdigest) in sorted(digests.files.items()):
+        entry = {'path': file_path, 'size': size, 'hash': hexdigest}
+        if hexdigest is None:
+            entry['verified'] = 'stripes'
+        else:
+            entry['verified'] = file_path not in mismatched
+            if file_path in mismatched:
+                entry['remote_hash'] = remote.get(file_path)
+        files.append(entry)
+
+    manifest = {
+        'algorithm': digests.algorithm,
+        'direction': direction,
+        'local_dir': os.path.abspath(local_dir),
+        'remote_dir': remote_dir,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'files': files,
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print(f"Manifest written to {path}")
+    return path
+
+def verify_and_record(ssh, remote_root, digests, retransmit, direction, local_dir, manifest=None):
+    """Run verify_transfer, write the manifest and return True if every file matched."""
+    remote, mismatched = verify_transfer(ssh, remote_root, digests, retransmit)
+    write_manifest(digests, remote, mismatched, direction, local_dir, remote_root, manifest)
+    return not mismatched
@@ -0,0 +1,324 @@
+"""Change detection for `local2cluster --watch`.
+
+A watcher reports the paths below a local folder that changed, relative
+to it. On Linux it uses inotify (through libc, no extra package), with a
+watch on every directory of the tree; elsewhere, when the inotify watch
+limit is reached, or when asked to, it polls: the tree is walked every
+interval and its sizes and mtimes compared with the previous walk.
+
+plan_changes() turns the changed paths into the remote operations that
+bring the cluster copy up to date. Files that vanished and reappeared
+elsewhere with the same size and mtime were renamed, and are renamed on
+the cluster too instead of being uploaded again; a renamed directory
+becomes a single `mv`, and a deleted one a single `rm -rf`.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from clustertools.sync import compare_manifests, local_manifest
+
+# Color constants
+RED = '\033[91m'
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+# Seconds without events before a burst of changes is uploaded, and the
+# longest a change waits while events keep coming
+DEBOUNCE = 1.0
+MAX_DELAY = 10.0
+# Seconds between walks of the tree when polling
+POLL_INTERVAL = 2.0
+
+# inotify event bits (linux/inotify.h)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    libc.inotify_init1
+except (OSError, AttributeError):
+    libc = None
+
+def join(rel_dir, name):
+    return f"{rel_dir}/{name}" if rel_dir else name
+
+def is_below(path, roots):
+    """True if a relative path is one of roots or lies below one ('' is the whole folder)."""
+    return any(root == '' or path == root or path.startswith(root + '/') for root in roots)
+
+def topmost(paths):
+    """The paths that don't lie below another one of them."""
+    roots = []
+    for path in sorted(paths, key=len):
+        if not is_below(path, roots):
+            roots.append(path)
+    return roots
+
+class InotifyWatcher:
+    """Watches every directory below root with inotify.
+
+    Directories excluded by filters aren't watched. New directories are
+    watched as they appear, and reported whole so files created in them
+    before their watch was added aren't missed.
+    """
+
+    def __init__(self, root, skip_dots=True, filters=None):
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self.root = root
+        self.skip_dots = skip_dots
+        self.filters = filters
+        self.watches = {}
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            self._add_tree('')
+        except OSError:
+            os.close(self.fd)
+            raise
+        self.method = f"inotify, {len(self.watches)} directories"
+
+    def _add_tree(self, rel_dir):
+        """Watch rel_dir and every directory below it."""
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, rel_dir) if rel_dir else self.root):
+            rel = os.path.relpath(dirpath, self.root).replace("\\", "/")
+            rel = '' if rel == '.' else rel
+            if self.filters:
+                dirnames[:] = [d for d in dirnames if not self.filters.excludes_dir(join(rel, d))]
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC:
+                    raise OSError(error, "inotify watch limit reached; raise fs.inotify.max_user_watches")
+                # The directory vanished while being walked
+                continue
+            self.watches[wd] = rel
+
+    def _remove_tree(self, rel_dir):
+        """Stop watching rel_dir and everything below it, which moved away."""
+        for wd, rel in list(self.watches.items()):
+            if is_below(rel, [rel_dir]):
+                libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def changes(self, timeout):
+        """Wait up to timeout seconds and return the set of changed relative paths."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, so nothing short of a full rescan is safe
+                changed.add('')
+                continue
+            if mask & IN_IGNORED or wd not in self.watches:
+                self.watches.pop(wd, None)
+                continue
+            path = join(self.watches[wd], name)
+            if mask & IN_ISDIR:
+                if mask & IN_ATTRIB:
+                    continue
+                if self.filters and self.filters.excludes_dir(path):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._add_tree(path)
+                    except OSError as e:
+                        print(f"{YELLOW}Not watching {path}: {e.strerror}{RESET}")
+                elif mask & IN_MOVED_FROM:
+                    self._remove_tree(path)
+            elif self.skip_dots and name.startswith("._"):
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """Walks the tree every interval seconds and reports the files that changed."""
+
+    def __init__(self, root, skip_dots=True, filters=None, interval=POLL_INTERVAL):
+        self.root = root
+        self.skip_dots = skip_dots
+        self.filters = filters
+        self.interval = interval
+        self.snapshot = local_manifest(root, skip_dots, filters)
+        self.method = f"polling every {interval:g}s"
+
+    def changes(self, timeout):
+        time.sleep(self.interval)
+        snapshot = local_manifest(self.root, self.skip_dots, self.filters)
+        changed, removed = compare_manifests(snapshot, self.snapshot, tolerance=0)
+        self.snapshot = snapshot
+        return set(changed) | set(removed)
+
+    def close(self):
+        pass
+
+def open_watcher(root, skip_dots=True, filters=None, poll=None):
+    """An InotifyWatcher for root, or a PollingWatcher if poll (seconds) is given or inotify fails."""
+    if poll is None:
+        try:
+            return InotifyWatcher(root, skip_dots, filters)
+        except OSError as e:
+            if libc is not None:
+                print(f"{YELLOW}Falling back to polling: {e.strerror}{RESET}")
+    return PollingWatcher(root, skip_dots, filters, poll or POLL_INTERVAL)
+
+def scan_paths(root, paths, skip_dots=True, filters=None):
+    """Return the {relative_path: (size, mtime)} manifest of the given files and directories below root."""
+    manifest = {}
+    for path in topmost(paths):
+        full_path = os.path.join(root, path) if path else root
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            if path and filters and filters.excludes_dir(path):
+                continue
+            manifest.update(local_manifest(root, skip_dots, filters, subdir=path))
+        elif os.path.isfile(full_path):
+            if skip_dots and os.path.basename(path).startswith("._"):
+                continue
+            try:
+                st = os.stat(full_path)
+            except FileNotFoundError:
+                continue
+            if filters and not filters.matches(path, st.st_size, st.st_mtime):
+                continue
+            manifest[path] = (st.st_size, st.st_mtime)
+    return manifest
+
+class ChangeSet:
+    """Remote operations that bring the cluster copy of a folder up to date.
+
+    moves are (source, destination, file_pairs) renames of files or whole
+    directories, file_pairs listing the (source, destination) files they
+    cover; uploads are files to send; deletes are files and removed_dirs
+    directories to remove. roots are the rescanned paths and scanned their
+    new {path: (size, mtime)} manifest, which commit() records.
+    """
+
+    def __init__(self, moves, uploads, deletes, removed_dirs, roots=(), scanned=None):
+        self.moves = moves
+        self.uploads = uploads
+        self.deletes = deletes
+        self.removed_dirs = removed_dirs
+        self.roots = list(roots)
+        self.scanned = scanned or {}
+
+    def __bool__(self):
+        return bool(self.moves or self.uploads or self.deletes or self.removed_dirs)
+
+    def summary(self):
+        parts = []
+        if self.uploads:
+            parts.append(f"{len(self.uploads)} changed")
+        if self.moves:
+            parts.append(f"{len(self.moves)} renamed")
+        if self.deletes or self.removed_dirs:
+            parts.append(f"{len(self.deletes) + len(self.removed_dirs)} deleted")
+        return ', '.join(parts)
+
+    def commit(self, state, failed=()):
+        """Update the state manifest once the operations are applied.
+
+        Paths in failed keep their old entries (or stay absent), so the
+        cluster copy isn't taken to have them.
+        """
+        failed = set(failed)
+        for path in [path for path in state if is_below(path, self.roots) and path not in failed]:
+            del state[path]
+        state.update((path, entry) for path, entry in self.scanned.items() if path not in failed)
+
+def plan_changes(root, state, paths, skip_dots=True, filters=None):
+    """Rescan the changed paths below root and plan the remote operations.
+
+    state is the {path: (size, mtime)} manifest the cluster copy matches;
+    it isn't changed here, commit() the returned ChangeSet to it once the
+    operations succeed. Without filters a directory that is
+    gone locally is removed remotely as a whole; with filters files are
+    removed one by one, so excluded remote files survive.
+    """
+    roots = topmost(paths)
+    old = {path: entry for path, entry in state.items() if is_below(path, roots)}
+    new = scan_paths(root, roots, skip_dots, filters)
+    changed, removed = compare_manifests(new, old, tolerance=0)
+
+    # A file that vanished and reappeared with the same size and mtime was renamed
+    vanished = {}
+    for path in removed:
+        vanished.setdefault(old[path], []).append(path)
+    pairs = []
+    for path in changed:
+        if path not in old and vanished.get(new[path]):
+            pairs.append((vanished[new[path]].pop(), path))
+
+    # Renames sharing a directory prefix are a renamed directory
+    groups = {}
+    for source, destination in pairs:
+        source_parts, destination_parts = source.split('/'), destination.split('/')
+        while len(source_parts) > 1 and len(destination_parts) > 1 and source_parts[-1] == destination_parts[-1]:
+            source_parts.pop()
+            destination_parts.pop()
+        groups.setdefault(('/'.join(source_parts), '/'.join(destination_parts)), []).append((source, destination))
+    moves = []
+    for (source, destination), group in groups.items():
+        moved = set(pair[0] for pair in group)
+        is_dir_move = (len(group) > 1 or group[0] != (source, destination)) \
+            and not os.path.exists(os.path.join(root, source)) \
+            and all(path in moved for path in state if is_below(path, [source])) \
+            and not any(is_below(path, [destination]) for path in state)
+        if is_dir_move:
+            moves.append((source, destination, group))
+        else:
+            moves.extend((pair[0], pair[1], [pair]) for pair in group)
+
+    moved_from = set(pair[0] for pair in pairs)
+    moved_to = set(pair[1] for pair in pairs)
+    uploads = [path for path in changed if path not in moved_to]
+    deletes = []
+    removed_dirs = set()
+    for path in removed:
+        if path in moved_from:
+            continue
+        parts = path.split('/')
+        gone = None
+        if not filters:
+            for i in range(1, len(parts)):
+                if not os.path.isdir(os.path.join(root, *parts[:i])):
+                    gone = '/'.join(parts[:i])
+                    break
+        if gone is not None:
+            removed_dirs.add(gone)
+        else:
+            deletes.append(path)
+
+    return ChangeSet(moves, uploads, deletes, sorted(topmost(removed_dirs)), roots, new)
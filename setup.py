@@ -3,7 +3,7 @@ from setuptools import setup, find_packages
 setup(
     name="clustertools",
     version="0.1.0",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*", "tests"]),
     install_requires=[
         "paramiko>=3.5.1",
         "tqdm==4.65.0",
@@ -13,6 +13,9 @@ setup(
         'console_scripts': [
             'cluster2local=clustertools.cluster2local:main',
             'local2cluster=clustertools.local2cluster:main',
+            'cluster2cluster=clustertools.cluster2cluster:main',
+            'clustertools-broker=clustertools.broker:main',
+            'clustertools=clustertools.cli:main',
         ],
     },
     author="Simone D'Ambrogio",
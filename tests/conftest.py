@@ -0,0 +1,25 @@
+import paramiko
+import pytest
+from scp import SCPClient
+
+# The benchmarks' SSH stand-in serves exec and SFTP on the local filesystem
+from benchmarks.server import BenchmarkServer
+
+@pytest.fixture(scope='session')
+def server():
+    server = BenchmarkServer().start()
+    yield server
+    server.close()
+
+@pytest.fixture
+def ssh(server):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect('127.0.0.1', port=server.port, username='test', password='test',
+                   look_for_keys=False, allow_agent=False)
+    yield client
+    client.close()
+
+@pytest.fixture
+def scp(ssh):
+    return SCPClient(ssh.get_transport())
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from clustertools import compression as compression_module
+from clustertools.cluster2local import download_folder
+
+def make_tree(root, files):
+    for path, data in files.items():
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'wb') as f:
+            f.write(data)
+
+def read_tree(root):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            full = os.path.join(dirpath, filename)
+            with open(full, 'rb') as f:
+                tree[os.path.relpath(full, root)] = f.read()
+    return tree
+
+def test_sync_download_of_missing_folder_raises(tmp_path, ssh, scp):
+    make_tree(tmp_path / 'local' / 'data', {'keep': b'k'})
+    with pytest.raises(FileNotFoundError):
+        download_folder(ssh, scp, str(tmp_path / 'local'), str(tmp_path / 'missing' / 'data'), sync=True, delete=True)
+    assert read_tree(tmp_path / 'local' / 'data') == {'keep': b'k'}
+
+def test_sync_delete_refuses_to_empty_the_local_folder(tmp_path, ssh, scp):
+    make_tree(tmp_path / 'local' / 'data', {'keep': b'k'})
+    os.makedirs(tmp_path / 'remote' / 'data')
+    with pytest.raises(Exception, match='Refusing to delete'):
+        download_folder(ssh, scp, str(tmp_path / 'local'), str(tmp_path / 'remote' / 'data'), sync=True, delete=True)
+    assert read_tree(tmp_path / 'local' / 'data') == {'keep': b'k'}
+
+TREE = {'a.txt': b'a' * 100, 'sub/b.bin': os.urandom(2 * 1024 * 1024), 'sub/deep/c.txt': b'c', 'd.gz': os.urandom(500)}
+
+@pytest.mark.parametrize('compression', ['none', 'gzip', 'zstd', 'lz4', 'auto'])
+def test_stream_download_round_trip(tmp_path, ssh, scp, compression):
+    make_tree(tmp_path / 'remote' / 'data', TREE)
+    download_folder(ssh, scp, str(tmp_path / 'local'), str(tmp_path / 'remote' / 'data'), compression=compression)
+    assert read_tree(tmp_path / 'local' / 'data') == TREE
+
+def test_stream_download_falls_back_to_gzip_for_a_missing_codec(tmp_path, ssh, scp, monkeypatch, capsys):
+    monkeypatch.setattr(compression_module, 'local_codecs', lambda: {'none', 'gzip'})
+    make_tree(tmp_path / 'remote' / 'data', TREE)
+    download_folder(ssh, scp, str(tmp_path / 'local'), str(tmp_path / 'remote' / 'data'), compression='zstd')
+    assert 'zstd is not available on both ends, using gzip' in capsys.readouterr().out
+    assert read_tree(tmp_path / 'local' / 'data') == TREE
+
+def test_sharded_download_round_trip(tmp_path, ssh, scp):
+    make_tree(tmp_path / 'remote' / 'data', TREE)
+    download_folder(ssh, scp, str(tmp_path / 'local'), str(tmp_path / 'remote' / 'data'), shards=3)
+    assert read_tree(tmp_path / 'local' / 'data') == TREE
+
+def test_stream_download_of_missing_folder_reports_remote_error(tmp_path, ssh, scp):
+    with pytest.raises(Exception, match='No such file'):
+        download_folder(ssh, scp, str(tmp_path / 'local'), str(tmp_path / 'missing' / 'data'), compression='none')
+
+def test_sharded_download_of_missing_folder_raises(tmp_path, ssh, scp):
+    with pytest.raises(FileNotFoundError):
+        download_folder(ssh, scp, str(tmp_path / 'local'), str(tmp_path / 'missing' / 'data'), shards=3)
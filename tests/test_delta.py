@@ -0,0 +1,95 @@
+import io
+import os
+import random
+
+import pytest
+
+from clustertools.delta import apply_delta, block_signatures, compute_delta, decode_signatures, encode_signatures
+
+BLOCK_SIZE = 4096
+
+def run_delta(basis, target, block_size=BLOCK_SIZE):
+    """Send target against basis and return (rebuilt, literal_bytes, copied_bytes)."""
+    signatures = decode_signatures(encode_signatures(block_signatures(io.BytesIO(basis), block_size)))
+    stream = io.BytesIO()
+    literal, copied = compute_delta(io.BytesIO(target), signatures, block_size, stream.write, 1234.5)
+    stream.seek(0)
+    out = io.BytesIO()
+    result = apply_delta(io.BytesIO(basis), stream, out, block_size)
+    assert result == (literal, copied, 1234.5)
+    return out.getvalue(), literal, copied
+
+def random_bytes(n, seed=0):
+    return random.Random(seed).randbytes(n)
+
+def test_identical_file_is_copied():
+    data = random_bytes(300000)
+    rebuilt, literal, copied = run_delta(data, data)
+    assert rebuilt == data
+    assert literal == 0
+    assert copied == len(data)
+
+def test_empty_basis_sends_everything():
+    data = random_bytes(50000)
+    rebuilt, literal, copied = run_delta(b'', data)
+    assert rebuilt == data
+    assert literal == len(data)
+
+def test_empty_target():
+    rebuilt, literal, copied = run_delta(random_bytes(10000), b'')
+    assert rebuilt == b''
+    assert (literal, copied) == (0, 0)
+
+@pytest.mark.parametrize('offset', [0, 1, 4095, 100000])
+def test_small_insert(offset):
+    basis = random_bytes(200000)
+    target = basis[:offset] + b'inserted' + basis[offset:]
+    rebuilt, literal, copied = run_delta(basis, target)
+    assert rebuilt == target
+    assert literal <= 2 * BLOCK_SIZE + 8
+
+def test_shifted_insert_longer_than_rolling_window():
+    # An insert longer than 16 blocks used to leave every later block unmatched
+    basis = random_bytes(2 * 1024 * 1024)
+    insert = random_bytes(16 * BLOCK_SIZE + 123, seed=1)
+    target = basis[:500000] + insert + basis[500000:]
+    rebuilt, literal, copied = run_delta(basis, target)
+    assert rebuilt == target
+    assert literal < len(insert) + 10 * BLOCK_SIZE
+    assert copied > len(basis) - 10 * BLOCK_SIZE
+
+@pytest.mark.parametrize('seed', range(8))
+def test_random_edits_round_trip(seed):
+    rng = random.Random(seed)
+    basis = random_bytes(rng.randrange(1, 400000), seed=seed)
+    target = bytearray(basis)
+    for _ in range(rng.randrange(1, 6)):
+        offset = rng.randrange(len(target) + 1)
+        length = rng.randrange(0, 80000)
+        kind = rng.choice(['insert', 'delete', 'replace'])
+        if kind == 'insert':
+            target[offset:offset] = rng.randbytes(length)
+        elif kind == 'delete':
+            del target[offset:offset + length]
+        else:
+            target[offset:offset + length] = rng.randbytes(length)
+    rebuilt, literal, copied = run_delta(basis, bytes(target), block_size=rng.choice([512, 4096, 65536]))
+    assert rebuilt == bytes(target)
+    assert literal + copied == len(target)
+
+def test_changed_tail_and_truncation():
+    basis = random_bytes(100000)
+    target = basis[:70000] + random_bytes(5000, seed=2)
+    rebuilt, literal, copied = run_delta(basis, target)
+    assert rebuilt == target
+    assert copied >= 65536
+
+def test_corrupted_stream_is_rejected():
+    basis = random_bytes(20000)
+    signatures = block_signatures(io.BytesIO(basis), BLOCK_SIZE)
+    stream = io.BytesIO()
+    compute_delta(io.BytesIO(basis + b'tail'), signatures, BLOCK_SIZE, stream.write)
+    # Rebuilding from a different basis doesn't match the carried checksum
+    stream.seek(0)
+    with pytest.raises(ValueError):
+        apply_delta(io.BytesIO(os.urandom(20000)), stream, io.BytesIO(), BLOCK_SIZE)
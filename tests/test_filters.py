@@ -0,0 +1,133 @@
+import os
+import re
+import subprocess
+import time
+
+import pytest
+
+from clustertools.filters import TransferFilter, parse_pattern, parse_size
+
+def make_tree(root, files):
+    """Create {relative_path: size} files below root."""
+    for path, size in files.items():
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'wb') as f:
+            f.write(b'x' * size)
+
+def find_matches(filters, root):
+    """Relative paths of the files the remote find of filters lists, run locally."""
+    output = subprocess.run(filters.find_command(str(root)), shell=True, check=True,
+                            capture_output=True).stdout
+    return sorted(path.decode() for path in output.split(b'\0') if path)
+
+def local_matches(filters, root):
+    """Relative paths of the files below root that filters.matches() selects."""
+    selected = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            full = os.path.join(dirpath, filename)
+            path = os.path.relpath(full, root)
+            if filters.matches(path, os.path.getsize(full), os.path.getmtime(full)):
+                selected.append(path)
+    return sorted(selected)
+
+@pytest.mark.parametrize('pattern, matching, other', [
+    ('*.log', ['a.log', 'x/y/b.log'], ['a.log.1', 'alog', 'x/a.txt']),
+    ('/build', ['build'], ['src/build', 'builds']),
+    ('data/raw/*.tmp', ['data/raw/a.tmp'], ['data/raw/sub/a.tmp', 'other/data/raw/a.tmp']),
+    ('logs/', ['logs', 'a/logs'], ['logs.txt']),
+    ('a?c', ['abc', 'x/a_c'], ['ac', 'a/c']),
+    ('**/cache', ['cache', 'a/b/cache'], ['a/cached']),
+    ('src/**', ['src/a', 'src/a/b/c'], ['src', 'lib/src/a']),
+    ('a/**/z', ['a/z', 'a/b/z', 'a/b/c/z'], ['b/a/z', 'a/zz']),
+    ('[!a]*.py', ['b.py', 'x/c.py'], ['a.py']),
+    ('file[0-9].txt', ['file3.txt'], ['filex.txt', 'file10.txt']),
+    ('\\#notes', ['#notes'], ['notes']),
+    ('a+b(c).txt', ['a+b(c).txt'], ['aab(c).txt', 'a+bc.txt']),
+])
+def test_gitignore_patterns(pattern, matching, other):
+    regex, dir_only = parse_pattern(pattern)
+    assert dir_only == pattern.endswith('/')
+    for path in matching:
+        assert re.fullmatch(regex, path), (pattern, path)
+    for path in other:
+        assert not re.fullmatch(regex, path), (pattern, path)
+
+def test_excluded_directory_excludes_its_files():
+    filters = TransferFilter(exclude=['.git', 'tmp/'])
+    assert filters.excludes_dir('.git') and filters.excludes_dir('sub/tmp')
+    assert not filters.matches('.git/config', 10)
+    assert not filters.matches('sub/tmp/x', 10)
+    assert filters.matches('tmpfile', 10)
+    assert filters.matches('src/main.py', 10)
+
+def test_include_selects_files_and_directories():
+    filters = TransferFilter(include=['*.py', 'docs/'])
+    assert filters.matches('a/b.py', 1)
+    assert filters.matches('docs/index.md', 1)
+    assert not filters.matches('a/b.txt', 1)
+
+def test_exclude_wins_over_include():
+    filters = TransferFilter(include=['*.py'], exclude=['tests/'])
+    assert filters.matches('src/a.py', 1)
+    assert not filters.matches('tests/test_a.py', 1)
+
+def test_empty_filter_is_false():
+    assert not TransferFilter()
+    assert TransferFilter(min_size=0)
+
+@pytest.mark.parametrize('value, size', [('500', 500), ('64k', 65536), ('1.5M', 1572864), ('2GiB', 2 * 1024 ** 3)])
+def test_parse_size(value, size):
+    assert parse_size(value) == size
+
+TREE = {
+    'a.log': 5, 'keep.txt': 20, 'big.bin': 5000, 'empty': 0,
+    'src/main.py': 100, 'src/util.py': 50, 'src/build/out.o': 300,
+    'build/x.o': 10, '.git/config': 30, 'docs/index.md': 40, 'docs/img/logo.png': 2000,
+    'odd name [1].txt': 7, 'data/raw/a.tmp': 3, 'data/raw/sub/b.tmp': 3,
+}
+
+@pytest.mark.parametrize('kwargs', [
+    {'exclude': ['*.log', '.git']},
+    {'exclude': ['/build', 'data/raw/*.tmp']},
+    {'exclude': ['build/']},
+    {'include': ['*.py']},
+    {'include': ['docs/'], 'exclude': ['*.png']},
+    {'include': ['src/**'], 'exclude': ['build']},
+    {'include': ['odd name*']},
+    {'min_size': 10, 'max_size': 1000},
+    {'max_size': 0},
+    {'exclude': ['**/raw'], 'min_size': 1},
+])
+def test_find_matches_local_filter(tmp_path, kwargs):
+    make_tree(tmp_path, TREE)
+    filters = TransferFilter(**kwargs)
+    assert find_matches(filters, tmp_path) == local_matches(filters, tmp_path)
+
+def test_find_matches_local_filter_on_mtimes(tmp_path):
+    make_tree(tmp_path, TREE)
+    now = time.time()
+    os.utime(tmp_path / 'a.log', (now - 7200, now - 7200))
+    os.utime(tmp_path / 'src' / 'main.py', (now - 3 * 86400, now - 3 * 86400))
+    for filters in [TransferFilter(newer_than=now - 3600), TransferFilter(older_than=now - 3600),
+                    TransferFilter(newer_than=now - 86400, older_than=now - 3600)]:
+        assert find_matches(filters, tmp_path) == local_matches(filters, tmp_path)
+
+def test_find_handles_special_characters_in_root(tmp_path):
+    root = tmp_path / 'dir with [brackets] (and) $pecial+chars'
+    make_tree(root, TREE)
+    filters = TransferFilter(exclude=['src/'], include=['*.py', '*.txt'])
+    assert find_matches(filters, root) == local_matches(filters, root)
+
+@pytest.mark.parametrize('min_size, expected', [
+    (0, ['big', 'empty', 'small']),
+    (1, ['big', 'small']),
+    (100, ['big']),
+])
+def test_min_size(tmp_path, min_size, expected):
+    make_tree(tmp_path, {'empty': 0, 'small': 10, 'big': 100})
+    filters = TransferFilter(min_size=min_size)
+    assert '+-1c' not in filters.find_command(str(tmp_path))
+    assert find_matches(filters, tmp_path) == expected
+    assert local_matches(filters, tmp_path) == expected
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from clustertools.local2cluster import plan_upload, upload_folder
+
+MB = 1024 * 1024
+
+def item(path, size):
+    return (f'/local/{path}', os.path.dirname(f'/remote/{path}'), f'/remote/{path}', size)
+
+def test_plan_upload_splits_small_and_large_files():
+    files = [item('a', 10), item('b', 2 * MB), item('c', 20), item('d', MB)]
+    batches, large_files = plan_upload(files, small_file_threshold=MB, batch_size=64 * MB)
+    assert [[entry[0] for entry in batch] for batch in batches] == [['/local/a', '/local/c']]
+    assert [entry[0] for entry in large_files] == ['/local/b', '/local/d']
+
+def test_plan_upload_closes_batches_at_batch_size():
+    files = [item(f'f{i}', 400) for i in range(10)]
+    batches, large_files = plan_upload(files, small_file_threshold=MB, batch_size=1000)
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+    assert sum(batches, []) == files
+    assert large_files == []
+
+def test_plan_upload_keeps_compressed_files_apart():
+    files = [item('a.txt', 10), item('b.gz', 10), item('c.txt', 10), item('d.zip', 10)]
+    batches, large_files = plan_upload(files, small_file_threshold=MB, batch_size=64 * MB)
+    assert sorted([entry[0] for entry in batch] for batch in batches) == [
+        ['/local/a.txt', '/local/c.txt'], ['/local/b.gz', '/local/d.zip']]
+
+def test_plan_upload_packs_everything_compressible_with_a_codec():
+    files = [item('big.txt', 10 * MB), item('big.gz', 10 * MB), item('small.txt', 10)]
+    batches, large_files = plan_upload(files, small_file_threshold=MB, batch_size=64 * MB, codec='zstd')
+    assert [[entry[0] for entry in batch] for batch in batches] == [['/local/big.txt', '/local/small.txt']]
+    assert [entry[0] for entry in large_files] == ['/local/big.gz']
+
+def test_plan_upload_without_packing():
+    files = [item('a', 10), item('b', 20)]
+    batches, large_files = plan_upload(files, small_file_threshold=0, batch_size=64 * MB)
+    assert batches == [] and large_files == files
+
+def make_tree(root, files):
+    for path, data in files.items():
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'wb') as f:
+            f.write(data)
+
+def read_tree(root):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            full = os.path.join(dirpath, filename)
+            with open(full, 'rb') as f:
+                tree[os.path.relpath(full, root)] = f.read()
+    return tree
+
+TREE = {'a.txt': b'a' * 100, 'sub/b.bin': os.urandom(2 * MB), 'sub/deep/c.txt': b'c', 'd.gz': os.urandom(500)}
+
+def test_upload_round_trip(tmp_path, ssh, scp):
+    make_tree(tmp_path / 'local' / 'data', TREE)
+    assert upload_folder(ssh, scp, str(tmp_path / 'local' / 'data'), str(tmp_path / 'remote'), workers=2)
+    assert read_tree(tmp_path / 'remote' / 'data') == TREE
+
+def test_upload_reports_failed_tar_batches(tmp_path, ssh, scp):
+    make_tree(tmp_path / 'local' / 'data', {'sub/a': b'a', 'sub/b': b'b', 'c': b'c'})
+    # A file where the cluster needs a directory makes the remote tar fail
+    make_tree(tmp_path / 'remote' / 'data', {'sub': b'in the way'})
+    assert upload_folder(ssh, scp, str(tmp_path / 'local' / 'data'), str(tmp_path / 'remote')) is False
+
+def test_upload_recreates_directories_removed_between_transfers(tmp_path, ssh, scp):
+    make_tree(tmp_path / 'local' / 'data', {'sub/deep/f': b'f'})
+    local, remote = str(tmp_path / 'local' / 'data'), str(tmp_path / 'remote')
+    assert upload_folder(ssh, scp, local, remote, small_file_threshold=0)
+    os.remove(tmp_path / 'remote' / 'data' / 'sub' / 'deep' / 'f')
+    os.rmdir(tmp_path / 'remote' / 'data' / 'sub' / 'deep')
+    assert upload_folder(ssh, scp, local, remote, small_file_threshold=0)
+    assert read_tree(tmp_path / 'remote' / 'data') == {'sub/deep/f': b'f'}
+
+def test_sync_delete_refuses_to_empty_the_destination(tmp_path, ssh, scp):
+    os.makedirs(tmp_path / 'local' / 'data')
+    make_tree(tmp_path / 'remote' / 'data', {'keep': b'k'})
+    with pytest.raises(Exception, match='Refusing to delete'):
+        upload_folder(ssh, scp, str(tmp_path / 'local' / 'data'), str(tmp_path / 'remote'), sync=True, delete=True)
+    assert read_tree(tmp_path / 'remote' / 'data') == {'keep': b'k'}
+
+def test_upload_of_missing_folder_raises(tmp_path, ssh, scp):
+    with pytest.raises(FileNotFoundError):
+        upload_folder(ssh, scp, str(tmp_path / 'missing'), str(tmp_path / 'remote'), sync=True, delete=True)
@@ -0,0 +1,104 @@
+import os
+import shutil
+
+from clustertools.filters import TransferFilter
+from clustertools.sync import local_manifest
+from clustertools.watch import plan_changes, topmost
+
+def make_tree(root, files):
+    for path, content in files.items():
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, 'w') as f:
+            f.write(content)
+
+TREE = {
+    'a.txt': 'a', 'b.txt': 'bb',
+    'dir/x.txt': 'x', 'dir/y.txt': 'yy', 'dir/sub/z.txt': 'zzz',
+    'other/o.txt': 'o',
+}
+
+def setup_tree(tmp_path):
+    root = str(tmp_path)
+    make_tree(root, TREE)
+    return root, local_manifest(root)
+
+def test_file_rename_is_a_move(tmp_path):
+    root, state = setup_tree(tmp_path)
+    os.rename(os.path.join(root, 'a.txt'), os.path.join(root, 'renamed.txt'))
+    changes = plan_changes(root, state, {'a.txt', 'renamed.txt'})
+    assert changes.moves == [('a.txt', 'renamed.txt', [('a.txt', 'renamed.txt')])]
+    assert changes.uploads == [] and changes.deletes == [] and changes.removed_dirs == []
+    changes.commit(state)
+    assert 'renamed.txt' in state and 'a.txt' not in state
+
+def test_directory_rename_is_one_move(tmp_path):
+    root, state = setup_tree(tmp_path)
+    os.rename(os.path.join(root, 'dir'), os.path.join(root, 'moved'))
+    changes = plan_changes(root, state, {'dir', 'moved'})
+    assert len(changes.moves) == 1
+    source, destination, pairs = changes.moves[0]
+    assert (source, destination) == ('dir', 'moved')
+    assert sorted(pairs) == [('dir/sub/z.txt', 'moved/sub/z.txt'), ('dir/x.txt', 'moved/x.txt'),
+                             ('dir/y.txt', 'moved/y.txt')]
+    assert not changes.uploads and not changes.deletes and not changes.removed_dirs
+
+def test_partial_directory_move_is_per_file(tmp_path):
+    root, state = setup_tree(tmp_path)
+    # Only some files of dir move, so dir itself must not be renamed
+    os.makedirs(os.path.join(root, 'new'))
+    os.rename(os.path.join(root, 'dir', 'x.txt'), os.path.join(root, 'new', 'x.txt'))
+    os.rename(os.path.join(root, 'dir', 'y.txt'), os.path.join(root, 'new', 'y.txt'))
+    changes = plan_changes(root, state, {'dir/x.txt', 'dir/y.txt', 'new'})
+    assert sorted(move[:2] for move in changes.moves) == [('dir/x.txt', 'new/x.txt'), ('dir/y.txt', 'new/y.txt')]
+    assert all(len(move[2]) == 1 for move in changes.moves)
+
+def test_changed_content_is_uploaded_not_moved(tmp_path):
+    root, state = setup_tree(tmp_path)
+    os.remove(os.path.join(root, 'a.txt'))
+    make_tree(root, {'c.txt': 'different'})
+    changes = plan_changes(root, state, {'a.txt', 'c.txt'})
+    assert changes.moves == []
+    assert changes.uploads == ['c.txt']
+    assert changes.deletes == ['a.txt']
+
+def test_removed_directory_is_removed_whole(tmp_path):
+    root, state = setup_tree(tmp_path)
+    shutil.rmtree(os.path.join(root, 'dir'))
+    changes = plan_changes(root, state, {'dir'})
+    assert changes.removed_dirs == ['dir']
+    assert changes.deletes == []
+    changes.commit(state)
+    assert not any(path.startswith('dir/') for path in state)
+
+def test_removed_directory_with_filters_deletes_files(tmp_path):
+    root = str(tmp_path)
+    make_tree(root, TREE)
+    filters = TransferFilter(exclude=['*.log'])
+    state = local_manifest(root, filters=filters)
+    shutil.rmtree(os.path.join(root, 'dir'))
+    changes = plan_changes(root, state, {'dir'}, filters=filters)
+    # Excluded remote files in dir must survive, so nothing is removed recursively
+    assert changes.removed_dirs == []
+    assert sorted(changes.deletes) == ['dir/sub/z.txt', 'dir/x.txt', 'dir/y.txt']
+
+def test_state_changes_only_on_commit(tmp_path):
+    root, state = setup_tree(tmp_path)
+    before = dict(state)
+    make_tree(root, {'a.txt': 'changed', 'new.txt': 'n'})
+    changes = plan_changes(root, state, {'a.txt', 'new.txt'})
+    assert sorted(changes.uploads) == ['a.txt', 'new.txt']
+    assert state == before
+    # A failed upload keeps its old entry, so the file still differs next time
+    changes.commit(state, failed=['a.txt'])
+    assert state['a.txt'] == before['a.txt']
+    assert 'new.txt' in state
+
+def test_no_changes(tmp_path):
+    root, state = setup_tree(tmp_path)
+    changes = plan_changes(root, state, {'a.txt'})
+    assert not changes
+    assert changes.summary() == ''
+
+def test_topmost():
+    assert sorted(topmost(['a/b', 'a', 'c/d', 'c/d/e', 'cd'])) == ['a', 'c/d', 'cd']